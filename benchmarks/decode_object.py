@@ -0,0 +1,114 @@
+"""
+    Compares database.io.decode_object against the previous deepcopy and regex based
+    decoding, over synthetic stored transactions.
+
+    Usage (from the repository root):
+
+        PYTHONPATH=src python benchmarks/decode_object.py [documents ...]
+"""
+from copy import deepcopy
+from dataclasses import is_dataclass
+from datetime import datetime, timedelta
+
+import re
+import sys
+import time
+
+import datatypes
+from database.io import decode_object, encode_object
+from datatypes import BankAccountTransaction, Account, Card, Category, Issuer, TransactionType, UnknownSubject
+
+
+def make_documents(count):
+    first_date = datetime(2010, 1, 1)
+    return [
+        encode_object(BankAccountTransaction(
+            transaction_id=str(seq),
+            type=TransactionType.PURCHASE,
+            currency='EUR',
+            amount=-float(seq % 97 + 1),
+            balance=float(seq),
+            value_date=first_date + timedelta(hours=seq),
+            transaction_date=first_date + timedelta(hours=seq),
+            source=Account('TEST_ACCOUNT', '00000000001'),
+            destination=Issuer('SHOP {}'.format(seq % 50)),
+            account=Account('TEST_ACCOUNT', '00000000001'),
+            card=Card('TEST_CARD', '00000000001') if seq % 2 else UnknownSubject(),
+            details={'origin': 'SHOP {}'.format(seq % 50), 'activity': 'RETAIL'},
+            keywords=['SHOP', str(seq % 50)],
+            comment='',
+            category=Category(id='1', name='Shopping') if seq % 3 else None,
+            tags=['test'],
+            _seq=seq
+        ))
+        for seq in range(count)
+    ]
+
+
+def legacy_decode_object(document):
+    if document is None:
+        return None
+
+    def decode(obj):
+        if not isinstance(obj, dict):
+            return obj
+
+        if '__type__' not in obj:
+            return obj
+
+        custom_type_class, custom_type_name = re.match(r'([^:]+)(?:::(.*))?', obj.pop('__type__')).groups()
+
+        if custom_type_class == 'dataclass':
+            CustomDataclass = getattr(datatypes, custom_type_name)
+            return CustomDataclass(**obj)
+        elif custom_type_class == 'enum':
+            CustomEnum = getattr(datatypes, custom_type_name)
+            return CustomEnum[obj['name']]
+        elif custom_type_class == 'datetime':
+            return datetime.strptime(obj['date'], '%Y-%m-%dT%H:%M:%S')
+        else:
+            return obj
+
+    def recurse(obj):
+        decoded = decode(obj)
+        if is_dataclass(decoded):
+            for key, value in decoded.__dict__.items():
+                setattr(decoded, key, recurse(value))
+            return decoded
+        elif isinstance(decoded, dict):
+            return {key: recurse(value) for key, value in decoded.items()}
+        elif isinstance(decoded, list):
+            return [recurse(item) for item in decoded]
+        else:
+            return decoded
+
+    return recurse(deepcopy(document))
+
+
+def timed(function, documents):
+    t0 = time.perf_counter()
+    result = list(map(function, documents))
+    return result, time.perf_counter() - t0
+
+
+def run(count):
+    documents = make_documents(count)
+    snapshot = deepcopy(documents)
+
+    legacy_result, legacy_time = timed(legacy_decode_object, documents)
+    result, decode_time = timed(decode_object, documents)
+
+    assert result == legacy_result, 'Decoded objects differ from the previous decoding'
+    assert documents == snapshot, 'Stored documents were modified while decoding'
+
+    print('{count:>8} documents | legacy {legacy:8.3f}s | decode_object {decode:8.3f}s | x{speedup:.1f}'.format(
+        count=count,
+        legacy=legacy_time,
+        decode=decode_time,
+        speedup=legacy_time / decode_time
+    ))
+
+
+if __name__ == '__main__':
+    for count in map(int, sys.argv[1:] or [50000]):
+        run(count)
@@ -0,0 +1,139 @@
+"""
+    Compares common.utils.get_nested_item against the previous implementation, that
+    parsed the xpath on every call, reading the details the bank parsers read from
+    synthetic BBVA and Bankia movements, and the fields read by the rules from
+    transactions.
+
+    Usage (from the repository root):
+
+        PYTHONPATH=src python benchmarks/get_nested_item.py [movements ...]
+"""
+from datetime import datetime
+from functools import reduce
+
+import re
+import sys
+import time
+
+from common.utils import get_nested_item
+from datatypes import BankAccountTransaction, Account, Card, Issuer, TransactionType
+
+
+BBVA_XPATHS = [
+    'comments.[0].text', 'cardTransactionDetail.shop.name', 'humanConceptName',
+    'origin.panCode', 'cardTransactionDetail.shop.businessActivity.name',
+    'wireTransactionDetail.sender.person.name', 'wireTransactionDetail.sender.account.formats.ccc',
+    'humanExtendedConceptName', 'billTransactionDetail.creditor.name',
+    'billTransactionDetail.extendedBillConceptName', 'scheme.subCategory.id', 'concept.id',
+]
+
+BANKIA_XPATHS = [
+    'referencias.0440.descripcion', 'referencias.0240.descripcion', 'beneficiarioOEmisor',
+    'referencias.0500.descripcion', 'referencias.0300.descripcion', 'referencias.0400.descripcion',
+    'referencias.0503.descripcion', 'lugarMovimiento',
+]
+
+RULES_XPATHS = ['type', 'keywords', 'destination', 'details.shop_name', 'details.concept', 'amount']
+
+
+def make_bbva_movement(seq):
+    movement = {
+        'humanConceptName': 'Compra {}'.format(seq),
+        'humanExtendedConceptName': 'Compra en comercio {}'.format(seq),
+        'concept': {'id': '{:04d}'.format(seq % 300)},
+        'scheme': {'subCategory': {'id': '{:04d}'.format(seq % 50)}},
+        'origin': {'panCode': '{:04d}'.format(seq % 10)},
+    }
+    if seq % 3 == 0:
+        movement['comments'] = [{'text': 'Comment {}'.format(seq)}]
+        movement['cardTransactionDetail'] = {'shop': {'name': 'SHOP {}'.format(seq % 50), 'businessActivity': {'name': 'RETAIL'}}}
+    elif seq % 3 == 1:
+        movement['wireTransactionDetail'] = {'sender': {'person': {'name': 'SENDER'}, 'account': {'formats': {'ccc': '0000'}}}}
+    else:
+        movement['billTransactionDetail'] = {'creditor': {'name': 'CREDITOR'}, 'extendedBillConceptName': 'BILL'}
+    return movement
+
+
+def make_bankia_movement(seq):
+    references = ['0440', '0240', '0300'] if seq % 2 else ['0500', '0400', '0503']
+    return {
+        'beneficiarioOEmisor': 'EMISOR {}'.format(seq % 20) if seq % 4 else None,
+        'lugarMovimiento': 'LUGAR {}'.format(seq % 30),
+        'referencias': {reference: {'descripcion': 'REF {}'.format(seq)} for reference in references},
+    }
+
+
+def make_transaction(seq):
+    return BankAccountTransaction(
+        transaction_id=str(seq),
+        type=TransactionType.PURCHASE,
+        currency='EUR',
+        amount=-float(seq % 97 + 1),
+        balance=float(seq),
+        value_date=datetime(2019, 1, 1),
+        transaction_date=datetime(2019, 1, 1),
+        source=Account('TEST_ACCOUNT', '00000000001'),
+        destination=Issuer('SHOP {}'.format(seq % 50)),
+        account=Account('TEST_ACCOUNT', '00000000001'),
+        card=Card('TEST_CARD', '00000000001'),
+        details={'shop_name': 'SHOP {}'.format(seq % 50), 'activity': 'RETAIL'},
+        keywords=['SHOP', str(seq % 50)],
+        comment='',
+    )
+
+
+def legacy_get_nested_item(dictionary, xpath, default=None):
+
+    def getitem(d, key):
+        match = re.match(r'\[(\d+)\]', key)
+        if match:
+            index = int(match.groups()[0])
+            return d[index]
+        else:
+            try:
+                return d[key]
+            except (KeyError, TypeError):
+                try:
+                    return getattr(d, key)
+                except AttributeError:
+                    return None
+                except Exception:
+                    return None
+            except Exception:
+                return None
+    try:
+        return reduce(getitem, xpath.split('.'), dictionary)
+    except TypeError:
+        return default
+    except IndexError:
+        return default
+    except AttributeError:
+        return default
+
+
+def timed(function, objects, xpaths):
+    t0 = time.perf_counter()
+    result = [function(obj, xpath) for obj in objects for xpath in xpaths]
+    return result, time.perf_counter() - t0
+
+
+def run(name, objects, xpaths):
+    legacy_result, legacy_time = timed(legacy_get_nested_item, objects, xpaths)
+    result, compiled_time = timed(get_nested_item, objects, xpaths)
+
+    assert result == legacy_result, 'Values differ from the previous implementation'
+
+    print('{name:>14} | {count:>8} lookups | legacy {legacy:8.3f}s | compiled {compiled:8.3f}s | x{speedup:.1f}'.format(
+        name=name,
+        count=len(result),
+        legacy=legacy_time,
+        compiled=compiled_time,
+        speedup=legacy_time / compiled_time
+    ))
+
+
+if __name__ == '__main__':
+    for count in map(int, sys.argv[1:] or [20000]):
+        run('BBVA', [make_bbva_movement(seq) for seq in range(count)], BBVA_XPATHS)
+        run('Bankia', [make_bankia_movement(seq) for seq in range(count)], BANKIA_XPATHS)
+        run('Transactions', [make_transaction(seq) for seq in range(count)], RULES_XPATHS)
@@ -0,0 +1,101 @@
+"""
+    Compares the transaction alignment engine used by database.io.select_new_transactions
+    against the previous difflib.Differ based comparison, over synthetic histories.
+
+    Usage (from the repository root):
+
+        PYTHONPATH=src python benchmarks/select_new_transactions.py [rows ...]
+"""
+from datetime import datetime, timedelta
+from difflib import Differ
+from operator import itemgetter
+
+import sys
+import time
+
+from common.utils import get_nested_item
+from database import alignment
+from datatypes import BankCreditCardTransaction, Card, TransactionType, UnknownSubject
+
+KEY_FIELDS = ['transaction_date', 'amount', 'type.name']
+NEW_TRANSACTIONS = 50
+
+
+def make_history(rows):
+    first_date = datetime(2010, 1, 1)
+    return [
+        BankCreditCardTransaction(
+            transaction_id=str(seq),
+            type=TransactionType.PURCHASE,
+            currency='EUR',
+            amount=-float(seq % 97 + 1),
+            value_date=first_date + timedelta(hours=seq),
+            transaction_date=first_date + timedelta(hours=seq),
+            source=Card('TEST_CARD', '00000000001'),
+            destination=UnknownSubject(),
+            card=Card('TEST_CARD', '00000000001'),
+            details={},
+            keywords=[],
+            comment='',
+            _seq=seq
+        )
+        for seq in range(rows + NEW_TRANSACTIONS)
+    ]
+
+
+def transaction_key(transaction):
+    return alignment.key_line(get_nested_item(transaction, field) for field in KEY_FIELDS)
+
+
+def differ_diff(db_keys, fetched_keys):
+    return [
+        (line[0], line[2:])
+        for line in Differ().compare(db_keys, fetched_keys)
+        if line[0] != '?'
+    ]
+
+
+def alignment_diff(db_keys, fetched_keys):
+    return list(alignment.diff(db_keys, fetched_keys))
+
+
+def timed(function, *args):
+    t0 = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - t0
+
+
+def tail_scenario(history, rows):
+    # Stored history overlaps with a fetched window of the last half, plus new ones at the tail
+    return history[:rows], history[rows // 2:]
+
+
+def interleaved_scenario(history, rows):
+    # Backfill of a fetched window where every other transaction was missing on the database
+    return history[:rows:2] + history[rows:], history[rows // 2:]
+
+
+def run(rows, scenario):
+    history = list(map(transaction_key, make_history(rows)))
+    db_keys, fetched_keys = scenario(history, rows)
+
+    alignment_result, alignment_time = timed(alignment_diff, db_keys, fetched_keys)
+    differ_result, differ_time = timed(differ_diff, db_keys, fetched_keys)
+
+    assert alignment_result == differ_result, 'Alignment differs from difflib.Differ'
+    inserted = len(list(filter(lambda action: action == '+', map(itemgetter(0), alignment_result))))
+
+    print('{scenario:<12} {rows:>8} rows | differ {differ:8.3f}s | alignment {alignment:8.3f}s | x{speedup:.1f} | {inserted} inserted'.format(
+        scenario=scenario.__name__.replace('_scenario', ''),
+        rows=rows,
+        differ=differ_time,
+        alignment=alignment_time,
+        speedup=differ_time / alignment_time,
+        inserted=inserted
+    ))
+
+
+if __name__ == '__main__':
+    for scenario in [tail_scenario, interleaved_scenario]:
+        for rows in map(int, sys.argv[1:] or [1000, 10000, 100000]):
+            run(rows, scenario)
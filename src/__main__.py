@@ -7,9 +7,11 @@ Usage:
   banking load <bank> (account|card) transactions [options]
   banking load all transactions [--filter=<filters>]
   banking remove <bank> (account|card) transaction <seq> [options]
-  banking apply rules
+  banking apply rules [--workers=<count>] [--all]
+  banking profile rules [--json=<filename>]
   banking load <bank> (account|card) raw transactions <raw-filename> [options]
   banking run server [options]
+  banking migrate database <tinymongo-folder>
   banking (-h | --help)
   banking --version
 
@@ -25,12 +27,16 @@ Options:
   --keep-browser-open    Prevent to close the selenium browser after a crash
   --use-cache            Use cached raw transactions if any
   --no-initial-update    When running the server, don't run the initial scheduler
+  --workers=<count>      Processes used to apply the rules, defaults to the number of cpus
+  --all                  Apply the rules to all transactions, not only the ones affected by rule changes
+  --json=<filename>      Save the rules profile to a json file
 
 """
 
 # ps aux | grep "python src" | grep -v grep | tr -s " " | cut -d" " -f2 | xargs kill -9
 #  ps aux | grep -i chrome | grep webdriver | tr -s " " | cut -d" " -f2 | xargs kill -9
 
+from dataclasses import replace
 from datetime import datetime
 from docopt import docopt
 from itertools import chain
@@ -162,6 +168,50 @@ def table_all(records, filters=[], show_balance=False):
     return tabulate(filtered, headers=headers, tablefmt='presto')
 
 
+def table_rules_profile(rules_profile):
+    headers = ['#', 'Rule', 'Actions', 'Evaluated', 'Matched', 'Hit rate', 'Time (ms)', 'Action passes']
+
+    def hit_rate(stats):
+        return '{:.1%}'.format(stats.matches / stats.evaluations) if stats.evaluations else '--'
+
+    def prepare_row(position, stats):
+        return [
+            position,
+            stats.description,
+            stats.actions,
+            stats.evaluations,
+            stats.matches,
+            hit_rate(stats),
+            round(stats.time * 1000, 2),
+            stats.action_passes
+        ]
+
+    rows = [
+        prepare_row(position, stats)
+        for position, stats in sorted(enumerate(rules_profile.rule_stats), key=lambda item: item[1].time, reverse=True)
+    ]
+
+    condition_headers = ['#', 'Condition', 'Evaluated', 'Matched', 'Hit rate', 'Time (ms)']
+    condition_rows = [
+        [position, condition.description, condition.evaluations, condition.matches, hit_rate(condition), round(condition.time * 1000, 2)]
+        for position, stats in enumerate(rules_profile.rule_stats)
+        for condition in stats.conditions
+    ]
+
+    never_matched = [position for position, stats in enumerate(rules_profile.rule_stats) if stats.matches == 0]
+
+    return '\n\n'.join([
+        tabulate(rows, headers=headers, tablefmt='presto'),
+        tabulate(condition_rows, headers=condition_headers, tablefmt='presto'),
+        '{} transactions, {} passes (max {} on a single transaction). Rules never matched: {}'.format(
+            rules_profile.transactions,
+            rules_profile.passes,
+            rules_profile.max_passes,
+            ', '.join(map(str, never_matched)) or 'none'
+        )
+    ])
+
+
 def parse_date(date_string):
     """
         Dates from cli are expected as yyyy-mm-dd
@@ -178,8 +228,8 @@ if __name__ == '__main__':
     arguments = docopt(__doc__, version='Banking 1.0')
     banking_configuration = bank.load_config(bank.env()['main_config_file'])
 
-    action = list(filter(lambda action: arguments[action] is True, ['get', 'load', 'apply', 'update', 'run', 'remove']))[0]
-    target = list(filter(lambda target: arguments[target] is True, ['account', 'card', 'server', 'all']))[0]
+    action = list(filter(lambda action: arguments[action] is True, ['get', 'load', 'apply', 'update', 'run', 'remove', 'migrate', 'profile']))[0]
+    target = list(filter(lambda target: arguments[target] is True, ['account', 'card', 'server', 'all', 'database', 'rules']))[0]
 
     load_raw = arguments['raw']
     load_all = arguments['all']
@@ -196,6 +246,14 @@ if __name__ == '__main__':
         app.run(banking_configuration)
         sys.exit(0)
 
+    if action == 'migrate' and arguments['database']:
+        database_folder = bank.env()['database_folder']
+        migrated = database.migrate(arguments['<tinymongo-folder>'], database_folder)
+        for collection_name, count in migrated.items():
+            print('Copied {} documents from {}'.format(count, collection_name))
+        print('SQLite database ready at {}, it will be used from now on'.format(database_folder))
+        sys.exit(0)
+
     if action == 'load' and load_all:
         db = database.load(bank.env()['database_folder'])
         account_transactions = database.io.find_account_transactions(db)
@@ -215,18 +273,41 @@ if __name__ == '__main__':
 
         all_transactions = sorted(chain(account_transactions, credit_card_transactions), key=attrgetter('transaction_date'))
 
-        processed_transactions = rules.apply(rules.load(), all_transactions)
+        workers = int(arguments['--workers']) if arguments['--workers'] else os.cpu_count() or 1
+        user_rules = rules.load()
+        if arguments['--all']:
+            # Without a fingerprint, transactions are processed again by all the rules
+            pending_transactions = [replace(transaction, rules_fingerprint=None) for transaction in all_transactions]
+            rulesets = {}
+        else:
+            pending_transactions = all_transactions
+            rulesets = database.find_rulesets(db)
+        processed_transactions = rules.apply_incremental(user_rules, pending_transactions, rulesets, workers=workers)
 
-        changed = 0
-        for old_transaction, new_transaction in zip(all_transactions, processed_transactions):
-            if old_transaction != new_transaction:
-                database.update_transaction(db, new_transaction)
-                changed += 1
+        changed, field_changes = database.update_transactions_bulk(db, all_transactions, processed_transactions)
+        database.save_ruleset(db, user_rules)
 
         print('Updated {} of {} transactions'.format(changed, len(processed_transactions)))
+        for fieldname, count in field_changes.most_common():
+            print('  {}: {}'.format(fieldname, count))
 
         sys.exit(1)
 
+    if action == 'profile' and arguments['rules']:
+        db = database.load(bank.env()['database_folder'])
+        account_transactions = database.io.find_account_transactions(db)
+        credit_card_transactions = database.io.find_credit_card_transactions(db)
+
+        all_transactions = sorted(chain(account_transactions, credit_card_transactions), key=attrgetter('transaction_date'))
+
+        rules_profile = rules.profile(rules.load(), all_transactions)
+        print(table_rules_profile(rules_profile))
+
+        if arguments['--json']:
+            with open(arguments['--json'], 'w') as json_file:
+                json.dump(rules_profile.as_dict(), json_file, indent=4)
+        sys.exit(0)
+
     bank_id = arguments['<bank>']
 
     if action in ['get', 'update']:
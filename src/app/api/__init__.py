@@ -31,12 +31,11 @@ def account_from_config(account_config):
 class Account(Resource):
     def get(self, account_id):
         banking_configuration = bank.load_config(bank.env()['main_config_file'])
-        db = database.load(bank.env()['database_folder'])
-
-        account = account_from_config(banking_configuration.accounts[account_id])
-        encoded_account = io.encode_account(account)
-        encoded_account['balance'] = database.get_account_balance(db, account)
-        return jsonify(encoded_account)
+        with database.load(bank.env()['database_folder']) as db:
+            account = account_from_config(banking_configuration.accounts[account_id])
+            encoded_account = io.encode_account(account)
+            encoded_account['balance'] = database.get_account_balance(db, account)
+            return jsonify(encoded_account)
 
 
 class AccountsList(Resource):
@@ -51,48 +50,45 @@ class AccountsList(Resource):
 class AccountTransactions(Resource):
     def get(self, account_id):
         banking_configuration = bank.load_config(bank.env()['main_config_file'])
-        db = database.load(bank.env()['database_folder'])
-
-        account = account_from_config(banking_configuration.accounts[account_id])
-        transactions = database.find_transactions(db, account, sort_direction=database.SortDirection.NEWEST_TRANSACTION_FIRST)
-        return jsonify(list(map(io.encode_object, transactions)))
+        with database.load(bank.env()['database_folder']) as db:
+            account = account_from_config(banking_configuration.accounts[account_id])
+            transactions = database.find_transactions(db, account, sort_direction=database.SortDirection.NEWEST_TRANSACTION_FIRST)
+            return jsonify(list(map(io.encode_object, transactions)))
 
 
 class AccountAccessCode(Resource):
     def get(self, account_id):
         banking_configuration = bank.load_config(bank.env()['main_config_file'])
-        db = database.load(bank.env()['database_folder'])
-
-        account = account_from_config(banking_configuration.accounts[account_id])
-        access_code = database.get_account_access_code(db, account)
-        return jsonify(io.encode_object(access_code))
+        with database.load(bank.env()['database_folder']) as db:
+            account = account_from_config(banking_configuration.accounts[account_id])
+            access_code = database.get_account_access_code(db, account)
+            return jsonify(io.encode_object(access_code))
 
     def put(self, account_id):
         banking_configuration = bank.load_config(bank.env()['main_config_file'])
-        db = database.load(bank.env()['database_folder'])
-        code = request.get_json()['code']
+        with database.load(bank.env()['database_folder']) as db:
+            code = request.get_json()['code']
 
-        account = account_from_config(banking_configuration.accounts[account_id])
-        access_code = datatypes.AccountAccessCode(code=code, date=datetime.utcnow(), account_id=account.id)
-        database.update_account_access_code(db, account, access_code)
-        return jsonify(io.encode_object(access_code))
+            account = account_from_config(banking_configuration.accounts[account_id])
+            access_code = datatypes.AccountAccessCode(code=code, date=datetime.utcnow(), account_id=account.id)
+            database.update_account_access_code(db, account, access_code)
+            return jsonify(io.encode_object(access_code))
 
 
 class BankAccessCode(Resource):
     def get(self, bank_id):
         banking_configuration = bank.load_config(bank.env()['main_config_file'])
-        db = database.load(bank.env()['database_folder'])
-
-        bank_config = banking_configuration.banks[bank_id]
-        access_code = database.get_bank_access_code(db, bank_config)
-        return jsonify(io.encode_object(access_code))
+        with database.load(bank.env()['database_folder']) as db:
+            bank_config = banking_configuration.banks[bank_id]
+            access_code = database.get_bank_access_code(db, bank_config)
+            return jsonify(io.encode_object(access_code))
 
     def put(self, bank_id):
         banking_configuration = bank.load_config(bank.env()['main_config_file'])
-        db = database.load(bank.env()['database_folder'])
-        code = request.get_json()['code']
+        with database.load(bank.env()['database_folder']) as db:
+            code = request.get_json()['code']
 
-        bank_config = banking_configuration.banks[bank_id]
-        access_code = datatypes.BankAccessCode(code=code, date=datetime.utcnow(), bank_id=bank_config.id)
-        database.update_bank_access_code(db, bank_config, access_code)
-        return jsonify(io.encode_object(access_code))
+            bank_config = banking_configuration.banks[bank_id]
+            access_code = datatypes.BankAccessCode(code=code, date=datetime.utcnow(), bank_id=bank_config.id)
+            database.update_bank_access_code(db, bank_config, access_code)
+            return jsonify(io.encode_object(access_code))
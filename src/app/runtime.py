@@ -6,8 +6,12 @@ from flask_restful import Api as RestApi
 from . import scheduler
 from . import api
 
+import bank
+
 
 def run(banking_config):
+    # Browsers are started before the first scheduled update needs them
+    bank.start_browser_pool()
     scheduler.run(banking_config)
 
     app = Flask('banking')
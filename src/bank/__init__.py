@@ -1,4 +1,4 @@
 from .runtime import env, load_config, load_module, load_categories
 from .runtime import parse_account_transactions, parse_credit_card_transactions
 from .runtime import update_bank_account_transactions, update_bank_credit_card_transactions
-from .runtime import update_all
+from .runtime import update_all, start_browser_pool
@@ -4,14 +4,13 @@ from itertools import chain
 import re
 
 from datatypes import TransactionType, TransactionDirection, ParsedBankAccountTransaction, ParsedCreditCardTransaction
-from datatypes import Account, Bank, Card, UnknownSubject, UnknownWallet
+from datatypes import Account, Bank, Card
 from common.parsing import extract_literals, extract_keywords
 from common.utils import get_nested_item
+from bank.classification import build_type_table, bank_type_table, get_source, get_destination
 from exceptions import ParsingError
 
 
-import datatypes
-
 KEYWORD_FIELDS = [
     'conceptoMovimiento.descripcionConcepto',
     'referencias.0300.descripcion',
@@ -22,130 +21,31 @@ KEYWORD_FIELDS = [
 ]
 
 
-def get_type(transaction_code, transaction_direction):
-    """
-        Determine the transaction type, from a bank prespective
-        no
-    """
-
-    PAYCHECK = ['105']
-    TRANSFER_CODES = ['163', '203', '603', '673']
-    BANK_COMISSION_CODES = ['205', '275', '578', '751', '423']
-    RECEIPT_CODES = ['253', '257', '261']
-    MORTAGE_RECEIPT = ['255']
-    CREDIT_CARD_INVOICE = ['274', '400']
-    PURCHASE = ['800', '410', '226', '127']
-
-    if transaction_code in PAYCHECK:
-        return {
-            TransactionDirection.CHARGE: None,
-            TransactionDirection.INCOME: TransactionType.RECEIVED_TRANSFER
-        }.get(transaction_direction)
-
-    if transaction_code in BANK_COMISSION_CODES:
-        return {
-            TransactionDirection.CHARGE: TransactionType.BANK_COMISSION,
-            TransactionDirection.INCOME: TransactionType.BANK_COMISSION_RETURN
-        }.get(transaction_direction)
-
-    if transaction_code in RECEIPT_CODES:
-        return {
-            TransactionDirection.CHARGE: TransactionType.DOMICILED_RECEIPT,
-            TransactionDirection.INCOME: None
-        }.get(transaction_direction)
-
+# kind: (codes, type when it's a charge, type when it's an income)
+TRANSACTION_KINDS = {
+    'paycheck': (['105'], None, TransactionType.RECEIVED_TRANSFER),
+    'transfer': (['163', '203', '603', '673'], TransactionType.ISSUED_TRANSFER, TransactionType.RECEIVED_TRANSFER),
+    'bank_comission': (['205', '275', '578', '751', '423'], TransactionType.BANK_COMISSION, TransactionType.BANK_COMISSION_RETURN),
+    'receipt': (['253', '257', '261'], TransactionType.DOMICILED_RECEIPT, None),
     # This is indeed a special case of domicilied receipt, where the destination is the Bank itself.
-    if transaction_code in MORTAGE_RECEIPT:
-        return {
-            TransactionDirection.CHARGE: TransactionType.MORTAGE_RECEIPT,
-            TransactionDirection.INCOME: None
-        }.get(transaction_direction)
-
-    if transaction_code in CREDIT_CARD_INVOICE:
-        return {
-            TransactionDirection.CHARGE: TransactionType.CREDIT_CARD_INVOICE,
-            TransactionDirection.INCOME: TransactionType.CREDIT_CARD_INVOICE_PAYMENT
-        }.get(transaction_direction)
-
-    if transaction_code in PURCHASE:
-        return {
-            TransactionDirection.CHARGE: TransactionType.PURCHASE,
-            TransactionDirection.INCOME: TransactionType.PURCHASE_RETURN
-        }.get(transaction_direction)
-
-    if transaction_code in TRANSFER_CODES:
-        return {
-            TransactionDirection.CHARGE: TransactionType.ISSUED_TRANSFER,
-            TransactionDirection.INCOME: TransactionType.RECEIVED_TRANSFER
-        }.get(transaction_direction)
-
-    return TransactionType.UNKNOWN
-
-
-def get_source(details, transaction_type):
-
-    def safe_issuer(subject):
-        return UnknownSubject() if subject is None else datatypes.Issuer(subject)
+    'mortage_receipt': (['255'], TransactionType.MORTAGE_RECEIPT, None),
+    'credit_card_invoice': (['274', '400'], TransactionType.CREDIT_CARD_INVOICE, TransactionType.CREDIT_CARD_INVOICE_PAYMENT),
+    'purchase': (['800', '410', '226', '127'], TransactionType.PURCHASE, TransactionType.PURCHASE_RETURN),
+}
 
-    if transaction_type is TransactionType.ATM_WITHDRAWAL:
-        return details['account']
-    if transaction_type is TransactionType.ISSUED_TRANSFER:
-        return details['account']
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE:
-        return details['account']
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE_PAYMENT:
-        return details['account']
-    if transaction_type is TransactionType.DOMICILED_RECEIPT:
-        return details['account']
-    if transaction_type is TransactionType.MORTAGE_RECEIPT:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION:
-        return details['account']
-    if transaction_type is TransactionType.MORTAGE_RECEIPT:
-        return details['account']
-    if transaction_type is TransactionType.PURCHASE:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION_RETURN:
-        return details['bank']
-    if transaction_type is TransactionType.RETURN_DEPOSIT:
-        return safe_issuer(details['creditor_name'])
-    if transaction_type is TransactionType.RECEIVED_TRANSFER:
-        return safe_issuer(details['issuer_name'])
-    if transaction_type is TransactionType.PURCHASE_RETURN:
-        return safe_issuer(details['shop_name'])
+TYPE_TABLE = build_type_table(TRANSACTION_KINDS)
 
 
-def get_destination(details, transaction_type):
+def get_type(transaction_code, transaction_direction, type_table=TYPE_TABLE):
+    """
+        Determine the transaction type, from a bank prespective
+        no
+    """
+    return type_table.get((transaction_code, transaction_direction), TransactionType.UNKNOWN)
 
-    def safe_recipient(subject):
-        return UnknownSubject() if subject is None else datatypes.Recipient(subject)
 
-    if transaction_type is TransactionType.RECEIVED_TRANSFER:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION_RETURN:
-        return details['account']
-    if transaction_type is TransactionType.RETURN_DEPOSIT:
-        return details['account']
-    if transaction_type is TransactionType.PURCHASE_RETURN:
-        return details['account']
-    if transaction_type is TransactionType.ATM_WITHDRAWAL:
-        return UnknownWallet()
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE:
-        return details['bank']
-    if transaction_type is TransactionType.MORTAGE_RECEIPT:
-        return details['bank']
-    if transaction_type is TransactionType.BANK_COMISSION:
-        return details['bank']
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE_PAYMENT:
-        return details['bank']
-    if transaction_type is TransactionType.ISSUED_TRANSFER:
-        return safe_recipient(details['beneficiary'])
-    if transaction_type is TransactionType.DOMICILED_RECEIPT:
-        return safe_recipient(details['creditor_name'])
-    if transaction_type is TransactionType.PURCHASE:
-        return safe_recipient(details['shop_name'])
+def get_type_table(bank_config):
+    return bank_type_table(bank_config, TRANSACTION_KINDS, TYPE_TABLE)
 
 
 def references_by_code(transaction):
@@ -278,12 +178,12 @@ def decode_date(date, hour=None):
     return datetime(*map(int, [year, month, day, hour, minute, second]))
 
 
-def parse_account_transaction(bank_config, account_config, transaction):
+def parse_account_transaction(bank_config, account_config, transaction, type_table=None):
     amount = decode_numeric_value(transaction['importe'])
     transaction_code = transaction['codigoMovimiento']
     transaction['referencias'] = references_by_code(transaction)
     transaction_direction = TransactionDirection.CHARGE if amount < 0 else TransactionDirection.INCOME
-    transaction_type = get_type(transaction_code, transaction_direction)
+    transaction_type = get_type(transaction_code, transaction_direction, type_table or get_type_table(bank_config))
 
     details = get_account_transaction_details(transaction, transaction_type)
     details['account'] = Account.from_config(account_config)
@@ -332,7 +232,7 @@ def infer_transaction_direction(transaction_code):
     }[transaction_code]
 
 
-def parse_credit_card_transaction(bank_config, account_config, card_config, transaction):
+def parse_credit_card_transaction(bank_config, account_config, card_config, transaction, type_table=None):
 
     amount = decode_numeric_value(transaction['importeMovimiento'])
     transaction_code = transaction['claveMovimiento']
@@ -342,7 +242,7 @@ def parse_credit_card_transaction(bank_config, account_config, card_config, tran
     if transaction_direction is TransactionDirection.CHARGE:
         amount = amount * -1
 
-    transaction_type = get_type(transaction_code, transaction_direction)
+    transaction_type = get_type(transaction_code, transaction_direction, type_table or get_type_table(bank_config))
 
     details = get_card_transaction_details(transaction, transaction_type)
     details['account'] = Account.from_config(account_config)
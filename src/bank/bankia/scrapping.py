@@ -17,6 +17,9 @@ from selenium.common.exceptions import (
 
 logger = get_logger(name='scrapper')
 
+# Sites visited while scrapping, which storage is cleared before reusing the browser
+ORIGINS = ['https://www.bankia.es']
+
 
 def log(text):
     logger.debug(text)
@@ -26,6 +29,16 @@ def encode_date(dt):
     return dt.strftime('%d/%m/%Y')
 
 
+def session_expired(browser):
+    """
+        Once the session expires, the private site (under /oficina) sends us back
+        to the public one, where the login form is opened from.
+    """
+    if '/oficina/' not in browser.current_url:
+        return True
+    return bool(browser.find_elements_by_css_selector('a.fc-openLogin', timeout=2, do_raise=False))
+
+
 @retry(exceptions=(TimeoutException, WebDriverException), logger=logger)
 def login(browser, username, password):
     log('Loading BANKIA main page')
@@ -1,2 +1,2 @@
-from .scrapping import login, get_account_transactions, get_credit_card_transactions
-from .parsing import parse_account_transaction, parse_credit_card_transaction
+from .scrapping import ORIGINS, login, session_expired, get_account_transactions, get_credit_card_transactions
+from .parsing import get_type_table, parse_account_transaction, parse_credit_card_transaction
@@ -4,9 +4,10 @@ from datetime import datetime
 import re
 
 from datatypes import TransactionType, TransactionDirection, ParsedBankAccountTransaction, ParsedCreditCardTransaction
-from datatypes import Account, Bank, Card, UnknownSubject, UnknownWallet
+from datatypes import Account, Bank, Card
 from common.parsing import extract_literals, extract_keywords
 from common.utils import get_nested_item
+from bank.classification import build_type_table, bank_type_table, get_source, get_destination
 
 
 import datatypes
@@ -23,7 +24,20 @@ KEYWORD_FIELDS = [
 ]
 
 
-def get_type(transaction_code, transation_direction):
+# kind: (codes, type when it's a charge, type when it's an income)
+TRANSACTION_KINDS = {
+    'paycheck': (['0114'], None, TransactionType.RECEIVED_TRANSFER),
+    'purchase': (['0017', '00400', '0005'], TransactionType.PURCHASE, TransactionType.PURCHASE_RETURN),
+    'transfer': (['0149', '0064'], TransactionType.ISSUED_TRANSFER, TransactionType.RECEIVED_TRANSFER),
+    'withdrawal': (['0022', '00200', '0007'], TransactionType.ATM_WITHDRAWAL, None),
+    'domiciled_receipt': (['0058'], TransactionType.DOMICILED_RECEIPT, TransactionType.RETURN_DEPOSIT),
+    'credit_card_invoice': (['0060', '0070'], TransactionType.CREDIT_CARD_INVOICE, TransactionType.CREDIT_CARD_INVOICE_PAYMENT),
+}
+
+TYPE_TABLE = build_type_table(TRANSACTION_KINDS)
+
+
+def get_type(transaction_code, transation_direction, type_table=TYPE_TABLE):
     """
         ipdb> pp(dict(set([(b['id'], b['name']) for b in [a['scheme']['subCategory'] for a in raw_transactions]])))
 
@@ -44,115 +58,11 @@ def get_type(transaction_code, transation_direction):
           "00400": "COMPRA BBVA WALLET"
         }
     """
+    return type_table.get((transaction_code, transation_direction))
 
-    PAYCHECK = ['0114']
-    PURCHASE = ['0017', '00400', '0005']
-    TRANSFER = ['0149', '0064']
-    WITHDRAWAL = ['0022', '00200', '0007']
-    DOMICILED_RECEIPT = ['0058']
-    CREDIT_CARD_INVOICE = ['0060', '0070']
-
-    if transaction_code in PURCHASE:
-        return {
-            TransactionDirection.CHARGE: TransactionType.PURCHASE,
-            TransactionDirection.INCOME: TransactionType.PURCHASE_RETURN
-        }.get(transation_direction)
-
-    if transaction_code in TRANSFER:
-        return {
-            TransactionDirection.CHARGE: TransactionType.ISSUED_TRANSFER,
-            TransactionDirection.INCOME: TransactionType.RECEIVED_TRANSFER
-        }.get(transation_direction)
-
-    if transaction_code in PAYCHECK:
-        return {
-            TransactionDirection.CHARGE: None,
-            TransactionDirection.INCOME: TransactionType.RECEIVED_TRANSFER
-        }.get(transation_direction)
-
-    if transaction_code in WITHDRAWAL:
-        return {
-            TransactionDirection.CHARGE: TransactionType.ATM_WITHDRAWAL,
-            TransactionDirection.INCOME: None
-        }.get(transation_direction)
-
-    if transaction_code in DOMICILED_RECEIPT:
-        return {
-            TransactionDirection.CHARGE: TransactionType.DOMICILED_RECEIPT,
-            TransactionDirection.INCOME: TransactionType.RETURN_DEPOSIT
-        }.get(transation_direction)
-
-    if transaction_code in CREDIT_CARD_INVOICE:
-        return {
-            TransactionDirection.CHARGE: TransactionType.CREDIT_CARD_INVOICE,
-            TransactionDirection.INCOME: TransactionType.CREDIT_CARD_INVOICE_PAYMENT
-        }.get(transation_direction)
-
-
-def get_source(details, transaction_type):
-
-    def safe_issuer(subject):
-        return UnknownSubject() if subject is None else datatypes.Issuer(subject)
-
-    if transaction_type is TransactionType.ATM_WITHDRAWAL:
-        return details['account']
-    if transaction_type is TransactionType.ISSUED_TRANSFER:
-        return details['account']
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE:
-        return details['account']
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE_PAYMENT:
-        return details['account']
-    if transaction_type is TransactionType.DOMICILED_RECEIPT:
-        return details['account']
-    if transaction_type is TransactionType.MORTAGE_RECEIPT:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION:
-        return details['account']
-    if transaction_type is TransactionType.MORTAGE_RECEIPT:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION:
-        return details['account']
-    if transaction_type is TransactionType.PURCHASE:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION_RETURN:
-        return details['bank']
-    if transaction_type is TransactionType.RETURN_DEPOSIT:
-        return safe_issuer(details['creditor_name'])
-    if transaction_type is TransactionType.RECEIVED_TRANSFER:
-        return safe_issuer(details['issuer_name'])
-    if transaction_type is TransactionType.PURCHASE_RETURN:
-        return safe_issuer(details['shop_name'])
 
-
-def get_destination(details, transaction_type):
-
-    def safe_recipient(subject):
-        return UnknownSubject() if subject is None else datatypes.Recipient(subject)
-
-    if transaction_type is TransactionType.RECEIVED_TRANSFER:
-        return details['account']
-    if transaction_type is TransactionType.BANK_COMISSION_RETURN:
-        return details['account']
-    if transaction_type is TransactionType.RETURN_DEPOSIT:
-        return details['account']
-    if transaction_type is TransactionType.PURCHASE_RETURN:
-        return details['account']
-    if transaction_type is TransactionType.ATM_WITHDRAWAL:
-        return UnknownWallet()
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE:
-        return details['bank']
-    if transaction_type is TransactionType.MORTAGE_RECEIPT:
-        return details['bank']
-    if transaction_type is TransactionType.BANK_COMISSION:
-        return details['bank']
-    if transaction_type is TransactionType.CREDIT_CARD_INVOICE_PAYMENT:
-        return details['bank']
-    if transaction_type is TransactionType.ISSUED_TRANSFER:
-        return safe_recipient(details['beneficiary'])
-    if transaction_type is TransactionType.DOMICILED_RECEIPT:
-        return safe_recipient(details['creditor_name'])
-    if transaction_type is TransactionType.PURCHASE:
-        return safe_recipient(details['shop_name'])
+def get_type_table(bank_config):
+    return bank_type_table(bank_config, TRANSACTION_KINDS, TYPE_TABLE)
 
 
 def get_account_transaction_details(transaction, transaction_type):
@@ -261,7 +171,7 @@ def get_comment(details, transaction_type):
         return details['concept']
 
 
-def parse_account_transaction(bank_config, account_config, transaction):
+def parse_account_transaction(bank_config, account_config, transaction, type_table=None):
     amount = transaction['amount']['amount']
     transaction_code = get_nested_item(transaction, 'scheme.subCategory.id')
 
@@ -269,7 +179,7 @@ def parse_account_transaction(bank_config, account_config, transaction):
         transaction_code = get_nested_item(transaction, 'concept.id')
 
     transation_direction = TransactionDirection.CHARGE if amount < 0 else TransactionDirection.INCOME
-    transaction_type = get_type(transaction_code, transation_direction)
+    transaction_type = get_type(transaction_code, transation_direction, type_table or get_type_table(bank_config))
 
     details = get_account_transaction_details(transaction, transaction_type)
     details['account'] = Account.from_config(account_config)
@@ -309,7 +219,7 @@ def parse_account_transaction(bank_config, account_config, transaction):
     )
 
 
-def parse_credit_card_transaction(bank_config, account_config, card_config, transaction):
+def parse_credit_card_transaction(bank_config, account_config, card_config, transaction, type_table=None):
     amount = transaction['amount']['amount']
     transaction_code = get_nested_item(transaction, 'concept.id')
     if transaction_code == '0000':
@@ -318,7 +228,7 @@ def parse_credit_card_transaction(bank_config, account_config, card_config, tran
         transaction_code = '0005'
 
     transation_direction = TransactionDirection.CHARGE if amount < 0 else TransactionDirection.INCOME
-    transaction_type = get_type(transaction_code, transation_direction)
+    transaction_type = get_type(transaction_code, transation_direction, type_table or get_type_table(bank_config))
 
     # Transactions have a _PT or _TT termination, that changes once over time and makes id unusable
     # this is an attempt to fix this and still being able to use the id as an unique id
@@ -19,6 +19,9 @@ from selenium.common.exceptions import (
 
 SMS_TIMEOUT = 10
 
+# Sites visited while scrapping, which storage is cleared before reusing the browser
+ORIGINS = ['https://www.bbva.es', 'https://web.bbva.es']
+
 FIX_NULL_DATE_ACCOUNT = """
 try {{
   arg = JSON.parse(arguments[0]);
@@ -66,6 +69,24 @@ def encode_date(dt):
     return dt.strftime('%d/%m/%Y')
 
 
+def access_code_age(access_code):
+    return (datetime.utcnow() - access_code.date).total_seconds()
+
+
+def recent_access_code(access_code):
+    return access_code_age(access_code) < 30
+
+
+def session_expired(browser):
+    """
+        Once the session expires, the private site sends us back to the public one,
+        where the login form is opened from.
+    """
+    if not browser.current_url.startswith('https://web.bbva.es'):
+        return True
+    return bool(browser.find_elements_by_css_selector('.header__actions .header__access', timeout=2, do_raise=False))
+
+
 @retry(exceptions=(TimeoutException, WebDriverException, SMSOTPException), logger=logger)
 def login(browser, username, password):
     log('Loading BBVA main page')
@@ -95,32 +116,21 @@ def login(browser, username, password):
     code_request_input = browser.find_element_by_css_selector('input[name=otp][type=password]', visible=True, timeout=15, do_raise=False)
 
     if code_request_input:
-        received_code = None
-
-        t0 = int(time.time())
-
-        def sms_timeout():
-            return (int(time.time()) - t0) > SMS_TIMEOUT
-
-        while not received_code and not sms_timeout():
-            log('Waiting for SMS code')
-            access_code = database.get_bank_access_code(
-                database.load(env()['database_folder']),
-                load_config(env()['main_config_file']).banks['bbva']
+        log('Waiting for SMS code')
+        with database.load(env()['database_folder']) as db:
+            access_code = database.wait_for_bank_access_code(
+                db,
+                load_config(env()['main_config_file']).banks['bbva'],
+                accept=recent_access_code,
+                timeout=SMS_TIMEOUT
             )
-            if access_code is None:
-                time.sleep(0.5)
-                continue
-
-            age = (datetime.utcnow() - access_code.date).total_seconds()
-            if age < 30:
-                log('Valid SMS code arrived! {} seconds old'.format(age))
-                received_code = access_code.code
-            time.sleep(0.5)
 
-        if received_code is None:
+        if access_code is None:
             log('No recent SMS code received')
             raise SMSOTPException('No SMS received in time')
+
+        log('Valid SMS code arrived! {} seconds old'.format(access_code_age(access_code)))
+        received_code = access_code.code
         if received_code:
             log('Submitting SMS code')
             code_request_input.focus().clear().send_keys(received_code)
@@ -177,32 +187,21 @@ def get_account_transactions(browser, account_number, from_date, to_date):
     code_request_input = browser.find_element_by_css_selector('#cuentas_buscador_firma input[type=password]', visible=True, timeout=15, do_raise=False)
 
     if code_request_input:
-        received_code = None
-
-        t0 = int(time.time())
-
-        def sms_timeout():
-            return (int(time.time()) - t0) > SMS_TIMEOUT
-
-        while not received_code and not sms_timeout():
-            log('Waiting for SMS code')
-            access_code = database.get_account_access_code(
-                database.load(env()['database_folder']),
-                load_config(env()['main_config_file']).accounts[account_number]
+        log('Waiting for SMS code')
+        with database.load(env()['database_folder']) as db:
+            access_code = database.wait_for_account_access_code(
+                db,
+                load_config(env()['main_config_file']).accounts[account_number],
+                accept=recent_access_code,
+                timeout=SMS_TIMEOUT
             )
-            if access_code is None:
-                time.sleep(0.5)
-                continue
 
-            age = (datetime.utcnow() - access_code.date).total_seconds()
-            if age < 30:
-                log('Valid SMS code arrived! {} seconds old'.format(age))
-                received_code = access_code.code
-            time.sleep(0.5)
-
-        if received_code is None:
+        if access_code is None:
             log('No recent SMS code received')
             raise SMSOTPException('No SMS received in time')
+
+        log('Valid SMS code arrived! {} seconds old'.format(access_code_age(access_code)))
+        received_code = access_code.code
         if received_code:
             log('Submitting SMS code')
             code_request_input.focus().clear().send_keys(received_code)
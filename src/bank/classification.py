@@ -0,0 +1,111 @@
+from itertools import chain
+
+from datatypes import TransactionType, TransactionDirection, UnknownSubject, UnknownWallet
+
+import datatypes
+
+
+def build_type_table(transaction_kinds, extra_codes=None):
+    """
+        Maps each (code, direction) to its transaction type, from the kinds of transactions
+        of a bank, defined as:
+
+            kind: (codes, type when it's a charge, type when it's an income)
+
+        extra_codes adds more codes to some of the kinds, as {kind: codes}
+    """
+    extra_codes = extra_codes or {}
+    unknown_kinds = set(extra_codes) - set(transaction_kinds)
+    if unknown_kinds:
+        raise ValueError('Unknown transaction kinds: {}'.format(', '.join(sorted(unknown_kinds))))
+
+    table = {}
+    for kind, (codes, charge_type, income_type) in transaction_kinds.items():
+        for code in chain(codes, extra_codes.get(kind, [])):
+            table[(code, TransactionDirection.CHARGE)] = charge_type
+            table[(code, TransactionDirection.INCOME)] = income_type
+    return table
+
+
+def bank_type_table(bank_config, transaction_kinds, default_table):
+    """
+        Type table of a bank, with the extra codes of its configuration if any. Built
+        once for all the transactions parsed together, as in bank.runtime.
+    """
+    extra_codes = bank_config.transaction_codes
+    if not extra_codes:
+        return default_table
+    return build_type_table(transaction_kinds, extra_codes)
+
+
+def account(details):
+    return details['account']
+
+
+def bank(details):
+    return details['bank']
+
+
+def unknown_wallet(details):
+    return UnknownWallet()
+
+
+def issuer(fieldname):
+    def safe_issuer(details):
+        subject = details[fieldname]
+        return UnknownSubject() if subject is None else datatypes.Issuer(subject)
+    return safe_issuer
+
+
+def recipient(fieldname):
+    def safe_recipient(details):
+        subject = details[fieldname]
+        return UnknownSubject() if subject is None else datatypes.Recipient(subject)
+    return safe_recipient
+
+
+# Source and destination of each type of transaction, the same for all banks,
+# once their details are parsed. Types not found here have no source or destination.
+
+SOURCE_RESOLVERS = {
+    TransactionType.ATM_WITHDRAWAL: account,
+    TransactionType.ISSUED_TRANSFER: account,
+    TransactionType.CREDIT_CARD_INVOICE: account,
+    TransactionType.CREDIT_CARD_INVOICE_PAYMENT: account,
+    TransactionType.DOMICILED_RECEIPT: account,
+    TransactionType.MORTAGE_RECEIPT: account,
+    TransactionType.BANK_COMISSION: account,
+    TransactionType.PURCHASE: account,
+    TransactionType.BANK_COMISSION_RETURN: bank,
+    TransactionType.RETURN_DEPOSIT: issuer('creditor_name'),
+    TransactionType.RECEIVED_TRANSFER: issuer('issuer_name'),
+    TransactionType.PURCHASE_RETURN: issuer('shop_name'),
+}
+
+DESTINATION_RESOLVERS = {
+    TransactionType.RECEIVED_TRANSFER: account,
+    TransactionType.BANK_COMISSION_RETURN: account,
+    TransactionType.RETURN_DEPOSIT: account,
+    TransactionType.PURCHASE_RETURN: account,
+    TransactionType.ATM_WITHDRAWAL: unknown_wallet,
+    TransactionType.CREDIT_CARD_INVOICE: bank,
+    TransactionType.MORTAGE_RECEIPT: bank,
+    TransactionType.BANK_COMISSION: bank,
+    TransactionType.CREDIT_CARD_INVOICE_PAYMENT: bank,
+    TransactionType.ISSUED_TRANSFER: recipient('beneficiary'),
+    TransactionType.DOMICILED_RECEIPT: recipient('creditor_name'),
+    TransactionType.PURCHASE: recipient('shop_name'),
+}
+
+
+def resolve(resolvers, details, transaction_type):
+    resolver = resolvers.get(transaction_type)
+    return None if resolver is None else resolver(details)
+
+
+def get_source(details, transaction_type):
+    return resolve(SOURCE_RESOLVERS, details, transaction_type)
+
+
+def get_destination(details, transaction_type):
+    return resolve(DESTINATION_RESOLVERS, details, transaction_type)
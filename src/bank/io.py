@@ -7,7 +7,8 @@ def decode_bank(bank_config, accounts=[]):
         bank_config['name'],
         bank_config['credentials']['username'],
         bank_config['credentials']['password'],
-        accounts
+        accounts,
+        bank_config.get('transaction_codes')
     )
 
 
@@ -51,4 +52,5 @@ def decode_scheduler_configuration(scheduler_config):
     return SchedulerConfig(
         scheduler_config['scrapping_hours'],
         scheduler_config['update_timeout_seconds'],
+        scheduler_config.get('max_parallel_banks', 1),
     )
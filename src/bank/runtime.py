@@ -1,14 +1,19 @@
 import importlib
 import json
+import threading
+import time
 import traceback
 import yaml
 import os
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
 from functools import partial
 from dateutil.relativedelta import relativedelta
 
+from .sessions import BankSession
 from .io import decode_bank, decode_card, decode_account, decode_local_account, decode_notifications, decode_scheduler_configuration
 from datatypes import Configuration, Category
 from common.logging import get_logger
@@ -23,6 +28,9 @@ import exceptions
 
 logger = get_logger(name='bank')
 
+# Banks updated at the same time save their update times on the same metadata file
+_metadata_lock = threading.Lock()
+
 
 def env():
     return {
@@ -30,8 +38,11 @@ def env():
         'main_config_file': os.getenv('BANKING_CONFIG_FILE', './banking.yaml'),
         'metadata_file': os.getenv('BANKING_METADATA_FILE', './metadata.yaml'),
         'categories_file': os.getenv('BANKING_CATEGORIES_FILE', './categories.yaml'),
+        'rules_file': os.getenv('BANKING_RULES_FILE', './rules.yaml'),
         'headless_browser': parse_bool(os.getenv('BANKING_HEADLESS_BROWSER', True)),
         'close_browser': parse_bool(os.getenv('BANKING_CLOSE_BROWSER', True)),
+        'browser_pool_size': int(os.getenv('BANKING_BROWSER_POOL_SIZE', 0)),
+        'browser_pool_max_age': int(os.getenv('BANKING_BROWSER_POOL_MAX_AGE', 3600)),
         'update_accounts_on_start': parse_bool(os.getenv('BANKING_UPDATE_ACCOUNTS_ON_START', True)),
     }
 
@@ -112,7 +123,8 @@ def parse_account_transactions(bank_module, bank_config, account_config, transac
                 partial(
                     bank_module.parse_account_transaction,
                     bank_config,
-                    account_config
+                    account_config,
+                    type_table=bank_module.get_type_table(bank_config)
                 ),
                 transactions
             )
@@ -129,7 +141,8 @@ def parse_credit_card_transactions(bank_module, bank_config, account_config, cre
                     bank_module.parse_credit_card_transaction,
                     bank_config,
                     account_config,
-                    credit_card_config
+                    credit_card_config,
+                    type_table=bank_module.get_type_table(bank_config)
                 ),
                 transactions
             )
@@ -137,41 +150,122 @@ def parse_credit_card_transactions(bank_module, bank_config, account_config, cre
     )
 
 
-def scrap_bank_account_transactions(bank_module, bank_config, account_config, from_date, to_date):
-    browser = scrapper.new('./chromedriver', headless=env()['headless_browser'])
-    bank_module.login(browser, bank_config.username, bank_config.password)
-    transactions = bank_module.get_account_transactions(
-        browser,
-        account_config.id,
-        from_date,
-        to_date
-    )
+def start_browser_pool():
+    """
+        Starts the pool of browsers used by the scrappers of this process, when
+        enabled with a browser_pool_size greater than 0.
+    """
+    settings = env()
+    if settings['browser_pool_size'] > 0:
+        scrapper.start_pool(
+            settings['browser_pool_size'],
+            settings['browser_pool_max_age'],
+            './chromedriver',
+            headless=settings['headless_browser']
+        )
+
 
-    if env()['close_browser']:
+def new_browser():
+    pool = scrapper.current_pool()
+    if pool is not None:
+        return pool.acquire()
+    return scrapper.new('./chromedriver', headless=env()['headless_browser'])
+
+
+def release_browser(bank_config, browser):
+    pool = scrapper.current_pool()
+    if pool is not None:
+        pool.release(browser, origins=load_module(bank_config.id).ORIGINS)
+    elif env()['close_browser']:
         browser.close()
         browser.quit()
 
-    return transactions
 
+def login(bank_config, browser, username, password):
+    load_module(bank_config.id).login(browser, username, password)
+
+
+def session_expired(bank_config, browser):
+    return load_module(bank_config.id).session_expired(browser)
+
+
+def new_session(bank_config):
+    return BankSession(
+        bank_config,
+        partial(login, bank_config),
+        partial(session_expired, bank_config),
+        new_browser,
+        partial(release_browser, bank_config)
+    )
 
-def scrap_bank_credit_card_transactions(bank_module, bank_config, card_config, from_date, to_date):
-    browser = scrapper.new('./chromedriver', headless=env()['headless_browser'])
-    bank_module.login(browser, bank_config.username, bank_config.password)
-    transactions = bank_module.get_credit_card_transactions(
-        browser,
+
+def scrap(bank_config, session, scrap_function, *args):
+    if session is not None:
+        return session.scrap(scrap_function, *args)
+
+    with new_session(bank_config) as session:
+        return session.scrap(scrap_function, *args)
+
+
+def scrap_bank_account_transactions(bank_module, bank_config, account_config, from_date, to_date, session=None):
+    return scrap(
+        bank_config, session,
+        bank_module.get_account_transactions,
+        account_config.id,
+        from_date,
+        to_date
+    )
+
+
+def scrap_bank_credit_card_transactions(bank_module, bank_config, card_config, from_date, to_date, session=None):
+    return scrap(
+        bank_config, session,
+        bank_module.get_credit_card_transactions,
         card_config.number,
         from_date,
         to_date
     )
 
-    if env()['close_browser']:
-        browser.close()
-        browser.quit()
 
-    return transactions
+def drain(items):
+    """
+        Yields the items of a list removing them from it, so each item can be released
+        as soon as the next stages of a pipeline are done with it.
+    """
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
+def counted(counters, stage, items):
+    for item in items:
+        counters[stage] += 1
+        yield item
 
 
-def update_bank_account_transactions(db, bank_config, account_config, from_date, to_date):
+def transactions_pipeline(raw_transactions, parse_transaction, from_date, to_date, counters):
+    """
+        Chains the stages that process the scrapped transactions (parse, filter the ones
+        out of the date range and apply the rules) as generators, so only the transactions
+        being processed are kept in memory, counting on each stage how many went through.
+    """
+    fetched = counted(counters, 'fetched', drain(raw_transactions))
+    parsed = counted(counters, 'parsed', filter(bool, map(parse_transaction, fetched)))
+    in_range = counted(counters, 'in_range', filter(
+        lambda transaction: transaction.transaction_date >= from_date and transaction.transaction_date <= to_date,
+        parsed
+    ))
+    return counted(counters, 'processed', rules.apply_iter(rules.load(), in_range))
+
+
+def log_pipeline_counters(counters):
+    discarded_transactions_count = counters['parsed'] - counters['in_range']
+    filtered_info = ' ({} out of date range got filtered)'.format(discarded_transactions_count) if discarded_transactions_count > 0 else ''
+    logger.info('{} transactions parsed{}'.format(counters['parsed'], filtered_info))
+    logger.info('Rules applied to {} transactions'.format(counters['processed']))
+
+
+def update_bank_account_transactions(db, bank_config, account_config, from_date, to_date, session=None):
     logger.info('Updating {bank.name} account {account.id} transactions from {from_date} to {to_date}'.format(
         bank=bank_config,
         account=account_config,
@@ -181,32 +275,31 @@ def update_bank_account_transactions(db, bank_config, account_config, from_date,
 
     bank_module = load_module(bank_config.id)
 
-    raw_transactions = scrap_bank_account_transactions(bank_module, bank_config, account_config, from_date, to_date)
+    raw_transactions = scrap_bank_account_transactions(bank_module, bank_config, account_config, from_date, to_date, session)
     logger.info('{} transactions fetched'.format(len(raw_transactions)))
 
-    parsed_transactions = parse_account_transactions(bank_module, bank_config, account_config, raw_transactions)
-    filtered_transactions = list(filter(
-        lambda transaction: transaction.transaction_date >= from_date and transaction.transaction_date <= to_date,
-        parsed_transactions
-    ))
-    discarded_transactions_count = len(parsed_transactions) - len(filtered_transactions)
-    filtered_info = ' ({} out of date range got filtered)'.format(discarded_transactions_count) if discarded_transactions_count > 0 else ''
-    logger.info('{} transactions parsed{}'.format(len(parsed_transactions), filtered_info))
+    counters = Counter()
+    processed_transactions = transactions_pipeline(
+        raw_transactions,
+        partial(bank_module.parse_account_transaction, bank_config, account_config, type_table=bank_module.get_type_table(bank_config)),
+        from_date, to_date, counters
+    )
 
-    processed_transactions = rules.apply(rules.load(), filtered_transactions)
-    logger.info('Rules applied to {} transactions'.format(len(processed_transactions)))
+    # The database diff needs the whole window of fetched transactions at once
+    processed_transactions = list(processed_transactions)
+    log_pipeline_counters(counters)
 
     removed, added, _ = database.update_account_transactions(db, account_config.id, processed_transactions)
     if added:
         logger.info('Successfully added {} account transactions to the database.'.format(added))
     else:
-        logger.info('There are no new account transactions to add'.format(len(raw_transactions)))
+        logger.info('There are no new account transactions to add')
     if removed:
         logger.info('Successfully removed {} transactions from the database'.format(removed))
     return (removed, added)
 
 
-def update_bank_credit_card_transactions(db, bank_config, account_config, card_config, from_date, to_date):
+def update_bank_credit_card_transactions(db, bank_config, account_config, card_config, from_date, to_date, session=None):
     logger.info('Updating {bank.name} card {card.number} transactions from {from_date} to {to_date}'.format(
         bank=bank_config,
         card=card_config,
@@ -216,26 +309,25 @@ def update_bank_credit_card_transactions(db, bank_config, account_config, card_c
 
     bank_module = load_module(bank_config.id)
 
-    raw_transactions = scrap_bank_credit_card_transactions(bank_module, bank_config, card_config, from_date, to_date)
+    raw_transactions = scrap_bank_credit_card_transactions(bank_module, bank_config, card_config, from_date, to_date, session)
     logger.info('{} transactions fetched'.format(len(raw_transactions)))
 
-    parsed_transactions = parse_credit_card_transactions(bank_module, bank_config, account_config, card_config, raw_transactions)
-    filtered_transactions = list(filter(
-        lambda transaction: transaction.transaction_date >= from_date and transaction.transaction_date <= to_date,
-        parsed_transactions
-    ))
-    discarded_transactions_count = len(parsed_transactions) - len(filtered_transactions)
-    filtered_info = ' ({} out of date range got filtered)'.format(discarded_transactions_count) if discarded_transactions_count > 0 else ''
-    logger.info('{} transactions parsed{}'.format(len(parsed_transactions), filtered_info))
+    counters = Counter()
+    processed_transactions = transactions_pipeline(
+        raw_transactions,
+        partial(bank_module.parse_credit_card_transaction, bank_config, account_config, card_config, type_table=bank_module.get_type_table(bank_config)),
+        from_date, to_date, counters
+    )
 
-    processed_transactions = rules.apply(rules.load(), filtered_transactions)
-    logger.info('Rules applied to {} transactions'.format(len(processed_transactions)))
+    # The database diff needs the whole window of fetched transactions at once
+    processed_transactions = list(processed_transactions)
+    log_pipeline_counters(counters)
 
     removed, added, _ = database.update_credit_card_transactions(db, card_config.number, processed_transactions)
     if added:
         logger.info('Successfully added {} credit card transactions to the database.'.format(added))
     else:
-        logger.info('There are no new card transactions to add'.format(len(raw_transactions)))
+        logger.info('There are no new card transactions to add')
     if removed:
         logger.info('Successfully removed {} transactions from the database'.format(removed))
     return (removed, added)
@@ -260,8 +352,11 @@ def get_metadata(metadata_filename):
 
 
 def save_metadata(metadata_filename, metadata):
-    with open(metadata_filename, 'w') as metadata_file:
+    # Written aside and moved over the old file, so it's never read half written
+    temporary_filename = '{}.tmp'.format(metadata_filename)
+    with open(temporary_filename, 'w') as metadata_file:
         yaml.dump(metadata, metadata_file)
+    os.replace(temporary_filename, metadata_filename)
 
 
 def get_last_update_time(metadata, bank, account_type, identifier):
@@ -277,19 +372,58 @@ def set_last_update_time(metadata, bank, account_type, identifier, date):
     return _metadata
 
 
+class UpdateResults():
+    """
+        Success and failure messages of an update, collected from all the banks
+        being updated at the same time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.success = []
+        self.failure = []
+
+    def add_success(self, message):
+        with self.lock:
+            self.success.append(message)
+
+    def add_failure(self, message):
+        with self.lock:
+            self.failure.append(message)
+
+
+def query_from_date(last_transaction_date):
+    if last_transaction_date is None:
+        # Query from beginning of previous year
+        return datetime.now() + relativedelta(month=1, day=1, years=-1, minute=0, hour=0, second=0, microsecond=0)
+    # Query from beginning of previous day
+    return last_transaction_date - relativedelta(days=1, minute=0, hour=0, second=0, microsecond=0)
+
+
+def bank_credit_cards(banking_config, bank):
+    return [
+        card for card in banking_config.cards.values()
+        if card.type == 'credit' and card.active and card.account_number in bank.accounts
+    ]
+
+
 def update_all(banking_config, env):
-    success = []
-    failure = []
+    """
+        Updates the transactions of all the accounts and active credit cards. Each bank
+        is updated on its own worker, up to max_parallel_banks at the same time, while
+        the accounts and cards of the same bank are always updated one after the other,
+        as they share the login and access codes.
+    """
+    results = UpdateResults()
 
-    db = database.load(env['database_folder'])
     metadata_file = env['metadata_file']
     min_updated_elapsed = banking_config.scheduler.update_timeout_seconds
+    max_parallel_banks = max(1, banking_config.scheduler.max_parallel_banks or 1)
 
     def already_updated(bank_id, account_type, account_number):
-        last_update = get_last_update_time(
-            get_metadata(metadata_file),
-            bank_id, account_type, account_number
-        )
+        with _metadata_lock:
+            metadata = get_metadata(metadata_file)
+        last_update = get_last_update_time(metadata, bank_id, account_type, account_number)
         if last_update is None:
             return False
 
@@ -307,115 +441,133 @@ def update_all(banking_config, env):
             return False
 
     def update_last_update_time(bank_id, account_type, account_number):
-        save_metadata(
-            metadata_file,
-            set_last_update_time(get_metadata(metadata_file), bank_id, account_type, account_number, datetime.utcnow())
-        )
+        # Workers of other banks may be saving their update time too
+        with _metadata_lock:
+            save_metadata(
+                metadata_file,
+                set_last_update_time(get_metadata(metadata_file), bank_id, account_type, account_number, datetime.utcnow())
+            )
 
-    for bank_id, bank in banking_config.banks.items():
-        for account_number, account in bank.accounts.items():
-
-            if already_updated(bank_id, 'account', account_number):
-                continue
-
-            try:
-                last_transaction_date = database.last_account_transaction_date(db, account.id)
-                if last_transaction_date is None:
-                    # Query from beginning of previous year
-                    from_date = datetime.now() + relativedelta(month=1, day=1, years=-1, minute=0, hour=0, second=0, microsecond=0)
-                else:
-                    # Query from beginning of previous day
-                    from_date = last_transaction_date - relativedelta(days=1, minute=0, hour=0, second=0, microsecond=0)
-
-                # Query until current day and hour
-                to_date = datetime.now()
-                removed, added = update_bank_account_transactions(db, bank, account, from_date, to_date)
-
-                if added:
-                    success.append('Added {added} new transactions for *{bank.name}* account *{account.id}*'.format(
-                        bank=bank,
-                        account=account,
-                        added=added
-                    ))
-                if added:
-                    success.append('Removed {removed} transactions for *{bank.name}* account *{account.id}*'.format(
-                        bank=bank,
-                        account=account,
-                        removed=removed
-                    ))
-
-                update_last_update_time(bank_id, 'account', account_number)
-
-            except database.DivergedHistoryError as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=exc.message))
-                logger.error(exc.message)
-            except database.DatabaseError as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=str(exc)))
-                logger.error(str(exc))
-            except (exceptions.SomethingChangedError, exceptions.InteractionError) as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=str(exc.message)))
-                logger.error(exc.message)
-            except Exception as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=traceback.format_exc()))
-                logger.error(traceback_summary(traceback.format_exc(), exc))
-
-    for card_number, card in banking_config.cards.items():
-        if card.type == 'credit' and card.active:
-
-            if already_updated(banking_config.accounts[card.account_number].bank_id, 'card', card_number):
-                continue
-
-            try:
-                last_transaction_date = database.last_credit_card_transaction_date(db, card.number)
-                if last_transaction_date is None:
-                    # Query from beginning of current year
-                    from_date = datetime.now() + relativedelta(month=1, day=1, years=-1, minute=0, hour=0, second=0, microsecond=0)
-                else:
-                    # Query from beginning of previous day
-                    from_date = last_transaction_date - relativedelta(days=1, minute=0, hour=0, second=0, microsecond=0)
-
-                # Query until current day
-                to_date = datetime.now()
-
-                card_account = banking_config.accounts[card.account_number]
-                card_bank = banking_config.banks[card_account.bank_id]
-                removed, added = update_bank_credit_card_transactions(db, card_bank, card_account, card, from_date, to_date)
-
-                if added:
-                    success.append('Added {added} new transactions for *{bank.name}* card *{card.number}*'.format(
-                        bank=card_bank,
-                        card=card,
-                        added=added
-                    ))
-                if removed:
-                    success.append('Removed {removed} transactions for *{bank.name}* card *{card.number}*'.format(
-                        bank=card_bank,
-                        card=card,
-                        removed=removed
-                    ))
-
-                update_last_update_time(banking_config.accounts[card.account_number].bank_id, 'card', card_number)
-
-            except database.DivergedHistoryError as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=exc.message))
-                logger.error(exc.message)
-            except database.DatabaseError as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=str(exc)))
-                logger.error(str(exc))
-            except (exceptions.SomethingChangedError, exceptions.InteractionError) as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=str(exc.message)))
-                logger.error(exc.message)
-            except (exceptions.ParsingError) as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=str(exc)))
-                logger.error(exc.message)
-            except Exception as exc:
-                failure.append(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=traceback.format_exc()))
-                logger.error(traceback_summary(traceback.format_exc(), exc))
+    def update_account(db, session, bank, account):
+        try:
+            from_date = query_from_date(database.last_account_transaction_date(db, account.id))
+
+            # Query until current day and hour
+            to_date = datetime.now()
+            removed, added = update_bank_account_transactions(db, bank, account, from_date, to_date, session)
+
+            if added:
+                results.add_success('Added {added} new transactions for *{bank.name}* account *{account.id}*'.format(
+                    bank=bank,
+                    account=account,
+                    added=added
+                ))
+            if removed:
+                results.add_success('Removed {removed} transactions for *{bank.name}* account *{account.id}*'.format(
+                    bank=bank,
+                    account=account,
+                    removed=removed
+                ))
+
+            update_last_update_time(bank.id, 'account', account.id)
+
+        except database.DivergedHistoryError as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=exc.message))
+            logger.error(exc.message)
+        except database.DatabaseError as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=str(exc)))
+            logger.error(str(exc))
+        except (exceptions.SomethingChangedError, exceptions.InteractionError) as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=str(exc.message)))
+            logger.error(exc.message)
+        except Exception as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=bank, source='account', id=account.id, message=traceback.format_exc()))
+            logger.error(traceback_summary(traceback.format_exc(), exc))
+
+    def update_card(db, session, card_bank, card):
+        try:
+            from_date = query_from_date(database.last_credit_card_transaction_date(db, card.number))
+
+            # Query until current day
+            to_date = datetime.now()
+
+            card_account = banking_config.accounts[card.account_number]
+            removed, added = update_bank_credit_card_transactions(db, card_bank, card_account, card, from_date, to_date, session)
+
+            if added:
+                results.add_success('Added {added} new transactions for *{bank.name}* card *{card.number}*'.format(
+                    bank=card_bank,
+                    card=card,
+                    added=added
+                ))
+            if removed:
+                results.add_success('Removed {removed} transactions for *{bank.name}* card *{card.number}*'.format(
+                    bank=card_bank,
+                    card=card,
+                    removed=removed
+                ))
+
+            update_last_update_time(card_bank.id, 'card', card.number)
+
+        except database.DivergedHistoryError as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=exc.message))
+            logger.error(exc.message)
+        except database.DatabaseError as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=str(exc)))
+            logger.error(str(exc))
+        except (exceptions.SomethingChangedError, exceptions.InteractionError) as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=str(exc.message)))
+            logger.error(exc.message)
+        except (exceptions.ParsingError) as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=str(exc)))
+            logger.error(exc.message)
+        except Exception as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=card_bank, source='card', id=card.number, message=traceback.format_exc()))
+            logger.error(traceback_summary(traceback.format_exc(), exc))
+
+    def timed_update(update, bank, source, identifier, *args):
+        start = time.perf_counter()
+        update(*args)
+        logger.info('Finished update of {bank.name} {source} {identifier} in {elapsed:.1f}s'.format(
+            bank=bank, source=source, identifier=identifier, elapsed=time.perf_counter() - start
+        ))
+
+    def update_bank(bank):
+        # Each worker uses its own connection, as they can't be shared between threads,
+        # and all the accounts and cards of the bank are scrapped with the same login
+        with database.load(env['database_folder']) as db, new_session(bank) as session:
+            for account_number, account in bank.accounts.items():
+                if already_updated(bank.id, 'account', account_number):
+                    continue
+                timed_update(update_account, bank, 'account', account.id, db, session, bank, account)
+
+            for card in bank_credit_cards(banking_config, bank):
+                if already_updated(bank.id, 'card', card.number):
+                    continue
+                timed_update(update_card, bank, 'card', card.number, db, session, bank, card)
+
+    def safe_update_bank(bank):
+        # A failure outside the accounts and cards updates (as opening the database)
+        # is reported for the bank, without stopping the update of the other banks
+        try:
+            update_bank(bank)
+        except Exception as exc:
+            results.add_failure(EXCEPTION_MESSAGE.format(bank=bank, source='bank', id=bank.id, message=traceback.format_exc()))
+            logger.error(traceback_summary(traceback.format_exc(), exc))
+
+    banks = list(banking_config.banks.values())
+    if max_parallel_banks == 1:
+        for bank in banks:
+            safe_update_bank(bank)
+    else:
+        with ThreadPoolExecutor(max_workers=max_parallel_banks, thread_name_prefix='update') as executor:
+            for future in [executor.submit(safe_update_bank, bank) for bank in banks]:
+                future.result()
 
     notifier = get_notifier(banking_config.notifications)
 
-    for item in success:
+    for item in results.success:
         notifier(item)
 
-    for item in failure:
+    for item in results.failure:
         notifier(item)
@@ -0,0 +1,86 @@
+from selenium.common.exceptions import WebDriverException
+
+from common.logging import get_logger
+
+logger = get_logger(name='bank')
+
+# Loaded before reusing a browser, so the next page is loaded from scratch
+BLANK_PAGE = 'about:blank'
+
+
+class BankSession():
+    """
+        Browser logged in a bank, shared by the scrapping of all the accounts and cards
+        of the bank during an update, so the browser is started and the login (and its
+        access code, if any) done only once. The browser starts on the first scrapping.
+
+        If a scrapping fails on a session that was already used, and session_expired
+        tells the bank logged us out, the scrapping is tried once more after a new
+        login. Any other error is raised as is.
+    """
+
+    def __init__(self, bank_config, login, session_expired, new_browser, release_browser):
+        self.bank_config = bank_config
+        self.login_function = login
+        self.session_expired = session_expired
+        self.new_browser = new_browser
+        self.release_browser = release_browser
+        self.browser = None
+        self.logins = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def login(self):
+        # The browser is only kept once logged in, so a failed login is tried again
+        # on the next scrapping of the bank
+        self.browser = self.new_browser()
+        try:
+            self.login_function(self.browser, self.bank_config.username, self.bank_config.password)
+        except Exception:
+            self.close()
+            raise
+        self.logins += 1
+        return self.browser
+
+    def expired(self, browser):
+        try:
+            return self.session_expired(browser)
+        except Exception:
+            # A browser that can't tell is not the reason of the failure
+            return False
+
+    def scrap(self, scrap_function, *args):
+        """
+            Runs scrap_function(browser, *args) on the logged in browser
+        """
+        if self.browser is None:
+            return scrap_function(self.login(), *args)
+
+        browser = self.browser
+        try:
+            # Scrappers patch the page they load to intercept its requests, and as the
+            # pages of a bank app may only differ on the url fragment, loading one after
+            # another would keep the patches (and results) of the previous scrapping
+            browser.get(BLANK_PAGE)
+            return scrap_function(browser, *args)
+        except Exception:
+            if not self.expired(browser):
+                raise
+            logger.warning('{bank.name} session expired, login again'.format(bank=self.bank_config))
+
+        self.close()
+        return scrap_function(self.login(), *args)
+
+    def close(self):
+        browser, self.browser = self.browser, None
+        if browser is None:
+            return
+        try:
+            self.release_browser(browser)
+        except WebDriverException:
+            # The browser may be already gone
+            pass
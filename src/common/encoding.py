@@ -0,0 +1,97 @@
+from dataclasses import fields, is_dataclass
+from datetime import datetime
+from enum import Enum
+
+
+def encode_date(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+class ObjectEncoder():
+    """
+        Encodes domain objects into new plain dicts and lists, never touching the
+        encoded objects. How dataclasses, enums and datetimes are represented
+        depends on the output format, defined by:
+
+            dataclass_type: returns the __type__ of a dataclass, None to not include it
+            encode_enum: returns the representation of an enum member
+            encode_datetime: returns the representation of a datetime, None to leave them as they are
+
+        The encoder for each class is built the first time an object of that class
+        is found, so the dataclass fields and the checks on the class are done once.
+    """
+
+    def __init__(self, dataclass_type, encode_enum, encode_datetime=None):
+        self.dataclass_type = dataclass_type
+        self.encode_enum = encode_enum
+        self.encode_datetime = encode_datetime
+        self.encoders = {}
+
+    def encode(self, obj):
+        try:
+            encoder = self.encoders[obj.__class__]
+        except KeyError:
+            encoder = self.encoders[obj.__class__] = self.build_encoder(obj.__class__)
+        return encoder(obj)
+
+    def build_encoder(self, cls):
+        if is_dataclass(cls):
+            return self.build_dataclass_encoder(cls)
+        elif issubclass(cls, Enum):
+            return self.encode_enum
+        elif issubclass(cls, datetime) and self.encode_datetime is not None:
+            return self.encode_datetime
+        elif issubclass(cls, dict):
+            return self.encode_dict
+        elif issubclass(cls, list):
+            return self.encode_list
+        else:
+            return unchanged
+
+    def build_dataclass_encoder(self, cls):
+        encode = self.encode
+        field_names = [field.name for field in fields(cls)]
+        type_name = self.dataclass_type(cls)
+
+        def encode_dataclass(obj):
+            encoded = {}
+            for name in field_names:
+                encoded[name] = encode(getattr(obj, name))
+            if type_name is not None:
+                encoded['__type__'] = type_name
+            return encoded
+
+        return encode_dataclass
+
+    def encode_dict(self, obj):
+        encode = self.encode
+        return {key: encode(value) for key, value in obj.items()}
+
+    def encode_list(self, obj):
+        encode = self.encode
+        return [encode(item) for item in obj]
+
+
+def unchanged(obj):
+    return obj
+
+
+# Stored documents, decoded back by database.io.decode_object
+DATABASE = ObjectEncoder(
+    dataclass_type=lambda cls: 'dataclass::{}'.format(cls.__name__),
+    encode_enum=lambda obj: {'__type__': 'enum::{}'.format(obj.__class__.__name__), 'name': obj.name},
+    encode_datetime=lambda obj: {'__type__': 'datetime', 'date': encode_date(obj)}
+)
+
+# REST API responses
+API = ObjectEncoder(
+    dataclass_type=lambda cls: None,
+    encode_enum=lambda obj: {'__type__': 'enum::{}'.format(obj.__class__.__name__), 'name': obj.name},
+    encode_datetime=encode_date
+)
+
+# JSON dumps, decoded back by common.utils.AutoJSONDecoder
+JSON = ObjectEncoder(
+    dataclass_type=lambda cls: cls.__name__,
+    encode_enum=lambda obj: {'name': obj.name, '__type__': obj.__class__.__name__}
+)
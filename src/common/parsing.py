@@ -1,5 +1,5 @@
 from common.utils import get_nested_item
-from functools import partial
+from functools import lru_cache, partial
 from itertools import chain
 
 
@@ -17,6 +17,9 @@ def parse_bool(b):
 
 
 def normalize(text):
+    if isinstance(text, str) and text.isascii():
+        # Already decomposed, nothing to strip
+        return text.upper()
     normalized = (
         unicodedata.normalize('NFKD', text)
         .encode('ASCII', errors='ignore')
@@ -26,27 +29,52 @@ def normalize(text):
     return normalized
 
 
+# Translates normalized (ASCII) text, removing dots and replacing any
+# character other than letters, digits and spaces by a space
+CLEANUP_TABLE = str.maketrans({
+    chr(code): None if chr(code) == '.' else (chr(code) if re.match(r'[A-Z0-9 ]', chr(code)) else ' ')
+    for code in range(128)
+})
+
+
 def cleanup(text):
-    character_replacement = re.sub(r'\.', '', text)
-    character_cleanup = re.sub(r'[^A-Z0-9 ]', ' ', character_replacement)
-    dup_space_cleanup = re.sub(r' +', ' ', character_cleanup)
-    return dup_space_cleanup
+    return text.translate(CLEANUP_TABLE)
 
 
 def tokenize(text):
-    return text.split(' ')
+    """
+        Words of a cleaned up text, as split by single spaces once repeated spaces are
+        collapsed, so a leading or trailing space gives an empty word.
+    """
+    words = [word for word in text.split(' ') if word]
+    if text.startswith(' ') or not text:
+        words.insert(0, '')
+    if text.endswith(' '):
+        words.append('')
+    return words
+
+
+@lru_cache(maxsize=65536)
+def literal_tokens(literal):
+    return tuple(tokenize(cleanup(normalize(literal))))
 
 
 def extract_keywords(literals):
     valid_literals = filter(lambda literal: literal is not None, literals)
-    normalized_literals = map(normalize, valid_literals)
-    clean_literals = map(cleanup, normalized_literals)
-    tokenized = map(tokenize, clean_literals)
+    tokenized = map(literal_tokens, valid_literals)
     unique_keywords = set(chain.from_iterable(tokenized))
     filter_single_chars = filter(lambda token: len(token) > 2, unique_keywords)
     return list(filter_single_chars)
 
 
+def extract_keywords_batch(literals_lists):
+    """
+        Keywords of each list of literals. Literals found again, as the names of the
+        same shops or the same concepts over the years, are only tokenized once.
+    """
+    return [extract_keywords(literals) for literals in literals_lists]
+
+
 def extract_literals(movement, field_list):
     literals = map(
         partial(get_nested_item, movement),
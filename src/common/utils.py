@@ -1,9 +1,11 @@
-from functools import reduce
+from functools import lru_cache
+from operator import itemgetter
 import re
 from dataclasses import is_dataclass
 from enum import Enum, EnumMeta
 from json import JSONEncoder, JSONDecoder
 import datatypes
+from common import encoding
 import time
 import traceback
 from functools import wraps
@@ -14,34 +16,70 @@ def parse_bool(value):
     return str(value).upper() in ('1', 'TRUE')
 
 
-def get_nested_item(dictionary, xpath, default=None):
+INDEX_SEGMENT = re.compile(r'\[(\d+)\]')
+
+# Whether instances of each class can be subscripted, the rest only have attributes
+_subscriptable = {}
+
 
-    def getitem(d, key):
-        match = re.match(r'\[(\d+)\]', key)
-        if match:
-            index = int(match.groups()[0])
-            return d[index]
-        else:
+def subscriptable(cls):
+    try:
+        return _subscriptable[cls]
+    except KeyError:
+        # Classes themselves may be subscripted through __class_getitem__
+        _subscriptable[cls] = hasattr(cls, '__getitem__') or issubclass(cls, type)
+        return _subscriptable[cls]
+
+
+def segment_getter(key):
+    match = INDEX_SEGMENT.match(key)
+    if match:
+        return itemgetter(int(match.groups()[0]))
+
+    def get_item_or_attribute(obj):
+        if type(obj) is dict and key in obj:
+            return obj[key]
+        if subscriptable(type(obj)):
             try:
-                return d[key]
+                return obj[key]
             except (KeyError, TypeError):
-                try:
-                    return getattr(d, key)
-                except AttributeError:
-                    return None
-                except Exception:
-                    return None
+                pass
             except Exception:
                 return None
+        try:
+            return getattr(obj, key)
+        except Exception:
+            return None
+
+    return get_item_or_attribute
+
+
+@lru_cache(maxsize=1024)
+def compile_path(xpath):
+    """
+        Returns a function that gets the item on the xpath, like get_nested_item does,
+        with the xpath parsed once.
+    """
+    getters = [segment_getter(key) for key in xpath.split('.')]
+
+    def get_path(obj, default=None):
+        try:
+            for getter in getters:
+                obj = getter(obj)
+            return obj
+        except (TypeError, IndexError, AttributeError):
+            # in case we do a xxx.[0].fsdf and the aray is not there
+            return default
+
+    return get_path
+
+
+def get_nested_item(dictionary, xpath, default=None):
     try:
-        return reduce(getitem, xpath.split('.'), dictionary)
-    except TypeError:
-        return default
-    except IndexError:
-        # in case we do a xxx.[0].fsdf and the aray is not there
-        return default
-    except AttributeError:
+        get_path = compile_path(xpath)
+    except (TypeError, AttributeError):
         return default
+    return get_path(dictionary, default)
 
 
 class AutoJSONDecoder(JSONDecoder):
@@ -68,16 +106,8 @@ class AutoJSONDecoder(JSONDecoder):
 class AutoJSONEncoder(JSONEncoder):
     def default(self, obj):
 
-        if isinstance(obj, Enum):
-            return {
-                'name': obj.name,
-                '__type__': obj.__class__.__name__
-            }
-
-        if is_dataclass(obj):
-            raw_dictionary = obj.__dict__
-            raw_dictionary['__type__'] = obj.__class__.__name__
-            return raw_dictionary
+        if isinstance(obj, Enum) or is_dataclass(obj):
+            return encoding.JSON.encode(obj)
 
         return JSONEncoder.default(self, obj)
 
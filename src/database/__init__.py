@@ -1,11 +1,14 @@
 from .runtime import (
-    load,
-    update_transaction,
+    load, migrate,
+    update_transaction, update_transactions_bulk,
     update_account_transactions, update_credit_card_transactions,
     last_account_transaction_date, last_credit_card_transaction_date,
+    get_account_transactions_summary, get_credit_card_transactions_summary,
     find_transactions, insert_transaction, get_account_balance, remove_transactions,
     get_account_access_code, update_account_access_code,
-    get_bank_access_code, update_bank_access_code
+    get_bank_access_code, update_bank_access_code,
+    wait_for_account_access_code, wait_for_bank_access_code,
+    find_rulesets, save_ruleset
 )
 from .io import DatabaseError, DivergedHistoryError
 from .domain import SortDirection
@@ -0,0 +1,86 @@
+from dataclasses import replace
+
+import os
+import threading
+import time
+import weakref
+
+# Codes stored by other processes are only noticed when checking the storage, so
+# waiting threads check it at least this often (in seconds)
+POLL_INTERVAL = 1.0
+
+# Stores are shared by all the connections to the same database, as the api handlers
+# that receive the codes and the scrapper threads that wait for them open their own
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class AccessCodeStore():
+    """
+        Latest access code of each bank and account. Codes are replaced atomically,
+        on the database and on memory, and every replacement wakes up the threads
+        waiting for a code.
+
+        Codes are read again from the database when the storage version seen by
+        the connection (see storage_version) changed since it last read them, as
+        they may have been stored by another process.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.codes = {}
+        self.read_versions = weakref.WeakKeyDictionary()
+
+    def get(self, db, collection_name, key_field, key, decode):
+        with self.condition:
+            read_versions = self.read_versions.setdefault(db, {})
+            current_version = storage_version(db)
+            if (collection_name, key) not in self.codes or read_versions.get((collection_name, key)) != current_version:
+                results = list(getattr(db, collection_name).find({key_field: key}))
+                self.codes[(collection_name, key)] = decode(results[0]) if results else None
+                read_versions[(collection_name, key)] = current_version
+            return self.codes[(collection_name, key)]
+
+    def replace(self, db, collection_name, key_field, key, document, access_code):
+        with self.condition:
+            collection = getattr(db, collection_name)
+            collection.remove({key_field: key})
+            result = collection.insert_one(document)
+            self.codes[(collection_name, key)] = replace(access_code, _id=result.inserted_id)
+            self.condition.notify_all()
+            return result
+
+    def wait(self, db, collection_name, key_field, key, decode, accept, timeout):
+        """
+            Blocks until the code stored for key is accepted, or the timeout expires
+            (returning None). Each replacement wakes up the waiting threads, so a new
+            code is seen as soon as it's stored, and codes stored by other processes
+            are seen on the next check of the storage.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                access_code = self.get(db, collection_name, key_field, key, decode)
+                if access_code is not None and accept(access_code):
+                    return access_code
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(min(remaining, POLL_INTERVAL))
+
+
+def storage_version(db):
+    """
+        Changes whenever the database is written by someone else than the connection
+        (or, for tinymongo, the process) that reads it.
+    """
+    # Checked on the class, as unknown attributes of a database are its collections
+    if hasattr(type(db), 'data_version'):
+        return db.data_version()
+    return db.database_file.refresh()
+
+
+def store(db):
+    with _stores_lock:
+        return _stores.setdefault(os.path.abspath(db.filename), AccessCodeStore())
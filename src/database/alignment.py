@@ -0,0 +1,114 @@
+from difflib import Differ, SequenceMatcher
+
+
+def key_line(key):
+    """
+        String form of a transaction key, as used by the original difflib based comparison.
+        Keys are compared by this form, so values that are equal but have a different
+        repr (as 1 and 1.0) are still different keys.
+    """
+    return ' '.join(map(repr, key))
+
+
+def unique_ordered_pairs(db_keys, fetched_keys):
+    """
+        Pairs the positions of the keys present on both sequences using a hash join.
+
+        Returns None when any sequence has duplicated keys or the shared keys are not
+        in the same relative order on both sides. Otherwise the pairs are exactly the
+        matches SequenceMatcher would find, as every shared key gets matched.
+    """
+    fetched_positions = {}
+    for position, key in enumerate(fetched_keys):
+        if key in fetched_positions:
+            return None
+        fetched_positions[key] = position
+
+    seen = set()
+    pairs = []
+    last_fetched_position = -1
+    for db_position, key in enumerate(db_keys):
+        if key in seen:
+            return None
+        seen.add(key)
+
+        fetched_position = fetched_positions.get(key)
+        if fetched_position is None:
+            continue
+        if fetched_position < last_fetched_position:
+            return None
+
+        pairs.append((db_position, fetched_position))
+        last_fetched_position = fetched_position
+
+    return pairs
+
+
+def pairs_opcodes(pairs, db_length, fetched_length):
+    """
+        Same output format as SequenceMatcher.get_opcodes, built from the matching pairs.
+    """
+    db_position = fetched_position = 0
+
+    for db_match, fetched_match in pairs + [(db_length, fetched_length)]:
+        if db_position < db_match and fetched_position < fetched_match:
+            yield ('replace', db_position, db_match, fetched_position, fetched_match)
+        elif db_position < db_match:
+            yield ('delete', db_position, db_match, fetched_position, fetched_position)
+        elif fetched_position < fetched_match:
+            yield ('insert', db_position, db_position, fetched_position, fetched_match)
+
+        if db_match < db_length:
+            yield ('equal', db_match, db_match + 1, fetched_match, fetched_match + 1)
+
+        db_position, fetched_position = db_match + 1, fetched_match + 1
+
+
+def differ_compare(db_keys, fetched_keys):
+    """
+        Filtered output of difflib.Differ().compare over the keys, as (action, key) items
+    """
+    for line in Differ().compare(db_keys, fetched_keys):
+        if line[0] != '?':
+            yield (line[0], line[2:])
+
+
+def diff(db_keys, fetched_keys):
+    """
+        Aligns the stored and the fetched transaction keys (their key_line string forms),
+        yielding (action, key) items with the same actions and order as the filtered
+        output of difflib.Differ().compare over them:
+
+            ' ' the key is on both sequences
+            '-' the key is only on the stored sequence
+            '+' the key is only on the fetched sequence
+
+        Unique keys sharing the same order (the usual case) are aligned in linear time,
+        other cases fall back to SequenceMatcher. Differ pairs up similar lines on replaced
+        blocks, so the order of their removed and added keys depends on their text. These
+        blocks only exist when the history has diverged, and then the keys are compared
+        by Differ itself.
+    """
+    db_keys = list(db_keys)
+    fetched_keys = list(fetched_keys)
+
+    pairs = unique_ordered_pairs(db_keys, fetched_keys)
+    if pairs is None:
+        opcodes = SequenceMatcher(None, db_keys, fetched_keys).get_opcodes()
+    else:
+        opcodes = list(pairs_opcodes(pairs, len(db_keys), len(fetched_keys)))
+
+    if any(opcode[0] == 'replace' for opcode in opcodes):
+        yield from differ_compare(db_keys, fetched_keys)
+        return
+
+    for tag, db_start, db_end, fetched_start, fetched_end in opcodes:
+        if tag == 'equal':
+            for key in db_keys[db_start:db_end]:
+                yield (' ', key)
+        elif tag == 'delete':
+            for key in db_keys[db_start:db_end]:
+                yield ('-', key)
+        elif tag == 'insert':
+            for key in fetched_keys[fetched_start:fetched_end]:
+                yield ('+', key)
@@ -0,0 +1,396 @@
+from bisect import bisect_left, bisect_right
+from functools import reduce
+from hashlib import sha1
+from itertools import count
+
+from tinydb import where
+
+import os
+import threading
+import time
+
+
+INDEXED_FIELDS = ['_id', '_seq', 'account.id', 'card.number', 'transaction_date.date']
+
+RANGE_OPERATORS = {
+    '$gte': lambda values, value: values[bisect_left(values, value):],
+    '$gt': lambda values, value: values[bisect_right(values, value):],
+    '$lte': lambda values, value: values[:bisect_right(values, value)],
+    '$lt': lambda values, value: values[:bisect_left(values, value)],
+}
+
+COMPARISON_OPERATORS = {
+    '$gte': lambda field, value: field is not None and field >= value,
+    '$gt': lambda field, value: field is not None and field > value,
+    '$lte': lambda field, value: field is not None and field <= value,
+    '$lt': lambda field, value: field is not None and field < value,
+}
+
+# Indexes are shared by all the connections to the same database file, as the api
+# and the scheduler open a new connection on each request or update
+_database_files = {}
+_database_files_lock = threading.Lock()
+
+
+class UnsupportedQuery(Exception):
+    pass
+
+
+def get_field(document, path):
+    return reduce(
+        lambda value, key: value.get(key) if isinstance(value, dict) else None,
+        path.split('.'),
+        document
+    )
+
+
+def matches(document, query):
+    for path, condition in query.items():
+        field = get_field(document, path)
+        if isinstance(condition, dict):
+            for operator, value in condition.items():
+                if not COMPARISON_OPERATORS[operator](field, value):
+                    return False
+        elif field != condition:
+            return False
+    return True
+
+
+def check_supported(query):
+    for condition in query.values():
+        if isinstance(condition, dict) and not set(condition).issubset(COMPARISON_OPERATORS):
+            raise UnsupportedQuery(query)
+
+
+def sort_key(path, direction):
+    def key(document):
+        value = get_field(document, path)
+        return (value is not None, value)
+    return key
+
+
+def collection_table(db, collection_name):
+    """
+        The tinydb table behind a tinymongo collection, used for the bulk writes,
+        as tinymongo writes the whole table once per document updated or removed.
+        TinyDB returns the same table the collection uses, so both see the changes.
+    """
+    return db.tinydb.table(collection_name)
+
+
+# Files written less than this time before we read their signature may be written
+# again keeping the same signature, as filesystems store the mtime with less precision
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+def file_signature(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def file_digest(filename):
+    try:
+        with open(filename, 'rb') as database_file:
+            return sha1(database_file.read()).digest()
+    except OSError:
+        return None
+
+
+def copy_document(value):
+    if isinstance(value, dict):
+        return {key: copy_document(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_document(item) for item in value]
+    return value
+
+
+class DatabaseFile():
+    """
+        Tracks the changes made to a database file by anyone else but us. All the
+        collections are stored on the same file, so they share the lock and the
+        signature of the last known state of the file.
+
+        A write done right after the last known state may keep the same mtime and size,
+        so while the signature was taken within RACY_WINDOW_NS of the file mtime, the
+        file contents are checked too.
+    """
+
+    def __init__(self, filename, connect):
+        self.filename = filename
+        self.connect = connect
+        self.lock = threading.RLock()
+        self.signature = None
+        self.digest = None
+        self.signed_at = None
+        self.generation = 0
+        self.indexes = {}
+
+    def racy(self):
+        return self.signature is not None and self.signature[0] >= self.signed_at - RACY_WINDOW_NS
+
+    def sign(self, signature, digest):
+        self.signature = signature
+        self.digest = digest
+        self.signed_at = time.time_ns()
+
+    def refresh(self):
+        signature = file_signature(self.filename)
+        if signature == self.signature and not self.racy():
+            return self.generation
+
+        digest = file_digest(self.filename)
+        if signature != self.signature or digest != self.digest:
+            self.generation += 1
+        # Signed again, so it stops being racy once the window is over
+        self.sign(signature, digest)
+        return self.generation
+
+    def synced(self):
+        self.sign(file_signature(self.filename), file_digest(self.filename))
+
+    def collection_index(self, collection_name):
+        return self.indexes.setdefault(collection_name, CollectionIndex())
+
+
+class CollectionIndex():
+    """
+        In memory copy of a collection documents, with the documents ids grouped by the
+        value of each one of the indexed fields.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self.documents = None
+
+    def build(self, documents, generation):
+        self.documents = {}
+        self.positions = {}
+        self.values = {field: {} for field in INDEXED_FIELDS}
+        self.sorted_values = {}
+        self.counter = count()
+        for document in documents:
+            self.add(document)
+        self.generation = generation
+
+    def add(self, document):
+        _id = document['_id']
+        self.documents[_id] = document
+        self.positions[_id] = next(self.counter)
+        for field, ids_by_value in self.values.items():
+            ids_by_value.setdefault(get_field(document, field), set()).add(_id)
+        self.sorted_values.clear()
+
+    def discard(self, _id):
+        document = self.documents.pop(_id, None)
+        if document is None:
+            return
+        self.positions.pop(_id)
+        for field, ids_by_value in self.values.items():
+            value = get_field(document, field)
+            ids = ids_by_value.get(value)
+            ids.discard(_id)
+            if not ids:
+                del ids_by_value[value]
+        self.sorted_values.clear()
+
+    def replace(self, _id, document):
+        position = self.positions[_id]
+        self.discard(_id)
+        self.add(document)
+        self.positions[_id] = position
+
+    def field_values(self, field):
+        if field not in self.sorted_values:
+            self.sorted_values[field] = sorted(value for value in self.values[field] if value is not None)
+        return self.sorted_values[field]
+
+    def candidate_ids(self, field, condition):
+        ids_by_value = self.values[field]
+        if not isinstance(condition, dict):
+            return ids_by_value.get(condition, set())
+
+        values = self.field_values(field)
+        for operator, value in condition.items():
+            values = RANGE_OPERATORS[operator](values, value)
+        return set().union(*(ids_by_value[value] for value in values))
+
+    def find(self, query, sort=None):
+        check_supported(query)
+
+        indexed = [field for field in query if field in self.values]
+        not_indexed = {field: condition for field, condition in query.items() if field not in self.values}
+
+        if indexed:
+            ids = sorted(
+                (self.candidate_ids(field, query[field]) for field in indexed),
+                key=len
+            )
+            candidates = sorted(set.intersection(*ids), key=self.positions.get)
+        else:
+            candidates = self.documents.keys()
+
+        results = [
+            self.documents[_id] for _id in candidates
+            if matches(self.documents[_id], not_indexed)
+        ]
+
+        for path, direction in reversed(sort or []):
+            results.sort(key=sort_key(path, direction), reverse=direction < 0)
+
+        return results
+
+
+class IndexedCursor(list):
+    def count(self):
+        return len(self)
+
+
+class IndexedCollection():
+    """
+        Wraps a tinymongo collection, answering the queries from the in memory index
+        and keeping it up to date on each write. Queries the index can't answer, and
+        anything else, go straight to the wrapped collection.
+    """
+
+    def __init__(self, db, collection_name, database_file, index):
+        self.db = db
+        self.collection = getattr(db, collection_name)
+        self.collection_name = collection_name
+        self.database_file = database_file
+        self.index = index
+
+    def __getattr__(self, attribute):
+        return getattr(self.collection, attribute)
+
+    def fresh_index(self):
+        generation = self.database_file.refresh()
+        if self.index.generation != generation:
+            # Read through a new connection, as the current one may have cached the old contents
+            fresh_collection = getattr(self.database_file.connect(), self.collection_name)
+            self.index.build(fresh_collection.find({}), generation)
+        return self.index
+
+    def find(self, query=None, sort=None):
+        query = query or {}
+        with self.database_file.lock:
+            try:
+                # Copies, so the documents of the index can't be changed from outside
+                return IndexedCursor(map(copy_document, self.fresh_index().find(query, sort)))
+            except UnsupportedQuery:
+                return self.collection.find(query, sort=sort)
+
+    def insert_one(self, document):
+        with self.database_file.lock:
+            index = self.fresh_index()
+            result = self.collection.insert_one(document)
+            index.add(dict(document, _id=result.inserted_id))
+            self.database_file.synced()
+            return result
+
+    def update(self, query, document):
+        with self.database_file.lock:
+            index = self.fresh_index()
+            updated = index.find(query)
+            result = self.collection.update(query, document)
+            for stored_document in updated:
+                # Stored fields not present in the document are kept, as tinydb does
+                updated_document = dict(stored_document)
+                updated_document.update(document)
+                updated_document['_id'] = stored_document['_id']
+                index.replace(stored_document['_id'], updated_document)
+            self.database_file.synced()
+            return result
+
+    def insert_many(self, documents):
+        with self.database_file.lock:
+            index = self.fresh_index()
+            result = self.collection.insert_many(documents)
+            for document, _id in zip(documents, result.inserted_ids):
+                index.add(dict(document, _id=_id))
+            self.database_file.synced()
+            return result
+
+    def update_many(self, documents):
+        """
+            Updates each one of the documents, matched by _id, with a single table write.
+        """
+        documents_by_id = {document['_id']: document for document in documents}
+        with self.database_file.lock:
+            index = self.fresh_index()
+            collection_table(self.db, self.collection_name).update(
+                lambda stored_document: stored_document.update(documents_by_id[stored_document['_id']]),
+                where('_id').test(documents_by_id.__contains__)
+            )
+            for _id, document in documents_by_id.items():
+                stored_document = index.documents.get(_id)
+                if stored_document is not None:
+                    updated_document = dict(stored_document)
+                    updated_document.update(document)
+                    index.replace(_id, updated_document)
+            self.database_file.synced()
+
+    def remove_many(self, ids):
+        """
+            Removes all the documents with the given ids with a single table write.
+        """
+        ids = set(ids)
+        with self.database_file.lock:
+            index = self.fresh_index()
+            collection_table(self.db, self.collection_name).remove(where('_id').test(ids.__contains__))
+            for _id in ids:
+                index.discard(_id)
+            self.database_file.synced()
+
+    def remove(self, query):
+        with self.database_file.lock:
+            index = self.fresh_index()
+            removed = index.find(query)
+            result = self.collection.remove(query)
+            for stored_document in removed:
+                index.discard(stored_document['_id'])
+            self.database_file.synced()
+            return result
+
+
+class IndexedDatabase():
+    def __init__(self, db, database_file):
+        self.db = db
+        self.database_file = database_file
+        self.filename = database_file.filename
+
+    def __getattr__(self, collection_name):
+        return IndexedCollection(
+            self.db,
+            collection_name,
+            self.database_file,
+            self.database_file.collection_index(collection_name)
+        )
+
+    def close(self):
+        # Only this connection is closed, the indexes are shared with the other ones.
+        # Older tinymongo databases have no close, only their TinyDB file to close.
+        if hasattr(type(self.db), 'close'):
+            self.db.close()
+        else:
+            self.db.tinydb.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def indexed(connect, filename):
+    """
+        Returns a connection to the database stored at filename, with indexed collections.
+        The connect function opens a new connection to it.
+    """
+    filename = os.path.abspath(filename)
+    with _database_files_lock:
+        if filename not in _database_files:
+            _database_files[filename] = DatabaseFile(filename, connect)
+    return IndexedDatabase(connect(), _database_files[filename])
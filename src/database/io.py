@@ -1,17 +1,19 @@
 
 from collections import Counter
 from datetime import datetime
-from dataclasses import is_dataclass
-from difflib import Differ
-from enum import Enum
-from operator import itemgetter
+from functools import lru_cache, partial
+from operator import attrgetter, itemgetter
 from copy import deepcopy
 
 import re
 
 import datatypes
+from common import encoding
+from common.encoding import encode_date
 from common.utils import get_nested_item
 
+from . import access_codes
+from . import alignment
 from .domain import SortDirection
 
 
@@ -45,138 +47,116 @@ def diverged_history(diverged_transaction, extra_message=''):
     )
 
 
-def encode_date(dt):
-    return dt.strftime('%Y-%m-%dT%H:%M:%S')
+def encode_object(domain_object):
+    return encoding.DATABASE.encode(domain_object)
 
 
-def encode_object(domain_object):
-    def encode(obj):
-        if is_dataclass(obj):
-            encoded = obj.__dict__
-            encoded['__type__'] = 'dataclass::{}'.format(obj.__class__.__name__)
-            return encoded
-        elif isinstance(obj, Enum):
-            return {
-                '__type__': 'enum::{}'.format(obj.__class__.__name__),
-                'name': obj.name
-            }
-        elif isinstance(obj, datetime):
-            return {
-                '__type__': 'datetime',
-                'date': encode_date(obj)
-            }
-        else:
-            return obj
+@lru_cache(maxsize=65536)
+def decode_date(date_string):
+    # datetimes are immutable, so the same instance can be shared by all the decoded objects
+    return datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%S')
 
-    def recurse(obj):
-        encoded = encode(obj)
-        if isinstance(encoded, dict):
-            new = {}
-            for key, value in encoded.items():
-                new[key] = recurse(value)
-            return new
-
-        elif isinstance(encoded, list):
-            new = []
-            for item in encoded:
-                new.append(recurse(item))
-            return new
-        else:
-            return encoded
 
-    return recurse(domain_object)
+def decode_custom_type(type_string, fields):
+    """
+        Decodes a custom type not found in the decoders table, in the same way they
+        were all decoded before the table existed.
+    """
+    custom_type_class, custom_type_name = re.match(r'([^:]+)(?:::(.*))?', type_string).groups()
+
+    if custom_type_class == 'dataclass':
+        CustomDataclass = getattr(datatypes, custom_type_name)
+        return CustomDataclass(**fields)
+    elif custom_type_class == 'enum':
+        CustomEnum = getattr(datatypes, custom_type_name)
+        return CustomEnum[fields['name']]
+    elif custom_type_class == 'datetime':
+        return decode_date(fields['date'])
+    else:
+        return fields
+
+
+def build_decoders():
+    decoders = {
+        'datetime': lambda fields: decode_date(fields['date'])
+    }
+    for CustomDataclass in datatypes.DATACLASSES:
+        decoders['dataclass::{}'.format(CustomDataclass.__name__)] = partial(call_with_fields, CustomDataclass)
+    for CustomEnum in datatypes.ENUMS:
+        decoders['enum::{}'.format(CustomEnum.__name__)] = partial(enum_member, CustomEnum)
+    return decoders
+
+
+def call_with_fields(CustomDataclass, fields):
+    return CustomDataclass(**fields)
+
+
+def enum_member(CustomEnum, fields):
+    return CustomEnum[fields['name']]
+
+
+DECODERS = build_decoders()
 
 
 def decode_object(document):
+    """
+        Builds the domain objects from a stored document. The document is left untouched,
+        every decoded dict and list is a new one.
+    """
 
     if document is None:
         return None
 
-    def decode(obj):
-        if not isinstance(obj, dict):
-            return obj
-
-        if '__type__' not in obj:
-            return obj
-
-        custom_type_class, custom_type_name = re.match(r'([^:]+)(?:::(.*))?', obj.pop('__type__')).groups()
+    def recurse(obj):
+        if isinstance(obj, dict):
+            decoded = {key: recurse(value) for key, value in obj.items() if key != '__type__'}
+            if '__type__' not in obj:
+                return decoded
+            type_string = obj['__type__']
+            decoder = DECODERS.get(type_string)
+            if decoder is None:
+                return decode_custom_type(type_string, decoded)
+            return decoder(decoded)
+
+        elif isinstance(obj, list):
+            return [recurse(item) for item in obj]
 
-        if custom_type_class == 'dataclass':
-            CustomDataclass = getattr(datatypes, custom_type_name)
-            return CustomDataclass(**obj)
-        elif custom_type_class == 'enum':
-            CustomEnum = getattr(datatypes, custom_type_name)
-            return CustomEnum[obj['name']]
-        elif custom_type_class == 'datetime':
-            return datetime.strptime(obj['date'], '%Y-%m-%dT%H:%M:%S')
         else:
             return obj
 
-    def recurse(obj):
-        decoded = decode(obj)
-        if is_dataclass(decoded):
-            for key, value in decoded.__dict__.items():
-                setattr(decoded, key, recurse(value))
-            return decoded
-        elif isinstance(decoded, dict):
-            new = {}
-            for key, value in decoded.items():
-                new[key] = recurse(value)
-            return new
-
-        elif isinstance(decoded, list):
-            new = []
-            for item in decoded:
-                new.append(recurse(item))
-            return new
+    return recurse(document)
 
-        else:
-            return decoded
 
-    decoded = recurse(deepcopy(document))
-    return decoded
+def insert_many(collection, documents):
+    # Documents without an _id yet get a new one from tinymongo
+    return collection.insert_many([
+        {key: value for key, value in document.items() if key != '_id' or value is not None}
+        for document in documents
+    ])
 
 
 def get_account_access_code(db, account_number):
-    collection = db.account_access_codes
-    # In reality this cache problem here is a lack of locking that
-    # makes this break when we are continuously querying for access code, and a new code is deleted
-    # and inserted, and the empty db after the delte is cached, but not the insertion.
-    # maybe trying with the newest tinydb, or the tinyrecord extension.
-    try:
-        collection.table.clear_cache()
-    except AttributeError:
-        pass
-
-    results = list(collection.find({"account_id": account_number}))
-    return decode_object(results[0]) if results else None
+    return access_codes.store(db).get(db, 'account_access_codes', 'account_id', account_number, decode_object)
 
 
 def get_bank_access_code(db, bank_id):
-    collection = db.bank_access_codes
-    # In reality this cache problem here is a lack of locking that
-    # makes this break when we are continuously querying for access code, and a new code is deleted
-    # and inserted, and the empty db after the delte is cached, but not the insertion.
-    # maybe trying with the newest tinydb, or the tinyrecord extension.
-    try:
-        collection.table.clear_cache()
-    except AttributeError:
-        pass
-
-    results = list(collection.find({"bank_id": bank_id}))
-    return decode_object(results[0]) if results else None
+    return access_codes.store(db).get(db, 'bank_access_codes', 'bank_id', bank_id, decode_object)
 
 
 def update_bank_access_code(db, bank_id, access_code):
-    collection = db.bank_access_codes
-    collection.remove({"bank_id": bank_id})
-    return collection.insert_one(encode_object(access_code))
+    return access_codes.store(db).replace(db, 'bank_access_codes', 'bank_id', bank_id, encode_object(access_code), access_code)
 
 
 def update_account_access_code(db, account_number, access_code):
-    collection = db.account_access_codes
-    collection.remove({"account_id": account_number})
-    return collection.insert_one(encode_object(access_code))
+    return access_codes.store(db).replace(db, 'account_access_codes', 'account_id', account_number, encode_object(access_code), access_code)
+
+
+def wait_for_bank_access_code(db, bank_id, accept, timeout):
+    return access_codes.store(db).wait(db, 'bank_access_codes', 'bank_id', bank_id, decode_object, accept, timeout)
+
+
+def wait_for_account_access_code(db, account_number, accept, timeout):
+    return access_codes.store(db).wait(db, 'account_access_codes', 'account_id', account_number, decode_object, accept, timeout)
 
 
 def find_local_account_transactions(db, account_id=None, since_date=None, sort_direction=SortDirection.NEWEST_TRANSACTION_LAST):
@@ -205,36 +185,21 @@ def insert_local_account_transaction(db, transaction):
     return collection.insert_one(encode_object(transaction))
 
 
-def find_matching_account_transaction(db, account_number, transaction):
-    collection = db.account_transactions
-    results = list(
-        filter(
-            lambda transaction: not transaction.status_flags.valid_duplicate,
-            map(
-                decode_object,
-                collection.find(
-                    {
-                        'account.id': account_number,
-                        'transaction_date.date': encode_date(transaction.transaction_date),
-                        'amount': transaction.amount,
-                        'balance': transaction.balance
-                    },
-                    sort=[('_seq', 1)]
-                )
-            )
-        )
-    )
-
-    if not results:
-        return None
+def find_matching_account_transactions(db, account_number, transactions):
+    if not transactions:
+        return []
 
-    if len(results) > 1:
-        raise DatabaseError('Found more than one match for a transaction, check the algorithm [{date} {amount}]'.format(
-            date=encode_date(transaction.transaction_date),
-            amount=transaction.amount
-        ))
+    candidates = find_account_transactions(
+        db, account_number,
+        since_date=min(map(attrgetter('transaction_date'), transactions)),
+        until_date=max(map(attrgetter('transaction_date'), transactions))
+    )
 
-    return decode_object(results[0])
+    return match_transactions(
+        candidates,
+        transactions,
+        key=lambda transaction: (encode_date(transaction.transaction_date), transaction.amount, transaction.balance)
+    )
 
 
 def find_one_account_transaction(db, account_number, sort_seq=1):
@@ -252,7 +217,7 @@ def find_one_account_transaction(db, account_number, sort_seq=1):
     return decode_object(results[0])
 
 
-def find_account_transactions(db, account_number=None, since_seq_number=None, since_date=None, sort_field='_seq', sort_direction=1):
+def find_account_transactions(db, account_number=None, since_seq_number=None, since_date=None, until_date=None, sort_field='_seq', sort_direction=1):
     collection = db.account_transactions
     query = {}
 
@@ -263,7 +228,10 @@ def find_account_transactions(db, account_number=None, since_seq_number=None, si
         query['_seq'] = {"$gte": since_seq_number}
 
     if since_date is not None:
-        query['transaction_date.date'] = {'$gte': encode_date(since_date)}
+        query.setdefault('transaction_date.date', {})['$gte'] = encode_date(since_date)
+
+    if until_date is not None:
+        query.setdefault('transaction_date.date', {})['$lte'] = encode_date(until_date)
 
     results = list(map(
         decode_object,
@@ -281,11 +249,14 @@ def remove_account_transaction(db, transaction):
     collection.remove({
         '_id': transaction._id
     })
+    summary_transactions_removed(db, 'account_transactions', {transaction.account.id: [transaction]})
 
 
 def insert_account_transaction(db, transaction):
     collection = db.account_transactions
-    return collection.insert_one(encode_object(transaction))
+    result = collection.insert_one(encode_object(transaction))
+    summary_transactions_inserted(db, 'account_transactions', {transaction.account.id: [(transaction, result.inserted_id)]})
+    return result
 
 
 def count_account_transactions(db, account_number):
@@ -297,39 +268,52 @@ def count_account_transactions(db, account_number):
 
 def update_account_transaction(db, transaction):
     collection = db.account_transactions
-    return collection.update({'_id': transaction._id}, encode_object(transaction))
+    result = collection.update({'_id': transaction._id}, encode_object(transaction))
+    summary_transactions_updated(db, 'account_transactions', {transaction.account.id: [transaction]})
+    return result
 
 
-def find_matching_credit_card_transaction(db, credit_card_number, transaction):
-    collection = db.credit_card_transactions
-    results = list(
-        filter(
-            lambda transaction: not transaction.status_flags.valid_duplicate,
-            map(
-                decode_object,
-                collection.find(
-                    {
-                        'card.number': credit_card_number,
-                        'transaction_date.date': encode_date(transaction.transaction_date),
-                        'amount': transaction.amount,
-                        'transaction_id': transaction.transaction_id
-                    },
-                    sort=[('_seq', 1)]
-                )
-            )
-        )
-    )
+def insert_many_account_transactions(db, transactions):
+    if not transactions:
+        return []
+    collection = db.account_transactions
+    result = insert_many(collection, list(map(encode_object, transactions)))
+    inserted = zip(transactions, result.inserted_ids)
+    summary_transactions_inserted(db, 'account_transactions', group_transactions(inserted, lambda item: item[0].account.id))
+    return result.inserted_ids
 
-    if not results:
-        return None
 
-    if len(results) > 1:
-        raise DatabaseError('Found more than one match for a transaction, check the algorithm [{date} {amount}]'.format(
-            date=encode_date(transaction.transaction_date),
-            amount=transaction.amount
-        ))
+def update_many_account_transactions(db, transactions):
+    if not transactions:
+        return
+    collection = db.account_transactions
+    collection.update_many(list(map(encode_object, transactions)))
+    summary_transactions_updated(db, 'account_transactions', group_transactions(transactions, attrgetter('account.id')))
+
 
-    return decode_object(results[0])
+def remove_many_account_transactions(db, transactions):
+    if not transactions:
+        return
+    collection = db.account_transactions
+    collection.remove_many(map(attrgetter('_id'), transactions))
+    summary_transactions_removed(db, 'account_transactions', group_transactions(transactions, attrgetter('account.id')))
+
+
+def find_matching_credit_card_transactions(db, credit_card_number, transactions):
+    if not transactions:
+        return []
+
+    candidates = find_credit_card_transactions(
+        db, credit_card_number,
+        since_date=min(map(attrgetter('transaction_date'), transactions)),
+        until_date=max(map(attrgetter('transaction_date'), transactions))
+    )
+
+    return match_transactions(
+        candidates,
+        transactions,
+        key=lambda transaction: (encode_date(transaction.transaction_date), transaction.amount, transaction.transaction_id)
+    )
 
 
 def find_one_credit_card_transaction(db, credit_card_number, sort_seq=1):
@@ -347,7 +331,7 @@ def find_one_credit_card_transaction(db, credit_card_number, sort_seq=1):
     return decode_object(results[0])
 
 
-def find_credit_card_transactions(db, credit_card_number=None, since_seq_number=None, since_date=None, _seq=None, sort_field='_seq', sort_direction=1):
+def find_credit_card_transactions(db, credit_card_number=None, since_seq_number=None, since_date=None, until_date=None, _seq=None, sort_field='_seq', sort_direction=1):
     collection = db.credit_card_transactions
     query = {}
 
@@ -361,7 +345,10 @@ def find_credit_card_transactions(db, credit_card_number=None, since_seq_number=
         query['_seq'] = _seq
 
     if since_date is not None:
-        query['transaction_date.date'] = {'$gte': encode_date(since_date)}
+        query.setdefault('transaction_date.date', {})['$gte'] = encode_date(since_date)
+
+    if until_date is not None:
+        query.setdefault('transaction_date.date', {})['$lte'] = encode_date(until_date)
 
     results = list(map(
         decode_object,
@@ -379,11 +366,14 @@ def remove_credit_card_transaction(db, transaction):
     collection.remove({
         '_id': transaction._id
     })
+    summary_transactions_removed(db, 'credit_card_transactions', {transaction.card.number: [transaction]})
 
 
 def insert_credit_card_transaction(db, transaction):
     collection = db.credit_card_transactions
-    return collection.insert_one(encode_object(transaction))
+    result = collection.insert_one(encode_object(transaction))
+    summary_transactions_inserted(db, 'credit_card_transactions', {transaction.card.number: [(transaction, result.inserted_id)]})
+    return result
 
 
 def count_credit_card_transactions(db, credit_card_number):
@@ -395,7 +385,193 @@ def count_credit_card_transactions(db, credit_card_number):
 
 def update_credit_card_transaction(db, transaction):
     collection = db.credit_card_transactions
-    return collection.update({'_id': transaction._id}, encode_object(transaction))
+    result = collection.update({'_id': transaction._id}, encode_object(transaction))
+    summary_transactions_updated(db, 'credit_card_transactions', {transaction.card.number: [transaction]})
+    return result
+
+
+def insert_many_credit_card_transactions(db, transactions):
+    if not transactions:
+        return []
+    collection = db.credit_card_transactions
+    result = insert_many(collection, list(map(encode_object, transactions)))
+    inserted = zip(transactions, result.inserted_ids)
+    summary_transactions_inserted(db, 'credit_card_transactions', group_transactions(inserted, lambda item: item[0].card.number))
+    return result.inserted_ids
+
+
+def update_many_credit_card_transactions(db, transactions):
+    if not transactions:
+        return
+    collection = db.credit_card_transactions
+    collection.update_many(list(map(encode_object, transactions)))
+    summary_transactions_updated(db, 'credit_card_transactions', group_transactions(transactions, attrgetter('card.number')))
+
+
+def remove_many_credit_card_transactions(db, transactions):
+    if not transactions:
+        return
+    collection = db.credit_card_transactions
+    collection.remove_many(map(attrgetter('_id'), transactions))
+    summary_transactions_removed(db, 'credit_card_transactions', group_transactions(transactions, attrgetter('card.number')))
+
+
+def get_account_transactions_summary(db, account_number):
+    summary = find_transactions_summary(db, 'account_transactions', account_number)
+    if summary is None:
+        summary = build_transactions_summary(
+            'account_transactions', account_number,
+            count_account_transactions(db, account_number),
+            find_one_account_transaction(db, account_number, sort_seq=-1)
+        )
+        save_transactions_summary(db, summary)
+    return summary
+
+
+def get_credit_card_transactions_summary(db, credit_card_number):
+    summary = find_transactions_summary(db, 'credit_card_transactions', credit_card_number)
+    if summary is None:
+        summary = build_transactions_summary(
+            'credit_card_transactions', credit_card_number,
+            count_credit_card_transactions(db, credit_card_number),
+            find_one_credit_card_transaction(db, credit_card_number, sort_seq=-1)
+        )
+        save_transactions_summary(db, summary)
+    return summary
+
+
+def set_last_transaction(summary, transaction, transaction_id):
+    summary.last_seq = transaction._seq
+    summary.last_transaction_date = transaction.transaction_date
+    summary.last_balance = getattr(transaction, 'balance', None)
+    summary.last_id = transaction_id
+
+
+def build_transactions_summary(collection_name, grouping_id, count, last_transaction):
+    summary = datatypes.TransactionsSummary(collection=collection_name, grouping_id=grouping_id, count=count)
+    if last_transaction is not None:
+        set_last_transaction(summary, last_transaction, last_transaction._id)
+    return summary
+
+
+def find_transactions_summary(db, collection_name, grouping_id):
+    collection = db.transaction_summaries
+    results = list(collection.find({'collection': collection_name, 'grouping_id': grouping_id}))
+    return decode_object(results[0]) if results else None
+
+
+def save_transactions_summary(db, summary):
+    collection = db.transaction_summaries
+    if summary._id is None:
+        return collection.insert_one(encode_object(summary))
+    return collection.update({'_id': summary._id}, encode_object(summary))
+
+
+# The summary of a group of transactions is kept up to date on each write, so the last
+# transaction (the one with the highest sequence number) and the transaction count can be
+# read without loading the whole group. A missing summary gets built from the collection
+# the next time it's requested, so when the last transaction is removed or moved
+# we just discard it.
+#
+# The summaries touched by a write are read and saved at once, whatever the amount of
+# transactions and groups written. Only the writes done through this module update them,
+# so anything writing to the transaction collections by other means has to remove the
+# summaries of the groups it changes.
+
+def find_transactions_summaries(db, collection_name, grouping_ids):
+    collection = db.transaction_summaries
+    summaries = map(decode_object, collection.find({'collection': collection_name}))
+    return {summary.grouping_id: summary for summary in summaries if summary.grouping_id in grouping_ids}
+
+
+def update_transactions_summaries(db, collection_name, groups, update_summary):
+    """
+        Runs update_summary(summary, items) on the summary of each one of the groups
+        of written transactions, given as {grouping_id: items}. It returns the updated
+        summary, or None if the summary has to be discarded.
+    """
+    updated, discarded = [], []
+    for grouping_id, summary in find_transactions_summaries(db, collection_name, groups).items():
+        updated_summary = update_summary(deepcopy(summary), groups[grouping_id])
+        if updated_summary is None:
+            discarded.append(summary._id)
+        elif updated_summary != summary:
+            updated.append(encode_object(updated_summary))
+
+    collection = db.transaction_summaries
+    if updated:
+        collection.update_many(updated)
+    if discarded:
+        collection.remove_many(discarded)
+
+
+def summary_inserted(summary, inserted):
+    summary.count += len(inserted)
+    for transaction, transaction_id in inserted:
+        if summary.last_seq is None or transaction._seq >= summary.last_seq:
+            set_last_transaction(summary, transaction, transaction_id)
+    return summary
+
+
+def summary_updated(summary, transactions):
+    for transaction in transactions:
+        if summary.last_seq is None or transaction._seq >= summary.last_seq:
+            set_last_transaction(summary, transaction, transaction._id)
+        elif transaction._id == summary.last_id:
+            return None
+    return summary
+
+
+def summary_removed(summary, transactions):
+    if summary.last_id in set(map(attrgetter('_id'), transactions)):
+        return None
+    summary.count -= len(transactions)
+    return summary
+
+
+def summary_transactions_inserted(db, collection_name, groups):
+    update_transactions_summaries(db, collection_name, groups, summary_inserted)
+
+
+def summary_transactions_updated(db, collection_name, groups):
+    update_transactions_summaries(db, collection_name, groups, summary_updated)
+
+
+def summary_transactions_removed(db, collection_name, groups):
+    update_transactions_summaries(db, collection_name, groups, summary_removed)
+
+
+def group_transactions(transactions, grouping_id):
+    groups = {}
+    for transaction in transactions:
+        groups.setdefault(grouping_id(transaction), []).append(transaction)
+    return groups
+
+
+def match_transactions(candidates, transactions, key):
+    """
+        Resolves the stored counterpart of each one of the transactions in a single pass.
+        Candidates are indexed by the same fields a single match would be queried with,
+        ignoring the ones flagged as valid duplicates.
+    """
+    candidates_by_key = {}
+    for candidate in candidates:
+        if not candidate.status_flags.valid_duplicate:
+            candidates_by_key.setdefault(key(candidate), []).append(candidate)
+
+    matches = []
+    for transaction in transactions:
+        results = candidates_by_key.get(key(transaction), [])
+
+        if len(results) > 1:
+            raise DatabaseError('Found more than one match for a transaction, check the algorithm [{date} {amount}]'.format(
+                date=encode_date(transaction.transaction_date),
+                amount=transaction.amount
+            ))
+
+        matches.append(results[0] if results else None)
+
+    return matches
 
 
 def align_decimal(number):
@@ -417,8 +593,7 @@ def log_action(transaction, action):
 
 
 def check_balance_consistency(db, account_number):
-    collection = db.account_transactions
-    results = find_account_transactions(collection, account_number)
+    results = find_account_transactions(db, account_number)
 
     last_balance = results[0].balance
 
@@ -433,16 +608,14 @@ def check_balance_consistency(db, account_number):
 
 
 def check_account_sequence_numbering_consistency(db, account_number):
-    collection = db.account_transactions
-    results = find_account_transactions(collection, account_number)
+    results = find_account_transactions(db, account_number)
 
     duplicated_seq_numbers = list(map(lambda x: x[0], filter(lambda x: x[1] > 1, Counter([a._seq for a in results]).items())))
     return duplicated_seq_numbers
 
 
 def check_credit_card_sequence_numbering_consistency(db, credit_card_number):
-    collection = db.credit_card_transactions
-    results = find_credit_card_transactions(collection, credit_card_number)
+    results = find_credit_card_transactions(db, credit_card_number)
 
     duplicated_seq_numbers = list(map(lambda x: x[0], filter(lambda x: x[1] > 1, Counter([a._seq for a in results]).items())))
     return duplicated_seq_numbers
@@ -450,42 +623,39 @@ def check_credit_card_sequence_numbering_consistency(db, credit_card_number):
 
 def select_new_transactions(fetched_transactions, db_transactions, transaction_key_fields):
 
-    def transaction_string(transaction):
-        return ' '.join(
+    def transaction_key(transaction):
+        return alignment.key_line(
             map(
-                lambda field: get_nested_item(transaction, field).__repr__(),
+                lambda field: get_nested_item(transaction, field),
                 transaction_key_fields
             )
         )
 
-    hashed_fetched_transactions = [
+    keyed_fetched_transactions = [
         (
-            transaction_string(transaction),
+            transaction_key(transaction),
             transaction,
         )
         for transaction in fetched_transactions
     ]
 
-    hashed_db_transactions = [
+    keyed_db_transactions = [
         (
-            transaction_string(transaction),
+            transaction_key(transaction),
             transaction,
         )
         for transaction in db_transactions
     ]
 
-    fetched_transactions_by_hash = dict(hashed_fetched_transactions)
-    db_transactions_by_hash = dict(hashed_db_transactions)
+    fetched_transactions_by_key = dict(keyed_fetched_transactions)
+    db_transactions_by_key = dict(keyed_db_transactions)
 
-    # TODO Check for duplicate hashes
+    # TODO Check for duplicate keys
 
-    diff = list(filter(
-        lambda x: x[0] != '?',
-        list(Differ().compare(
-            list(map(itemgetter(0), hashed_db_transactions)),
-            list(map(itemgetter(0), hashed_fetched_transactions))
-        ))
-    ))
+    diff = alignment.diff(
+        map(itemgetter(0), keyed_db_transactions),
+        map(itemgetter(0), keyed_fetched_transactions)
+    )
 
     next_seq_number = 0
     sequence_change_needed = False
@@ -498,16 +668,14 @@ def select_new_transactions(fetched_transactions, db_transactions, transaction_k
 
     diverged = []
 
-    for item in diff:
+    for action, key in diff:
 
-        action = item[0]
-        transaction_hash = item[2:]
         # This will be set to None when the current transaction is a db transaction
         # that is not present in the fetched ones. This indicates that this batch has
         # a diversion that will be checked, but shouldn't be a problem
-        fetched_transaction = fetched_transactions_by_hash.get(transaction_hash)
+        fetched_transaction = fetched_transactions_by_key.get(key)
 
-        if transaction_hash == hashed_fetched_transactions[-1][0]:
+        if key == keyed_fetched_transactions[-1][0]:
             all_fetched_processed = True
 
         if action == '+' and fetched_transaction.status_flags.invalid:
@@ -542,13 +710,13 @@ def select_new_transactions(fetched_transactions, db_transactions, transaction_k
             # so here we only set the next sequence number, that will be
             # be used if we have new fetched transactions at the tail
             # or we need to cascade change sequence numbers
-            next_seq_number = db_transactions_by_hash[transaction_hash]._seq + 1
-            log_action(db_transactions_by_hash[transaction_hash], 's')
+            next_seq_number = db_transactions_by_key[key]._seq + 1
+            log_action(db_transactions_by_key[key], 's')
 
         elif sequence_change_needed and action == ' ':
             # this transaction is on both db and fetched transactions but we inserted
             # something that changed the sequence, so we need to update it
-            stored_transaction = db_transactions_by_hash[transaction_hash]
+            stored_transaction = db_transactions_by_key[key]
             updated_transaction = deepcopy(stored_transaction)
             updated_transaction._seq = next_seq_number
             yield ('update', updated_transaction)
@@ -558,7 +726,7 @@ def select_new_transactions(fetched_transactions, db_transactions, transaction_k
         elif action == '-' and all_fetched_processed and sequence_change_needed:
             # this transaction is only on db but as something happened
             # that changed the sequence, so we need to update it
-            stored_transaction = db_transactions_by_hash[transaction_hash]
+            stored_transaction = db_transactions_by_key[key]
             updated_transaction = deepcopy(stored_transaction)
             updated_transaction._seq = next_seq_number
             yield ('update', updated_transaction)
@@ -572,7 +740,7 @@ def select_new_transactions(fetched_transactions, db_transactions, transaction_k
             pass
 
         elif action == '-' and not all_fetched_processed:
-            diverged.append(db_transactions_by_hash[transaction_hash])
+            diverged.append(db_transactions_by_key[key])
 
         # After processing the last fetched transaction, if we didn't do
         # anything that broke the sequence numbering, we can stop
@@ -581,4 +749,17 @@ def select_new_transactions(fetched_transactions, db_transactions, transaction_k
             break
 
     if diverged:
-        raise DivergedHistoryError(db_transactions_by_hash[transaction_hash])
+        raise DivergedHistoryError(db_transactions_by_key[key])
+
+
+def find_rulesets(db):
+    return {
+        document['fingerprint']: document['rules']
+        for document in db.rulesets.find()
+    }
+
+
+def save_ruleset(db, fingerprint, rule_hashes):
+    collection = db.rulesets
+    if not list(collection.find({'fingerprint': fingerprint})):
+        return collection.insert_one({'fingerprint': fingerprint, 'rules': list(rule_hashes)})
@@ -1,18 +1,71 @@
+from collections import Counter
 from copy import deepcopy
+from dataclasses import fields
 from functools import partial
+from tinydb import TinyDB
 from tinymongo import TinyMongoClient
 
+import os
+
 from . import io
+from .indexes import indexed
+from .sqlite import SQLiteDatabase
 from datatypes import BankAccountTransaction, BankCreditCardTransaction, LocalAccountTransaction
 from datatypes import LocalAccount, Card
 
 from collections import namedtuple
 
 
-def load(database_folder):
-    connection = TinyMongoClient(database_folder)
-    db = getattr(connection, 'banking')
-    return db
+def load_tinymongo(database_folder):
+    def connect():
+        connection = TinyMongoClient(database_folder)
+        return getattr(connection, 'banking')
+
+    return indexed(connect, os.path.join(database_folder, 'banking.json'))
+
+
+def load_sqlite(database_folder):
+    return SQLiteDatabase(os.path.join(database_folder, 'banking.sqlite'))
+
+
+BACKENDS = {
+    'tinymongo': load_tinymongo,
+    'sqlite': load_sqlite
+}
+
+
+def load(database_folder, backend=None):
+    """
+        Opens the database stored at database_folder. Without an explicit backend,
+        the SQLite database is used if the folder has one, tinymongo otherwise.
+    """
+    if backend is None:
+        backend = 'sqlite' if os.path.exists(os.path.join(database_folder, 'banking.sqlite')) else 'tinymongo'
+    return BACKENDS[backend](database_folder)
+
+
+def migrate(tinymongo_folder, database_folder):
+    """
+        Copies all the collections of a tinymongo database into the SQLite database
+        of database_folder. Returns the number of documents copied by collection.
+    """
+    if os.path.exists(os.path.join(database_folder, 'banking.sqlite')):
+        raise io.DatabaseError('There is already a SQLite database at {}'.format(database_folder))
+
+    source_db = load_tinymongo(tinymongo_folder)
+    target_db = load_sqlite(database_folder)
+
+    collection_names = TinyDB(os.path.join(tinymongo_folder, 'banking.json')).tables() - {'_default'}
+
+    migrated = {}
+    for collection_name in sorted(collection_names):
+        documents = list(getattr(source_db, collection_name).find({}))
+        if documents:
+            getattr(target_db, collection_name).insert_many(documents)
+        migrated[collection_name] = len(documents)
+
+    target_db.close()
+    return migrated
 
 
 def get_account_access_code(db, account):
@@ -33,16 +86,36 @@ def update_bank_access_code(db, bank_config, access_code):
     return io.update_bank_access_code(db, bank_config.id, access_code)
 
 
+def wait_for_account_access_code(db, account, accept, timeout):
+    return io.wait_for_account_access_code(db, account.id, accept, timeout)
+
+
+def wait_for_bank_access_code(db, bank_config, accept, timeout):
+    return io.wait_for_bank_access_code(db, bank_config.id, accept, timeout)
+
+
+def find_rulesets(db):
+    return io.find_rulesets(db)
+
+
+def save_ruleset(db, rules):
+    return io.save_ruleset(db, rules.fingerprint, rules.hashes)
+
+
+def get_account_transactions_summary(db, account_number):
+    return io.get_account_transactions_summary(db, account_number)
+
+
+def get_credit_card_transactions_summary(db, credit_card_number):
+    return io.get_credit_card_transactions_summary(db, credit_card_number)
+
+
 def last_account_transaction_date(db, account_number):
-    collection = db.account_transactions
-    results = io.find_account_transactions(collection, account_number, sort_field='transaction_date.date')
-    return results[-1].transaction_date if results else None
+    return get_account_transactions_summary(db, account_number).last_transaction_date
 
 
 def last_credit_card_transaction_date(db, credit_card_number):
-    collection = db.credit_card_transactions
-    results = io.find_credit_card_transactions(collection, credit_card_number, sort_field='transaction_date.date')
-    return results[-1].transaction_date if results else None
+    return get_credit_card_transactions_summary(db, credit_card_number).last_transaction_date
 
 
 def find_transactions(db, account, **query):
@@ -78,14 +151,14 @@ def update_credit_card_transactions(db, credit_card_number, raw_fetched_transact
         TransactionDataclass=BankCreditCardTransaction,
         transaction_grouping_id=credit_card_number,
         transaction_key_fields=['transaction_date', 'amount', 'type.name'],
-        operations=namedtuple('TransactionOperations', 'insert, update, find, find_one, find_matching, count, remove')(
-            io.insert_credit_card_transaction,
-            io.update_credit_card_transaction,
+        operations=namedtuple('TransactionOperations', 'insert_many, update_many, find, find_one, find_matching, count, remove_many')(
+            io.insert_many_credit_card_transactions,
+            io.update_many_credit_card_transactions,
             io.find_credit_card_transactions,
             io.find_one_credit_card_transaction,
-            io.find_matching_credit_card_transaction,
+            io.find_matching_credit_card_transactions,
             io.count_credit_card_transactions,
-            io.remove_credit_card_transaction
+            io.remove_many_credit_card_transactions
         ),
         raw_fetched_transactions=raw_fetched_transactions
     )
@@ -106,14 +179,14 @@ def update_account_transactions(db, account_number, raw_fetched_transactions):
         TransactionDataclass=BankAccountTransaction,
         transaction_grouping_id=account_number,
         transaction_key_fields=['transaction_date', 'amount', 'balance'],
-        operations=namedtuple('TransactionOperations', 'insert, update, find, find_one, find_matching, count, remove')(
-            io.insert_account_transaction,
-            io.update_account_transaction,
+        operations=namedtuple('TransactionOperations', 'insert_many, update_many, find, find_one, find_matching, count, remove_many')(
+            io.insert_many_account_transactions,
+            io.update_many_account_transactions,
             io.find_account_transactions,
             io.find_one_account_transaction,
-            io.find_matching_account_transaction,
+            io.find_matching_account_transactions,
             io.count_account_transactions,
-            io.remove_account_transaction
+            io.remove_many_account_transactions
         ),
         raw_fetched_transactions=raw_fetched_transactions
     )
@@ -154,10 +227,11 @@ def update_transactions(db, TransactionDataclass, transaction_grouping_id, trans
             yield _transaction
 
     def process_actions():
-        removed = list(map(partial(operations.remove, db), actions['remove']))
-        inserted = list(map(partial(operations.insert, db), actions['insert']))
-        updated = list(map(partial(operations.update, db), actions['update']))
-        return (len(removed), len(inserted), len(updated))
+        # Each batch is written at once, as every write rewrites the whole database file
+        operations.remove_many(db, actions['remove'])
+        operations.insert_many(db, actions['insert'])
+        operations.update_many(db, actions['update'])
+        return (len(actions['remove']), len(actions['insert']), len(actions['update']))
 
     fetched_transactions = list(map(
         lambda transaction: TransactionDataclass(**transaction.__dict__),
@@ -218,10 +292,7 @@ def update_transactions(db, TransactionDataclass, transaction_grouping_id, trans
 
     overlapping_transactions = list(filter(
         bool,
-        map(
-            partial(operations.find_matching, db, transaction_grouping_id),
-            fetched_transactions
-        )
+        operations.find_matching(db, transaction_grouping_id, fetched_transactions)
     ))
 
     # All transactions are newer and neither in the tail or head
@@ -250,3 +321,43 @@ def update_transaction(db, transaction):
         BankCreditCardTransaction: io.update_credit_card_transaction
     }[transaction.__class__](db, transaction)
 
+
+# Fields stamped on the transactions to keep track of their processing, that are
+# stored but not reported as changes of the transactions
+BOOKKEEPING_FIELDS = {'rules_fingerprint'}
+
+
+def changed_fields(old_transaction, new_transaction):
+    return [
+        field.name for field in fields(new_transaction)
+        if getattr(old_transaction, field.name) != getattr(new_transaction, field.name)
+    ]
+
+
+def update_transactions_bulk(db, old_transactions, new_transactions):
+    """
+        Stores the new version of each transaction that changed, writing all the changed
+        transactions of each collection at once. Returns how many transactions changed,
+        and how many of them changed each field, not counting the bookkeeping fields.
+    """
+    update_many = {
+        BankAccountTransaction: io.update_many_account_transactions,
+        BankCreditCardTransaction: io.update_many_credit_card_transactions
+    }
+    changed_transactions = {TransactionDataclass: [] for TransactionDataclass in update_many}
+    field_changes = Counter()
+    changed = 0
+
+    for old_transaction, new_transaction in zip(old_transactions, new_transactions):
+        fieldnames = changed_fields(old_transaction, new_transaction)
+        if fieldnames:
+            changed_transactions[new_transaction.__class__].append(new_transaction)
+        reported_fieldnames = [fieldname for fieldname in fieldnames if fieldname not in BOOKKEEPING_FIELDS]
+        if reported_fieldnames:
+            changed += 1
+            field_changes.update(reported_fieldnames)
+
+    for TransactionDataclass, transactions in changed_transactions.items():
+        update_many[TransactionDataclass](db, transactions)
+
+    return changed, field_changes
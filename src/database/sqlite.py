@@ -0,0 +1,223 @@
+from collections import namedtuple
+from uuid import uuid1
+
+import json
+import sqlite3
+
+from .indexes import IndexedCursor, check_supported, get_field, matches, sort_key
+
+# Document fields stored on their own indexed column, so queries on them run on SQLite
+COLUMNS = {
+    '_id': '_id',
+    '_seq': 'seq',
+    'account.id': 'account_id',
+    'card.number': 'card_number',
+    'transaction_date.date': 'transaction_date',
+}
+
+SQL_OPERATORS = {
+    '$gte': '>=',
+    '$gt': '>',
+    '$lte': '<=',
+    '$lt': '<',
+}
+
+# SQLite default limit of parameters on a single statement
+MAX_PARAMETERS = 999
+
+InsertOneResult = namedtuple('InsertOneResult', 'inserted_id')
+InsertManyResult = namedtuple('InsertManyResult', 'inserted_ids')
+
+
+def row_values(document):
+    return tuple(get_field(document, path) for path in COLUMNS) + (json.dumps(document),)
+
+
+def generate_id():
+    return uuid1().hex
+
+
+def quoted(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def build_where(query):
+    """
+        Splits a query between the SQL conditions on the indexed columns, and the
+        conditions on other fields, checked on the decoded documents.
+    """
+    conditions = []
+    parameters = []
+    not_indexed = {}
+
+    for path, condition in query.items():
+        column = COLUMNS.get(path)
+        if column is None:
+            not_indexed[path] = condition
+        elif isinstance(condition, dict):
+            for operator, value in condition.items():
+                conditions.append('{} {} ?'.format(column, SQL_OPERATORS[operator]))
+                parameters.append(value)
+        elif condition is None:
+            conditions.append('{} IS NULL'.format(column))
+        else:
+            conditions.append('{} = ?'.format(column))
+            parameters.append(condition)
+
+    return ' AND '.join(conditions) or '1', parameters, not_indexed
+
+
+class SQLiteCollection():
+    """
+        Collection of json documents stored on a SQLite table, with the same interface
+        as the tinymongo collections used by database.io.
+
+        Queries are dicts of (dotted) field paths to either the value the field must be
+        equal to, or a dict of $gt, $gte, $lt and $lte comparisons. Conditions on the
+        fields of COLUMNS run on SQLite, the rest on the decoded documents. Other
+        operators raise UnsupportedQuery, as there's no tinymongo to fall back to.
+    """
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.table = quoted(name)
+
+    def select(self, query):
+        check_supported(query)
+        where, parameters, not_indexed = build_where(query)
+        rows = self.connection.execute(
+            'SELECT document FROM {} WHERE {} ORDER BY position'.format(self.table, where),
+            parameters
+        )
+        documents = (json.loads(row[0]) for row in rows)
+        return [document for document in documents if matches(document, not_indexed)]
+
+    def write(self, statement, rows):
+        with self.connection:
+            self.connection.executemany(statement.format(self.table), rows)
+
+    def find(self, query=None, sort=None):
+        results = self.select(query or {})
+        # Stable sorts over the insertion order, as tinymongo does
+        for path, direction in reversed(sort or []):
+            results.sort(key=sort_key(path, direction), reverse=direction < 0)
+        return IndexedCursor(results)
+
+    def insert_one(self, document):
+        return InsertOneResult(self.insert_many([document]).inserted_ids[0])
+
+    def insert_many(self, documents):
+        documents = [
+            dict(document, _id=document.get('_id') or generate_id())
+            for document in documents
+        ]
+        self.write(
+            'INSERT INTO {{}} ({}, document) VALUES ({}, ?)'.format(
+                ', '.join(COLUMNS.values()),
+                ', '.join('?' * len(COLUMNS))
+            ),
+            map(row_values, documents)
+        )
+        return InsertManyResult([document['_id'] for document in documents])
+
+    def update(self, query, document):
+        updated_documents = []
+        for stored_document in self.select(query):
+            # Stored fields not present in the document are kept, as tinydb does
+            updated_document = dict(stored_document)
+            updated_document.update(document)
+            updated_document['_id'] = stored_document['_id']
+            updated_documents.append(updated_document)
+        self.replace_many(updated_documents)
+
+    def update_many(self, documents):
+        stored_documents = {
+            stored_document['_id']: stored_document
+            for stored_document in self.select_ids([document['_id'] for document in documents])
+        }
+        updated_documents = []
+        for document in documents:
+            if document['_id'] in stored_documents:
+                updated_document = stored_documents[document['_id']]
+                updated_document.update(document)
+                updated_documents.append(updated_document)
+        self.replace_many(updated_documents)
+
+    def replace_many(self, documents):
+        self.write(
+            'UPDATE {{}} SET {}, document = ? WHERE _id = ?'.format(
+                ', '.join('{} = ?'.format(column) for column in COLUMNS.values())
+            ),
+            [row_values(document) + (document['_id'],) for document in documents]
+        )
+
+    def select_ids(self, ids):
+        documents = []
+        for start in range(0, len(ids), MAX_PARAMETERS):
+            chunk = ids[start:start + MAX_PARAMETERS]
+            rows = self.connection.execute(
+                'SELECT document FROM {} WHERE _id IN ({})'.format(self.table, ', '.join('?' * len(chunk))),
+                chunk
+            )
+            documents.extend(json.loads(row[0]) for row in rows)
+        return documents
+
+    def remove(self, query):
+        self.remove_many([document['_id'] for document in self.select(query)])
+
+    def remove_many(self, ids):
+        self.write('DELETE FROM {} WHERE _id = ?', [(_id,) for _id in ids])
+
+
+class SQLiteDatabase():
+    """
+        Database stored on a single SQLite file, one table per collection.
+
+        The connection can only be used from the thread that opened it, so each thread
+        loads its own database, and closes it when done (or uses it as a context manager).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename, check_same_thread=True)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.collections = {}
+
+    def __getattr__(self, collection_name):
+        if collection_name.startswith('_'):
+            raise AttributeError(collection_name)
+        if collection_name not in self.collections:
+            self.create_table(collection_name)
+            self.collections[collection_name] = SQLiteCollection(self.connection, collection_name)
+        return self.collections[collection_name]
+
+    def create_table(self, collection_name):
+        table = quoted(collection_name)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} (position INTEGER PRIMARY KEY, {}, document TEXT NOT NULL)'.format(
+                    table,
+                    ', '.join(column + (' TEXT UNIQUE NOT NULL' if column == '_id' else '') for column in COLUMNS.values())
+                )
+            )
+            for columns in [('account_id', 'seq'), ('card_number', 'seq'), ('transaction_date',)]:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+                    quoted('{}_{}'.format(collection_name, '_'.join(columns))),
+                    table,
+                    ', '.join(columns)
+                ))
+
+    def data_version(self):
+        """
+            Changes each time another connection commits changes to the database.
+        """
+        return self.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
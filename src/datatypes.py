@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field, is_dataclass
+from datetime import datetime
 from enum import Enum, EnumMeta
 
 
@@ -39,6 +40,7 @@ class NotificationsConfig:
 class SchedulerConfig:
     scrapping_hours: list
     update_timeout_seconds: int
+    max_parallel_banks: int = 1
 
 
 @dataclass
@@ -73,6 +75,7 @@ class BankConfig:
     username: str
     password: str
     accounts: list
+    transaction_codes: dict = None
 
 
 @dataclass
@@ -272,6 +275,7 @@ class BankCreditCardTransaction():
     status_flags: StatusFlags = field(default_factory=StatusFlags)
     subtransactions: list = field(default_factory=list)
     related: RelatedTransaction = None
+    rules_fingerprint: str = None
     _id: str = None
     _seq: int = None
 
@@ -299,6 +303,7 @@ class BankAccountTransaction():
     subtransactions: list = field(default_factory=list)
     related: RelatedTransaction = None
     offset: RelatedTransaction = None
+    rules_fingerprint: str = None
     _id: str = None
     _seq: int = None
 
@@ -326,5 +331,17 @@ class LocalAccountTransaction():
     _seq: int = None
 
 
+@dataclass
+class TransactionsSummary:
+    collection: str
+    grouping_id: str
+    count: int = 0
+    last_seq: int = None
+    last_transaction_date: datetime = None
+    last_balance: float = None
+    last_id: str = None
+    _id: str = None
+
+
 DATACLASSES = list(filter(lambda obj: is_dataclass(obj), locals().values()))
 ENUMS = list(filter(lambda obj: isinstance(obj, EnumMeta), locals().values()))
@@ -1 +1 @@
-from .runtime import load, apply
+from .runtime import load, apply, apply_iter, apply_incremental, profile
@@ -0,0 +1,289 @@
+from dataclasses import fields, is_dataclass
+from enum import Enum
+from functools import partial
+
+from .domain import AND, OR
+from .domain import MatchCondition
+
+import hashlib
+import re
+
+SCAN_PREFIXES = {
+    'match': '',
+    'search': '(?s:.*?)'
+}
+
+# Patterns referring to their own groups by number or name can't be combined with others
+SELF_REFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class CompiledRules():
+    """
+        Rules indexed by the conditions every transaction they match has to meet,
+        so only the rules that could match a transaction get their conditions checked:
+
+            - The type a transaction needs to have (a Match/MatchAny on the type field)
+            - The keywords a transaction needs to include, any of them (a Match/MatchAll/
+              MatchAny on the keywords field)
+
+        Iterating it yields all the rules, in their original order, so it can be used
+        anywhere a list of rules is expected. It also knows which rules read each field,
+        so only those need their conditions checked again when the field changes.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+
+        rules_by_type = {}
+        untyped_rules = []
+        self.keyword_index = {}
+        self.without_keywords = set()
+        self.readers = {}
+        self.reading_anything = set()
+
+        for position, rule in enumerate(self.rules):
+            for fieldname in read_fields(rule):
+                if fieldname is None:
+                    self.reading_anything.add(position)
+                else:
+                    self.readers.setdefault(fieldname, set()).add(position)
+
+            types = required_values(rule, 'type')
+            if types is None:
+                untyped_rules.append(position)
+            else:
+                for transaction_type in types:
+                    rules_by_type.setdefault(transaction_type, []).append(position)
+
+            keywords = required_values(rule, 'keywords')
+            if keywords is None:
+                self.without_keywords.add(position)
+            else:
+                for keyword in keywords:
+                    self.keyword_index.setdefault(keyword, set()).add(position)
+
+        self.untyped_rules = untyped_rules
+        self.scanners = build_scanners(self.rules)
+        self._hashes = None
+        self.rules_by_type = {
+            transaction_type: sorted(set(positions + untyped_rules))
+            for transaction_type, positions in rules_by_type.items()
+        }
+
+    @property
+    def hashes(self):
+        """
+            Hash of each rule content, the same on every run as long as the rule isn't changed
+        """
+        if self._hashes is None:
+            self._hashes = [rule_hash(rule) for rule in self.rules]
+        return self._hashes
+
+    @property
+    def fingerprint(self):
+        return ruleset_fingerprint(self.hashes)
+
+    def scans(self):
+        return TransactionScans(self.scanners)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def type_candidates(self, transaction):
+        try:
+            return self.rules_by_type.get(transaction.type, self.untyped_rules)
+        except TypeError:
+            # Unhashable values can't be looked up, so any rule could match
+            return range(len(self.rules))
+
+    def candidate_positions(self, transaction):
+        keywords = transaction.keywords
+        if not isinstance(keywords, list):
+            return list(self.type_candidates(transaction))
+
+        with_keywords = set()
+        for keyword in keywords:
+            with_keywords.update(self.keyword_index.get(keyword, ()))
+
+        return [
+            position
+            for position in self.type_candidates(transaction)
+            if position in self.without_keywords or position in with_keywords
+        ]
+
+    def candidates(self, transaction):
+        """
+            Rules that may match the transaction, in their original order.
+        """
+        return [self.rules[position] for position in self.candidate_positions(transaction)]
+
+    def reading(self, fieldnames):
+        """
+            Positions of the rules with conditions reading any of the fields.
+        """
+        positions = set(self.reading_anything)
+        for fieldname in fieldnames:
+            positions.update(self.readers.get(fieldname, ()))
+        return positions
+
+
+class PatternScanner():
+    """
+        Checks all the patterns used on a field with a single regex scan. Each pattern
+        becomes an optional lookahead at the start of the string, captured on its own
+        named group, so the groups that captured anything are the patterns that matched.
+    """
+
+    def __init__(self, patterns, mode):
+        self.patterns = {'pattern{}'.format(number): pattern for number, pattern in enumerate(patterns)}
+        self.regex = re.compile(
+            ''.join(
+                '(?:(?=(?P<{}>{}(?:{}))))?'.format(name, SCAN_PREFIXES[mode], pattern)
+                for name, pattern in self.patterns.items()
+            ),
+            re.IGNORECASE
+        )
+        self.pattern_set = set(patterns)
+
+    def matching(self, value):
+        return {
+            self.patterns[name]
+            for name, captured in self.regex.match(value).groupdict().items()
+            if captured is not None
+        }
+
+
+class TransactionScans():
+    """
+        Results of the scanners over the fields of the transaction being processed.
+    """
+
+    def __init__(self, scanners):
+        self.scanners = scanners
+        self.results = {}
+
+    def matching(self, condition, field_value):
+        scanner = self.scanners.get((condition.fieldname, condition.regex))
+        if scanner is None or not scanner.pattern_set.issuperset(condition.values):
+            return None
+
+        key = (condition.fieldname, condition.regex, field_value)
+        if key not in self.results:
+            self.results[key] = scanner.matching(field_value)
+        return self.results[key]
+
+
+def build_scanners(rules):
+    patterns_by_field = {}
+    for rule in rules:
+        for condition in rule.conditions:
+            if isinstance(condition, MatchCondition) and condition.regex in SCAN_PREFIXES:
+                patterns = patterns_by_field.setdefault((condition.fieldname, condition.regex), [])
+                patterns.extend(
+                    value for value in condition.values
+                    if value not in patterns and not SELF_REFERENCE.search(value)
+                )
+
+    scanners = {}
+    for (fieldname, mode), patterns in patterns_by_field.items():
+        try:
+            scanners[(fieldname, mode)] = PatternScanner(patterns, mode)
+        except re.error:
+            # Patterns that don't compile together (as with repeated group names)
+            # are checked one by one
+            pass
+    return scanners
+
+
+def describe(value):
+    """
+        Text representation of the parts of a rule that is the same on every run,
+        unlike the default repr of functions, that includes their memory address.
+    """
+    if is_dataclass(value) and not isinstance(value, type):
+        return '{}({})'.format(
+            value.__class__.__name__,
+            ', '.join(describe(getattr(value, field.name)) for field in fields(value))
+        )
+    if isinstance(value, partial):
+        return 'partial({})'.format(', '.join(map(describe, (value.func,) + value.args)))
+    if isinstance(value, (list, tuple)):
+        return '[{}]'.format(', '.join(map(describe, value)))
+    if isinstance(value, re.Pattern):
+        return 're({!r}, {})'.format(value.pattern, value.flags)
+    if isinstance(value, Enum):
+        return repr(value)
+    if callable(value):
+        name = '{}.{}'.format(getattr(value, '__module__', ''), getattr(value, '__qualname__', ''))
+        code = getattr(value, '__code__', None)
+        if code is None:
+            return name
+        # Lambdas are only told apart by their code
+        return '{}:{}:{}'.format(
+            name,
+            code.co_code.hex(),
+            describe([constant for constant in code.co_consts if not hasattr(constant, 'co_code')])
+        )
+    return repr(value)
+
+
+def rule_hash(rule):
+    return hashlib.sha1(describe(rule).encode('utf-8')).hexdigest()
+
+
+def ruleset_fingerprint(hashes):
+    return hashlib.sha1(':'.join(hashes).encode('utf-8')).hexdigest()
+
+
+def added_rules(compiled_rules, previous_hashes):
+    """
+        Rules not found on a previous version of the rules set, as the ones added or
+        edited since then. Removed rules can't change a transaction the previous rules
+        already processed, but None is returned if the kept rules were reordered, as
+        then any transaction could change.
+    """
+    current = set(compiled_rules.hashes)
+    previous = set(previous_hashes)
+    kept = [rule_hash for rule_hash in compiled_rules.hashes if rule_hash in previous]
+    if kept != [rule_hash for rule_hash in previous_hashes if rule_hash in current]:
+        return None
+    return CompiledRules(
+        rule for rule, rule_hash in zip(compiled_rules.rules, compiled_rules.hashes)
+        if rule_hash not in previous
+    )
+
+
+def read_fields(rule):
+    """
+        Transaction fields read by the conditions of a rule, only the first level
+        of nested fields. None stands for conditions that could read any field.
+    """
+    return {
+        condition.fieldname.split('.')[0] if isinstance(getattr(condition, 'fieldname', None), str) else None
+        for condition in rule.conditions
+    }
+
+
+def required_values(rule, fieldname):
+    """
+        Values a rule requires on a field, as in, the rule can only match transactions
+        having any of them on the field. None if the rule has no such requirement.
+    """
+    for condition in rule.conditions:
+        if not isinstance(condition, MatchCondition) or condition.fieldname != fieldname:
+            continue
+        if condition.regex or not condition.values:
+            continue
+        if condition.operator is AND:
+            # Every value is required, so any of them is enough to index the rule
+            return condition.values[:1]
+        if condition.operator is OR:
+            return list(condition.values)
+    return None
+
+
+def compile_rules(rules):
+    return CompiledRules(rules)
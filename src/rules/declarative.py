@@ -0,0 +1,130 @@
+"""
+    Rules defined on a YAML (or JSON) file, as a list of rules with the same conditions
+    and actions available on rules.io:
+
+        - conditions:
+            - match: {field: type, value: PURCHASE}
+            - match_any: {field: destination, values: [Amazon, Amzn], regex: search}
+            - match_numeric: {field: amount, value: 500, operator: gt, absolute: true}
+          actions:
+            - set: {field: category, value: supermercat}
+            - set_from_capture: {field: comment, source: details.concept, regex: '\\/([^\\/]+)$'}
+            - add: {field: tags, values: [online]}
+
+    Values of the type field are TransactionType names, and values of the category field
+    are category ids.
+"""
+
+from hashlib import sha1
+
+import os
+import threading
+import yaml
+
+from datatypes import TransactionType
+
+from .compiler import compile_rules
+from .domain import Rule
+from .io import Match, MatchAll, MatchAny, MatchNumeric
+from .io import Set, SetFromCapture, Add
+
+# Compiled rules of each rules file, with the stamp and hash of the files they were built from
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+class RulesFileError(Exception):
+    pass
+
+
+def convert_value(fieldname, value, categories):
+    if value is None:
+        return None
+    if fieldname == 'type':
+        try:
+            return TransactionType[value]
+        except KeyError:
+            raise RulesFileError('Unknown transaction type "{}"'.format(value))
+    if fieldname == 'category':
+        try:
+            return categories[value]
+        except KeyError:
+            raise RulesFileError('Unknown category "{}"'.format(value))
+    return value
+
+
+def parse_condition(raw_condition, categories):
+    (kind, arguments), = raw_condition.items()
+    fieldname = arguments['field']
+
+    def values():
+        return [convert_value(fieldname, value, categories) for value in arguments['values']]
+
+    if kind == 'match':
+        return Match(fieldname, convert_value(fieldname, arguments['value'], categories), regex=arguments.get('regex'))
+    if kind == 'match_all':
+        return MatchAll(fieldname, *values(), regex=arguments.get('regex'))
+    if kind == 'match_any':
+        return MatchAny(fieldname, *values(), regex=arguments.get('regex'))
+    if kind == 'match_numeric':
+        return MatchNumeric(fieldname, arguments['value'], arguments['operator'], arguments.get('absolute', False))
+    raise RulesFileError('Unknown condition "{}"'.format(kind))
+
+
+def parse_action(raw_action, categories):
+    (kind, arguments), = raw_action.items()
+    fieldname = arguments['field']
+
+    if kind == 'set':
+        return Set(fieldname, convert_value(fieldname, arguments['value'], categories))
+    if kind == 'set_from_capture':
+        return SetFromCapture(fieldname, arguments['source'], arguments['regex'], arguments.get('capture_group', 0))
+    if kind == 'add':
+        return Add(fieldname, *arguments['values'])
+    raise RulesFileError('Unknown action "{}"'.format(kind))
+
+
+def parse_rules(raw_rules, categories):
+    rules = []
+    for position, raw_rule in enumerate(raw_rules):
+        try:
+            rules.append(Rule(
+                conditions=[parse_condition(raw_condition, categories) for raw_condition in raw_rule.get('conditions', [])],
+                actions=[parse_action(raw_action, categories) for raw_action in raw_rule.get('actions', [])]
+            ))
+        except RulesFileError as exc:
+            raise RulesFileError('Rule #{}: {}'.format(position, exc))
+        except (KeyError, TypeError, ValueError, AttributeError) as exc:
+            raise RulesFileError('Rule #{} is malformed: {!r}'.format(position, exc))
+    return rules
+
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_rules_file(filename, categories_filename, load_categories):
+    """
+        Compiled rules from a rules file. While the rules and categories files are not
+        modified, the same compiled rules are returned without reading them. Changed
+        files are hashed, and only compiled again if their content changed.
+    """
+    stamp = (file_stamp(filename), file_stamp(categories_filename))
+
+    with _loaded_lock:
+        loaded_stamp, loaded_hash, compiled_rules = _loaded.get(filename, (None, None, None))
+        if loaded_stamp == stamp:
+            return compiled_rules
+
+        with open(filename, 'rb') as rules_file:
+            content = rules_file.read()
+        with open(categories_filename, 'rb') as categories_file:
+            content_hash = sha1(content + b'\0' + categories_file.read()).hexdigest()
+
+        if content_hash != loaded_hash:
+            raw_rules = yaml.safe_load(content) or []
+            compiled_rules = compile_rules(parse_rules(raw_rules, load_categories(categories_filename)))
+
+        _loaded[filename] = (stamp, content_hash, compiled_rules)
+        return compiled_rules
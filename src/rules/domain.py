@@ -26,6 +26,7 @@ class MatchCondition(RuleCondition):
     values: list
     operator: object
     regex: str = None
+    patterns: list = None
 
 
 @dataclass
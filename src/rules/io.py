@@ -1,5 +1,4 @@
-from itertools import chain
-from functools import partial, reduce
+from functools import lru_cache, partial, reduce
 from copy import deepcopy
 
 import operator as operator_module
@@ -9,6 +8,7 @@ from common.logging import get_logger
 from . import domain
 from .domain import AND, OR
 from .domain import MatchCondition, MatchNumericCondition, ValueSetter, ValueAdder
+from .compiler import CompiledRules
 
 import datatypes
 import re
@@ -16,47 +16,60 @@ import re
 
 logger = get_logger(name='rules')
 
+
+def unchanged(value):
+    return value
+
+
 FIELD_WRAPPERS = {
     'source': datatypes.Issuer,
     'destination': datatypes.Recipient,
-    'category': lambda x: x
+    'category': unchanged
 }
 
 DEFAULT_FIELD_WRAPPER = str
 
 
+# Actions are built from module level functions, so rules can be pickled
+# and sent to other processes
+
+def constant_value(value, transaction):
+    return value
+
+
+def capture_value(source, regex, capture_group, transaction):
+    field = get_nested_item(transaction, source)
+    if isinstance(field, datatypes.TransactionSubject):
+        source_value = field.name
+    elif isinstance(field, datatypes.UnknownSubject):
+        return False
+    else:
+        source_value = field
+
+    match = regex.search(source_value)
+    if match:
+        try:
+            return match.groups()[capture_group]
+        except IndexError:
+            return source_value
+    else:
+        return source_value
+
+
 def Set(fieldname, value):
 
     return ValueSetter(
         fieldname,
-        lambda _: value,
+        partial(constant_value, value),
         FIELD_WRAPPERS.get(fieldname, DEFAULT_FIELD_WRAPPER)
     )
 
 
 def SetFromCapture(fieldname, source, regex, capture_group=0):
 
-    def capture_value(source, regex, transaction):
-        field = get_nested_item(transaction, source)
-        if isinstance(field, datatypes.TransactionSubject):
-            source_value = field.name
-        elif isinstance(field, datatypes.UnknownSubject):
-            return False
-        else:
-            source_value = field
-
-        match = re.search(regex, source_value, re.IGNORECASE)
-        if match:
-            try:
-                return match.groups()[capture_group]
-            except IndexError:
-                return source_value
-        else:
-            return source_value
-
     return ValueSetter(
         fieldname,
-        partial(capture_value, source, regex),
+        partial(capture_value, source, compile_pattern(regex), capture_group),
         FIELD_WRAPPERS.get(fieldname, DEFAULT_FIELD_WRAPPER)
     )
 
@@ -72,8 +85,37 @@ def mark_field_changed(transaction, field):
     setattr(transaction.flags, field, datatypes.DataOrigin.RULES)
 
 
-def _run_ValueSetter(action, transaction):
-    transaction_copy = deepcopy(transaction)
+class FieldChanges():
+    """
+        Keeps the value (and modified flag) each field had before the first action
+        that writes it, to tell afterwards which fields actually changed.
+    """
+
+    def __init__(self, transaction):
+        self.transaction = transaction
+        self.previous = {}
+
+    def before_writing(self, field):
+        if field not in self.previous:
+            self.previous[field] = (
+                deepcopy(getattr(self.transaction, field)),
+                getattr(self.transaction.flags, field, None)
+            )
+
+    def changed_fields(self):
+        changed = set()
+        for field, (value, flag) in self.previous.items():
+            if getattr(self.transaction, field) != value:
+                changed.add(field)
+            if getattr(self.transaction.flags, field, None) != flag:
+                changed.add('flags')
+        return changed
+
+
+def set_value(action, transaction, changes=None):
+    """
+        Runs a ValueSetter action on the transaction itself
+    """
     try:
         raw_value = action.get_value(transaction)
         if isinstance(raw_value, str):
@@ -82,42 +124,65 @@ def _run_ValueSetter(action, transaction):
             value = raw_value
     except (KeyError, AttributeError, TypeError) as exc:
         print('WARNING: Failed to run action {} "{}": {}'.format(action.__class__.__name__, action.fieldname, exc.__repr__()))
-        return transaction_copy
+        return transaction
     wrapped = action.wrap(value)
-    setattr(transaction_copy, action.fieldname, wrapped)
-    mark_field_changed(transaction_copy, action.fieldname)
-    return transaction_copy
-
-
-def _run_ValueAdder(action, transaction):
-    transaction_copy = deepcopy(transaction)
+    if changes is not None:
+        changes.before_writing(action.fieldname)
+    setattr(transaction, action.fieldname, wrapped)
+    mark_field_changed(transaction, action.fieldname)
+    return transaction
+
+
+def add_values(action, transaction, changes=None):
+    """
+        Runs a ValueAdder action on the transaction itself
+    """
+    if changes is not None:
+        changes.before_writing(action.fieldname)
     for value in action.values:
-        field_list = getattr(transaction_copy, action.fieldname)
+        field_list = getattr(transaction, action.fieldname)
         if value not in field_list:
             field_list.append(value)
 
-    mark_field_changed(transaction_copy, action.fieldname)
-    return transaction_copy
+    mark_field_changed(transaction, action.fieldname)
+    return transaction
 
 
-def run_action(transaction, action):
+def _run_ValueSetter(action, transaction):
+    return set_value(action, deepcopy(transaction))
+
+
+def _run_ValueAdder(action, transaction):
+    return add_values(action, deepcopy(transaction))
+
+
+def run_action(transaction, action, changes=None):
     if isinstance(action, domain.ValueSetter):
-        return _run_ValueSetter(action, transaction)
+        return set_value(action, transaction, changes)
 
     if isinstance(action, domain.ValueAdder):
-        return _run_ValueAdder(action, transaction)
+        return add_values(action, transaction, changes)
+
+
+@lru_cache(maxsize=None)
+def compile_pattern(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def compile_patterns(values, regex):
+    return [compile_pattern(value) for value in values] if regex else None
 
 
 def Match(fieldname, value, regex=None):
-    return MatchCondition(fieldname, [value], AND, regex)
+    return MatchCondition(fieldname, [value], AND, regex, compile_patterns([value], regex))
 
 
 def MatchAll(fieldname, *values, regex=None):
-    return MatchCondition(fieldname, values, AND, regex)
+    return MatchCondition(fieldname, values, AND, regex, compile_patterns(values, regex))
 
 
 def MatchAny(fieldname, *values, regex=None):
-    return MatchCondition(fieldname, values, OR, regex)
+    return MatchCondition(fieldname, values, OR, regex, compile_patterns(values, regex))
 
 
 def MatchNumeric(fieldname, value, operator, absolute=False):
@@ -142,7 +207,23 @@ def _check_MatchNumericCondition(condition, transaction):
     return condition.operator(field_value, condition.value)
 
 
-def _check_MatchCondition(condition, transaction):
+def matched_patterns(condition, field_value, scans=None):
+    """
+        Values of a regex condition whose pattern matches the field value. The scans
+        of a compiled rules set check all the patterns on a field at once, otherwise
+        each pattern is checked on its own.
+    """
+    matched = scans.matching(condition, field_value) if scans is not None else None
+    if matched is None:
+        patterns = condition.patterns or compile_patterns(condition.values, condition.regex)
+        matched = {
+            pattern.pattern for pattern in patterns
+            if getattr(pattern, condition.regex)(field_value)
+        }
+    return matched
+
+
+def _check_MatchCondition(condition, transaction, scans=None):
     field = get_nested_item(transaction, condition.fieldname)
     if isinstance(field, datatypes.TransactionSubject):
         field_value = field.name
@@ -163,16 +244,10 @@ def _check_MatchCondition(condition, transaction):
             value == field_value
         )
 
-    def match(ok, value):
+    def regex_matched(ok, value):
         return condition.operator(
             ok,
-            bool(re.match(value, field_value, re.IGNORECASE))
-        )
-
-    def search(ok, value):
-        return condition.operator(
-            ok,
-            bool(re.search(value, field_value, re.IGNORECASE))
+            value in matched
         )
 
     if isinstance(field_value, list):
@@ -182,10 +257,9 @@ def _check_MatchCondition(condition, transaction):
     # Cannot do a regex on a None
     elif field_value is None:
         return False
-    if condition.regex == 'search':
-        value_checker = search
-    elif condition.regex == 'match':
-        value_checker = match
+    if condition.regex in ('search', 'match'):
+        matched = matched_patterns(condition, field_value, scans)
+        value_checker = regex_matched
 
     return reduce(
         value_checker,
@@ -194,39 +268,81 @@ def _check_MatchCondition(condition, transaction):
     )
 
 
-def check_condition(transaction, condition):
+def check_condition(transaction, condition, scans=None):
     if isinstance(condition, domain.MatchCondition):
-        return _check_MatchCondition(condition, transaction)
+        return _check_MatchCondition(condition, transaction, scans)
     if isinstance(condition, domain.MatchNumericCondition):
         return _check_MatchNumericCondition(condition, transaction)
 
 
-def matching_rules(user_rules, transaction):
-    for rule in user_rules:
-        if all(map(partial(check_condition, transaction), rule.conditions)):
-            yield rule
+def rule_matches(rule, transaction, scans=None):
+    return all(map(partial(check_condition, transaction, scans=scans), rule.conditions))
 
 
-def apply_rules_to_transaction(user_rules, transaction):
-    def process(transaction):
-        return reduce(
-            run_action,
-            chain.from_iterable(
-                (rule.actions for rule in matching_rules(user_rules, transaction))
-            ),
-            transaction
-        )
-    original_transaction = transaction
-    updated_transaction = process(original_transaction)
+def matching_rules(user_rules, transaction):
+    scans = None
+    if isinstance(user_rules, CompiledRules):
+        scans = user_rules.scans()
+        user_rules = user_rules.candidates(transaction)
 
-    needs_reprocessing = original_transaction != updated_transaction
-    # We need to reprocess all rules for a transaction in case any
-    # action has been executed, as maybe now some other rules needs
-    # to be applied. The stop poing is when after processing, no changes are detected.
+    for rule in user_rules:
+        if rule_matches(rule, transaction, scans):
+            yield rule
 
-    while needs_reprocessing:
-        original_transaction = updated_transaction
-        updated_transaction = process(original_transaction)
-        needs_reprocessing = original_transaction != updated_transaction
 
-    return updated_transaction
+def matching_positions(compiled_rules, transaction, positions=None, profile=None):
+    scans = compiled_rules.scans()
+    candidates = compiled_rules.candidate_positions(transaction)
+    if positions is not None:
+        candidates = positions.intersection(candidates)
+
+    if profile is not None:
+        check = partial(check_condition, transaction, scans=scans)
+        return {position for position in candidates if profile.check_rule(position, check)}
+
+    return {
+        position for position in candidates
+        if rule_matches(compiled_rules.rules[position], transaction, scans)
+    }
+
+
+def apply_rules_to_transaction(user_rules, transaction, profile=None):
+    """
+        Runs the actions of the matching rules over a single copy of the transaction.
+        As actions may make other rules match (or stop matching), the rules are run
+        again until a pass changes nothing, but only the rules whose conditions read
+        a field changed on the previous pass get their conditions checked again.
+
+        The rules must be already compiled, as compiling them takes longer than running
+        them on a transaction. A rules.profiling.RulesProfile of the same rules collects
+        the run counters.
+    """
+    if not isinstance(user_rules, CompiledRules):
+        raise TypeError('Rules must be compiled with rules.compiler.compile_rules before applying them')
+
+    matched = matching_positions(user_rules, transaction, profile=profile)
+    passes = 0
+
+    if matched:
+        transaction = deepcopy(transaction)
+
+    while matched:
+        passes += 1
+        changes = FieldChanges(transaction)
+        for position in sorted(matched):
+            if profile is not None:
+                profile.actions_run(position)
+            for action in user_rules.rules[position].actions:
+                run_action(transaction, action, changes)
+
+        changed_fields = changes.changed_fields()
+        if not changed_fields:
+            break
+
+        # The conditions of the rules not reading any changed field give the same result
+        outdated = user_rules.reading(changed_fields)
+        matched = (matched - outdated) | matching_positions(user_rules, transaction, outdated, profile)
+
+    if profile is not None:
+        profile.transaction_processed(passes)
+    return transaction
@@ -0,0 +1,135 @@
+from time import perf_counter
+
+from .domain import OR
+from .domain import MatchCondition, MatchNumericCondition, ValueSetter, ValueAdder
+
+
+def describe_condition(condition):
+    if isinstance(condition, MatchCondition):
+        values = ', '.join(getattr(value, 'name', str(value)) for value in condition.values)
+        return '{} {} {}{}'.format(
+            condition.fieldname,
+            'matches' if condition.regex else 'is',
+            values if len(condition.values) == 1 else '{} of [{}]'.format(
+                'any' if condition.operator is OR else 'all',
+                values
+            ),
+            ' ({})'.format(condition.regex) if condition.regex else ''
+        )
+    if isinstance(condition, MatchNumericCondition):
+        return '{}{} {} {}'.format(
+            condition.fieldname,
+            ' (absolute)' if condition.absolute else '',
+            condition.operator.__name__,
+            condition.value
+        )
+    return condition.__class__.__name__
+
+
+def describe_action(action):
+    if isinstance(action, ValueSetter):
+        return 'set {}'.format(action.fieldname)
+    if isinstance(action, ValueAdder):
+        return 'add {} to {}'.format(', '.join(map(str, action.values)), action.fieldname)
+    return action.__class__.__name__
+
+
+class RulesProfile():
+    """
+        Counters of a rules run, collected by the rules.io functions when they get a
+        profile: how many times each rule and condition was checked, matched, and the
+        time spent on it, how many passes ran the actions of each rule, and how many
+        passes each transaction needed until no rule changed it.
+
+        Conditions are checked in order until one fails, so the later conditions of a
+        rule are checked less times than the rule.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.transactions = 0
+        self.passes = 0
+        self.max_passes = 0
+        self.rule_stats = [RuleStats(rule) for rule in self.rules]
+
+    def check_rule(self, position, check_condition):
+        stats = self.rule_stats[position]
+        rule_start = perf_counter()
+        matched = True
+        for condition_stats in stats.conditions:
+            start = perf_counter()
+            matched = bool(check_condition(condition_stats.condition))
+            condition_stats.record(matched, perf_counter() - start)
+            if not matched:
+                break
+        stats.record(matched, perf_counter() - rule_start)
+        return matched
+
+    def actions_run(self, position):
+        self.rule_stats[position].action_passes += 1
+
+    def transaction_processed(self, passes):
+        self.transactions += 1
+        self.passes += passes
+        self.max_passes = max(self.max_passes, passes)
+
+    def as_dict(self):
+        return {
+            'transactions': self.transactions,
+            'passes': self.passes,
+            'max_passes': self.max_passes,
+            'rules': [
+                dict(position=position, **stats.as_dict())
+                for position, stats in enumerate(self.rule_stats)
+            ]
+        }
+
+
+class Stats():
+
+    def __init__(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.time = 0.0
+
+    def record(self, matched, elapsed):
+        self.evaluations += 1
+        self.matches += matched
+        self.time += elapsed
+
+    def as_dict(self):
+        return {
+            'evaluations': self.evaluations,
+            'matches': self.matches,
+            'time': self.time
+        }
+
+
+class ConditionStats(Stats):
+
+    def __init__(self, condition):
+        super().__init__()
+        self.condition = condition
+        self.description = describe_condition(condition)
+
+    def as_dict(self):
+        return dict(description=self.description, **super().as_dict())
+
+
+class RuleStats(Stats):
+
+    def __init__(self, rule):
+        super().__init__()
+        self.conditions = [ConditionStats(condition) for condition in rule.conditions]
+        self.description = ' & '.join(condition.description for condition in self.conditions)
+        self.actions = ', '.join(map(describe_action, rule.actions))
+        self.action_passes = 0
+
+    def as_dict(self):
+        return dict(
+            description=self.description,
+            actions=self.actions,
+            action_passes=self.action_passes,
+            conditions=[condition.as_dict() for condition in self.conditions],
+            **super().as_dict()
+        )
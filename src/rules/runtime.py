@@ -1,20 +1,189 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
 from functools import partial
 
-from .io import apply_rules_to_transaction
+import os
+import pickle
 
+from .compiler import CompiledRules, added_rules, compile_rules
+from .io import apply_rules_to_transaction, matching_positions
+from .declarative import load_rules_file
+from .profiling import RulesProfile
 
-def apply(rules, transactions):
-    return list(
-        map(
-            partial(
-                apply_rules_to_transaction,
-                rules
-            ),
-            transactions
-        )
+# Below this amount of transactions, starting the workers takes longer than applying the rules
+PARALLEL_MIN_TRANSACTIONS = 2000
+CHUNK_SIZE = 500
+
+# Rules set of each worker process, received once when the worker starts
+_worker_rules = None
+
+# Compiled rules of the rules.user module
+_user_rules = None
+
+
+def apply_serial(rules, transactions):
+    return list(apply_iter(rules, transactions))
+
+
+def apply_iter(rules, transactions):
+    """
+        Lazy version of apply, running the rules on each transaction as it's consumed,
+        to process transactions streamed from other generators.
+    """
+    if not isinstance(rules, CompiledRules):
+        rules = compile_rules(rules)
+
+    return map(
+        partial(
+            apply_rules_to_transaction,
+            rules
+        ),
+        transactions
     )
 
 
+def init_worker(pickled_rules):
+    global _worker_rules
+    _worker_rules = pickle.loads(pickled_rules)
+
+
+def apply_to_chunk(documents):
+    """
+        Runs on the workers. Transactions come and go encoded as database documents,
+        that are much cheaper to transfer than the dataclasses, and only the ones the
+        rules changed are sent back, with their position on the chunk.
+    """
+    from database.io import decode_object, encode_object
+
+    processed = []
+    for position, document in enumerate(documents):
+        transaction = decode_object(document)
+        processed_transaction = apply_rules_to_transaction(_worker_rules, transaction)
+        if processed_transaction != transaction:
+            processed.append((position, encode_object(processed_transaction)))
+    return processed
+
+
+def chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def pickle_rules(rules):
+    if not isinstance(rules, CompiledRules):
+        rules = compile_rules(rules)
+    try:
+        return pickle.dumps(rules)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return None
+
+
+def apply_parallel(pickled_rules, transactions, workers, chunk_size=None):
+    from database.io import decode_object, encode_object
+
+    chunk_size = chunk_size or CHUNK_SIZE
+    documents = [encode_object(transaction) for transaction in transactions]
+    processed_transactions = list(transactions)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(pickled_rules,)) as executor:
+        # map yields the results of the chunks in the order they were sent
+        processed_chunks = executor.map(apply_to_chunk, chunks(documents, chunk_size))
+        for chunk_start, processed in zip(range(0, len(documents), chunk_size), processed_chunks):
+            for position, document in processed:
+                processed_transactions[chunk_start + position] = decode_object(document)
+
+    return processed_transactions
+
+
+def apply(rules, transactions, workers=1):
+    """
+        Applies the rules to each transaction, returning the processed transactions in
+        the same order. With more than one worker, big sets of transactions are split
+        in chunks processed on a pool of processes. Rules that can't be sent to other
+        processes (as the ones with actions built from lambdas) are always applied here.
+    """
+    if not isinstance(rules, CompiledRules):
+        rules = compile_rules(rules)
+
+    transactions = list(transactions)
+    if workers > 1 and len(transactions) >= PARALLEL_MIN_TRANSACTIONS:
+        pickled_rules = pickle_rules(rules)
+        if pickled_rules is not None:
+            return apply_parallel(pickled_rules, transactions, workers)
+    return apply_serial(rules, transactions)
+
+
+def apply_incremental(rules, transactions, rulesets, workers=1):
+    """
+        Applies the rules only to the transactions that could change since they were
+        processed, stamping all of them with the fingerprint of the rules set:
+
+            - Transactions processed by an unknown rules set, or by one with the rules
+              the current ones kept in a different order, get all the rules applied
+            - Transactions processed by an older version, if any of the added or edited
+              rules matches them (otherwise the result would be the same they already have)
+
+        rulesets maps the fingerprints of the known rules sets to their rule hashes.
+        Returns the transactions in the same order, the untouched ones as they were.
+    """
+    if not isinstance(rules, CompiledRules):
+        rules = compile_rules(rules)
+
+    transactions = list(transactions)
+    current_fingerprint = rules.fingerprint
+    new_rules_by_fingerprint = {}
+    stale = []
+    restamped = []
+
+    for position, transaction in enumerate(transactions):
+        fingerprint = transaction.rules_fingerprint
+        if fingerprint == current_fingerprint:
+            continue
+
+        if fingerprint not in new_rules_by_fingerprint:
+            new_rules_by_fingerprint[fingerprint] = added_rules(rules, rulesets[fingerprint]) if fingerprint in rulesets else None
+        new_rules = new_rules_by_fingerprint[fingerprint]
+
+        if new_rules is None or matching_positions(new_rules, transaction):
+            stale.append(position)
+        else:
+            restamped.append(position)
+
+    processed_transactions = list(transactions)
+    processed_stale = apply(rules, [transactions[position] for position in stale], workers=workers)
+    for position, transaction in zip(stale + restamped, processed_stale + [transactions[position] for position in restamped]):
+        processed_transactions[position] = replace(transaction, rules_fingerprint=current_fingerprint)
+
+    return processed_transactions
+
+
+def profile(rules, transactions):
+    """
+        Applies the rules to the transactions, one by one on this process, collecting
+        the counters of each rule and condition.
+    """
+    if not isinstance(rules, CompiledRules):
+        rules = compile_rules(rules)
+
+    rules_profile = RulesProfile(rules)
+    for transaction in transactions:
+        apply_rules_to_transaction(rules, transaction, profile=rules_profile)
+    return rules_profile
+
+
 def load():
-    from rules.user import _rules
-    return _rules
+    """
+        Rules from the rules file, if there's one, or otherwise from the rules.user
+        module. The compiled rules are kept, and only built again when the rules file
+        changes, so they can be loaded before each use.
+    """
+    global _user_rules
+    from bank import env, load_categories
+
+    rules_file = env()['rules_file']
+    if os.path.exists(rules_file):
+        return load_rules_file(rules_file, env()['categories_file'], load_categories)
+
+    if _user_rules is None:
+        from rules.user import _rules
+        _user_rules = compile_rules(_rules)
+    return _user_rules
@@ -1 +1,2 @@
 from .driver import new
+from .pool import start_pool, current_pool, stop_pool
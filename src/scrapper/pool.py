@@ -0,0 +1,219 @@
+from collections import deque
+from functools import partial
+
+import atexit
+import threading
+import time
+
+from common.logging import get_logger
+
+from .driver import new
+
+logger = get_logger(name='scrapper')
+
+# Browser pool of the running process, if any was started
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class BrowserPool():
+    """
+        Keeps up to size browsers already started, so the scrappers get one without
+        waiting for the browser to start. Browsers are reset to a clean profile when
+        given back, and the idle ones are checked every check_interval seconds, quitting
+        the ones that stopped responding or that are older than max_age seconds, and
+        starting new ones to replace them.
+
+        Browsers are checked without holding the pool lock, so a browser that hangs
+        doesn't block the rest of the pool.
+    """
+
+    def __init__(self, new_browser, size, max_age, check_interval=60):
+        self.new_browser = new_browser
+        self.size = size
+        self.max_age = max_age
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.idle = deque()
+        self.started_at = {}
+        self.starting = 0
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.maintenance_loop, name='browser-pool', daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            idle, self.idle = list(self.idle), deque()
+        for browser in idle:
+            self.discard(browser)
+
+    def maintenance_loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.maintain()
+            except Exception as exc:
+                logger.error('Browser pool maintenance failed: {}'.format(exc))
+            self.stopped.wait(self.check_interval)
+
+    def maintain(self):
+        with self.lock:
+            idle = list(self.idle)
+
+        unusable = [browser for browser in idle if not self.usable(browser)]
+
+        discarded = []
+        with self.lock:
+            # Browsers taken meanwhile are checked again by acquire
+            for browser in unusable:
+                if browser in self.idle:
+                    self.idle.remove(browser)
+                    discarded.append(browser)
+
+            # Browsers given back while new ones were starting may leave extra browsers
+            while len(self.idle) > self.size:
+                discarded.append(self.idle.popleft())
+
+        for browser in discarded:
+            self.discard(browser)
+        self.fill()
+
+    def fill(self):
+        with self.lock:
+            missing = max(self.size - len(self.idle) - self.starting, 0)
+            self.starting += missing
+
+        for _ in range(missing):
+            browser = None
+            try:
+                browser = self.launch()
+            except Exception as exc:
+                logger.error('Could not start a browser for the pool: {}'.format(exc))
+            finally:
+                with self.lock:
+                    self.starting -= 1
+                    if browser is not None:
+                        self.idle.append(browser)
+
+    def refill(self):
+        if not self.stopped.is_set():
+            threading.Thread(target=self.fill, name='browser-pool-fill', daemon=True).start()
+
+    def launch(self):
+        browser = self.new_browser()
+        with self.lock:
+            self.started_at[browser] = time.monotonic()
+        return browser
+
+    def expired(self, browser):
+        return time.monotonic() - self.started_at.get(browser, 0) > self.max_age
+
+    def healthy(self, browser):
+        try:
+            return browser.execute_script('return 1') == 1
+        except Exception:
+            return False
+
+    def usable(self, browser):
+        return not self.expired(browser) and self.healthy(browser)
+
+    def take_idle(self):
+        with self.lock:
+            return self.idle.popleft() if self.idle else None
+
+    def acquire(self):
+        """
+            An idle browser of the pool, or a new one if there's none left
+        """
+        browser = self.take_idle()
+        while browser is not None and not self.usable(browser):
+            self.discard(browser)
+            browser = self.take_idle()
+
+        if browser is None:
+            browser = self.launch()
+
+        self.refill()
+        return browser
+
+    def release(self, browser, origins=()):
+        """
+            Gives a browser back to the pool, that keeps it if it can be reset
+            and there's room for it, and quits it otherwise. The storage of the
+            given origins is cleared along with the one of the current page.
+        """
+        if not self.stopped.is_set() and not self.expired(browser) and reset(browser, origins):
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(browser)
+                    return
+        self.discard(browser)
+
+    def discard(self, browser):
+        with self.lock:
+            self.started_at.pop(browser, None)
+        try:
+            browser.quit()
+        except Exception:
+            # The browser may be already gone
+            pass
+
+
+def reset(browser, origins=()):
+    """
+        Leaves the browser as a newly started one: a single blank window, without
+        cookies, cache, or storage of the current page and the given origins (as
+        "https://www.example.com"), that storage can only be cleared by origin.
+        Returns False if it fails.
+    """
+    try:
+        driver = browser.driver
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+
+        current_origin = driver.execute_script('return window.location.origin')
+        origins = set(origins)
+        if current_origin and current_origin.startswith('http'):
+            origins.add(current_origin)
+
+        driver.get('about:blank')
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+        for origin in sorted(origins):
+            driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+        return True
+    except Exception as exc:
+        logger.warning('Could not reset a browser of the pool: {}'.format(exc))
+        return False
+
+
+def start_pool(size, max_age, *args, **kwargs):
+    """
+        Starts the browser pool of the process, with browsers created by
+        scrapper.new(*args, **kwargs). Returns the running pool if already started.
+        The pool browsers are quit when the process exits.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BrowserPool(partial(new, *args, **kwargs), size, max_age)
+            _pool.start()
+            atexit.register(stop_pool)
+            logger.info('Started a pool of {} browsers'.format(size))
+        return _pool
+
+
+def current_pool():
+    return _pool
+
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.stop()
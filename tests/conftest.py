@@ -1,22 +1,20 @@
 import pytest
 
-from tinymongo import TinyMongoClient
-
-from database.io import encode_transaction
+import database
+from database.io import encode_object
 
 import tempfile
 
 
-@pytest.fixture(scope='function')
-def db_from_transactions():
+@pytest.fixture(scope='function', params=list(database.runtime.BACKENDS))
+def db_from_transactions(request):
 
     def make_db(**collections):
-        connection = TinyMongoClient(tempfile.mkdtemp())
-        test_db = getattr(connection, 'banking')
+        test_db = database.load(tempfile.mkdtemp(), backend=request.param)
         for collection_id, transactions in collections.items():
             test_collection = getattr(test_db, collection_id)
             for transaction in transactions:
-                test_collection.insert_one(encode_transaction(transaction))
+                test_collection.insert_one(encode_object(transaction))
 
         return test_db
 
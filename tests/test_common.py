@@ -1,8 +1,19 @@
 
 import pytest
 
-from common.utils import get_nested_item
-from .helpers import TestClass
+from copy import deepcopy
+from datetime import datetime
+from itertools import chain
+
+import random
+import re
+import unicodedata
+
+from common import encoding
+from common.parsing import extract_keywords, extract_keywords_batch
+from common.utils import compile_path, get_nested_item
+from datatypes import TransactionType
+from .helpers import TestClass, make_transaction
 
 
 TEST_DICT = {
@@ -43,6 +54,9 @@ testdata = {
     "Get dataclass value at level 1": [TEST_DATACLASS, 'att2.level_1.value', 1],
     "Get dataclass value at dataclass level": [TEST_DATACLASS, 'att2.level_2.att2.value', 2],
 
+    "Get missing key": [TEST_DICT, 'level_1.missing', None],
+    "Get below missing key": [TEST_DICT, 'level_1.missing.value', None],
+    "Get missing dataclass attribute": [TEST_DATACLASS, 'att2.level_2.missing', None],
 }
 
 testdata_values = list(testdata.values())
@@ -52,3 +66,89 @@ testdata_ids = list(testdata.keys())
 @pytest.mark.parametrize("obj,path,value", testdata_values, ids=testdata_ids)
 def test_nested_item_with_dict(obj, path, value):
     assert get_nested_item(obj, path) == value
+
+
+def test_nested_item_default():
+    # Only failed list indexes (and wrong xpaths) give the default, missing keys are None
+    assert get_nested_item(TEST_DICT, 'level_1.level1_list.[5].value', default='default') == 'default'
+    assert get_nested_item(TEST_DICT, 'root_value.[0]', default='default') == 'default'
+    assert get_nested_item(TEST_DICT, 'level_1.missing', default='default') is None
+    assert get_nested_item(TEST_DICT, None, default='default') == 'default'
+
+
+def test_compiled_path():
+    get_value = compile_path('level_1.level1_list.[1].value')
+
+    assert compile_path('level_1.level1_list.[1].value') is get_value
+    assert get_value(TEST_DICT) == 3
+    assert get_value({'level_1': {'level1_list': []}}, 'default') == 'default'
+
+
+def test_encoders_leave_objects_untouched():
+    transaction = make_transaction(type=TransactionType.PURCHASE, details={'nested': TestClass(att1='test', att2={})})
+    original = deepcopy(transaction)
+
+    for encoder in [encoding.DATABASE, encoding.API, encoding.JSON]:
+        encoder.encode(transaction)
+
+    assert transaction == original
+    assert '__type__' not in transaction.__dict__
+
+
+def test_encoders_output_formats():
+    obj = TestClass(att1=TransactionType.PURCHASE, att2={'date': datetime(2019, 1, 1)})
+
+    assert encoding.DATABASE.encode(obj) == {
+        'att1': {'__type__': 'enum::TransactionType', 'name': 'PURCHASE'},
+        'att2': {'date': {'__type__': 'datetime', 'date': '2019-01-01T00:00:00'}},
+        '__type__': 'dataclass::TestClass'
+    }
+    assert encoding.API.encode(obj) == {
+        'att1': {'__type__': 'enum::TransactionType', 'name': 'PURCHASE'},
+        'att2': {'date': '2019-01-01T00:00:00'},
+    }
+    assert encoding.JSON.encode(obj) == {
+        'att1': {'name': 'PURCHASE', '__type__': 'TransactionType'},
+        'att2': {'date': datetime(2019, 1, 1)},
+        '__type__': 'TestClass'
+    }
+
+
+def regex_extract_keywords(literals):
+    """
+        extract_keywords as it was, normalizing and cleaning up each literal with regexes
+    """
+    def normalize(text):
+        return unicodedata.normalize('NFKD', text).encode('ASCII', errors='ignore').decode('utf-8').upper()
+
+    def cleanup(text):
+        return re.sub(r' +', ' ', re.sub(r'[^A-Z0-9 ]', ' ', re.sub(r'\.', '', text)))
+
+    tokenized = [cleanup(normalize(literal)).split(' ') for literal in literals if literal is not None]
+    return [token for token in set(chain.from_iterable(tokenized)) if len(token) > 2]
+
+
+# Letters and digits, with and without accents, separators and compatibility characters
+KEYWORD_ALPHABET = 'aAbBzZ09 çÇñÑàÁèÉïÜœß.,-/*\t  ·€ºª½ﬁＡ①'
+
+
+def test_extract_keywords_as_regex_version():
+    generator = random.Random(0)
+
+    def literal():
+        if generator.random() < 0.1:
+            return None
+        return ''.join(generator.choice(KEYWORD_ALPHABET) for _ in range(generator.randint(0, 20)))
+
+    # A small pool of literals, so they repeat as shop names do
+    literals_pool = [literal() for _ in range(200)]
+    literals_lists = [
+        [generator.choice(literals_pool) for _ in range(generator.randint(0, 6))]
+        for _ in range(2000)
+    ]
+
+    expected = [regex_extract_keywords(literals) for literals in literals_lists]
+
+    assert [extract_keywords(literals) for literals in literals_lists] == expected
+    assert extract_keywords_batch(literals_lists) == expected
+    assert sorted(extract_keywords(['Compra en C/ Àlaba, 12.', 'S.L. ALABA'])) == ['ALABA', 'COMPRA']
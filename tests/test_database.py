@@ -1,9 +1,23 @@
 from database.runtime import update_credit_card_transactions
-from datatypes import TransactionType
-from database.io import decode_object
+from datatypes import TransactionType, BankConfig, BankAccessCode, Card
+from database.io import decode_object, encode_object, match_transactions, DatabaseError
+from database.io import find_credit_card_transactions, remove_credit_card_transaction, count_credit_card_transactions
+from database.io import insert_credit_card_transaction, get_credit_card_transactions_summary
+from database.io import insert_many_credit_card_transactions, update_many_credit_card_transactions, remove_many_credit_card_transactions
+from database.alignment import diff, key_line
+from database.indexes import IndexedDatabase, UnsupportedQuery
+from database.sqlite import SQLiteDatabase
 from .helpers import make_credit_card_transaction, make_test_account, make_test_card
 from copy import deepcopy
+from dataclasses import replace
 from datetime import datetime
+from difflib import Differ
+from tinymongo import TinyMongoClient
+import database
+import os
+import sqlite3
+import tempfile
+import threading
 import pytest
 
 from operator import eq, attrgetter
@@ -27,6 +41,11 @@ def T(date, amount, _seq=None):
     )
 
 
+def invalid(transaction):
+    transaction.status_flags.invalid = True
+    return transaction
+
+
 database_tests = {}
 failing_database_tests = {}
 
@@ -341,6 +360,23 @@ database_tests['Add transactions to head and tail, in between transactions alrea
 ]
 
 
+database_tests['Invalid transaction inside a diverged block, skipped'] = [
+    [
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+    ],
+    [
+        T('2019-01-01T00:00:00', -1.0),
+        invalid(T('2019-01-01T12:00:00', -99.0)),
+        T('2019-01-02T00:00:00', -12.0),
+    ],
+    [
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+    ]
+]
+
+
 failing_database_tests['Add transactions to head and tail, in between transactions already exist, except a middle one'] = [
     [
         T('2019-01-02T00:00:00', -3.0, 2),
@@ -436,3 +472,318 @@ def test_database_update_failures(db_from_transactions, current_db_transactions,
         match_fields('_seq', 'transaction_date', 'amount'),
         stored_db_transactions, current_db_transactions
     ))
+
+
+def test_match_transactions_ignores_valid_duplicates():
+    stored = T('2019-01-01T00:00:00', -1.0, 0)
+    duplicate = T('2019-01-01T00:00:00', -1.0, 1)
+    duplicate.status_flags.valid_duplicate = True
+    fetched = [T('2019-01-01T00:00:00', -1.0), T('2019-01-02T00:00:00', -2.0)]
+
+    matches = match_transactions([stored, duplicate], fetched, key=attrgetter('transaction_date', 'amount'))
+
+    assert matches == [stored, None]
+
+
+def test_match_transactions_multiple_matches():
+    stored = [T('2019-01-01T00:00:00', -1.0, 0), T('2019-01-01T00:00:00', -1.0, 1)]
+    fetched = [T('2019-01-01T00:00:00', -1.0)]
+
+    with pytest.raises(DatabaseError):
+        match_transactions(stored, fetched, key=attrgetter('transaction_date', 'amount'))
+
+
+alignment_tests = {
+    'Equal sequences': [[1, 2, 3], [1, 2, 3]],
+    'Tail insertions': [[1, 2, 3], [2, 3, 4, 5]],
+    'Interleaved insertions': [[1, 3, 5], [1, 2, 3, 4, 5, 6]],
+    'Replaced transaction': [[1, 2, 3, 4], [1, 2, 7, 4, 5]],
+    'Duplicated keys': [[1, 1, 2, 3], [1, 2, 2, 3, 4]],
+    'Reordered keys': [[1, 2, 3, 4], [1, 3, 2, 4]],
+    'Replaced block': [[1, 2, 3, 9], [1, 7, 8, 9]],
+    'Replaced block with similar keys': [[1, 2], [1, 99, 12]],
+}
+
+
+def alignment_keys(values):
+    return [key_line((make_date('2019-01-01T00:00:00'), -float(value), 'PURCHASE')) for value in values]
+
+
+@pytest.mark.parametrize('db_values, fetched_values', list(alignment_tests.values()), ids=list(alignment_tests.keys()))
+def test_alignment_matches_differ(db_values, fetched_values):
+    db_keys, fetched_keys = alignment_keys(db_values), alignment_keys(fetched_values)
+
+    expected = [
+        (line[0], line[2:])
+        for line in Differ().compare(db_keys, fetched_keys)
+        if line[0] != '?'
+    ]
+
+    assert list(diff(db_keys, fetched_keys)) == expected
+
+
+def test_indexed_collection_follows_writes(db_from_transactions):
+    db = db_from_transactions(credit_card_transactions=[
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+        T('2019-01-03T00:00:00', -3.0, 2),
+    ])
+    if not isinstance(db, IndexedDatabase):
+        pytest.skip('Only tinymongo databases are indexed in memory')
+
+    first = find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)[0]
+    remove_credit_card_transaction(db, first)
+
+    remaining = find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER, since_date=make_date('2019-01-02T00:00:00'))
+    assert [transaction._seq for transaction in remaining] == [1, 2]
+    assert count_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER) == 2
+
+    # Writes from outside of the indexed collections are picked up too
+    external_db = TinyMongoClient(os.path.dirname(db.database_file.filename)).banking
+    external_db.credit_card_transactions.remove({'_seq': 2})
+    assert count_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER) == 1
+
+
+def test_indexed_collection_returns_copies():
+    db = database.load(tempfile.mkdtemp(), backend='tinymongo')
+    db.rulesets.insert_one({'fingerprint': 'abc', 'rules': ['one']})
+
+    db.rulesets.find({})[0]['rules'].append('two')
+
+    assert db.rulesets.find({})[0]['rules'] == ['one']
+
+
+def test_indexed_collection_follows_writes_keeping_signature():
+    db = database.load(tempfile.mkdtemp(), backend='tinymongo')
+    db.rulesets.insert_one({'fingerprint': 'abc', 'rules': []})
+    assert db.rulesets.find({})[0]['fingerprint'] == 'abc'
+
+    # Written by someone else, keeping the same mtime and size of the file
+    stat = os.stat(db.filename)
+    with open(db.filename) as database_file:
+        content = database_file.read()
+    with open(db.filename, 'w') as database_file:
+        database_file.write(content.replace('"abc"', '"xyz"'))
+    os.utime(db.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert db.rulesets.find({})[0]['fingerprint'] == 'xyz'
+
+
+def test_transactions_summary_follows_writes(db_from_transactions):
+    db = db_from_transactions(credit_card_transactions=[
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+    ])
+
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (2, 1)
+
+    insert_credit_card_transaction(db, T('2019-01-03T00:00:00', -3.0, 2))
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (3, 2)
+    assert summary.last_transaction_date == make_date('2019-01-03T00:00:00')
+
+    first, second, last = find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)
+    remove_credit_card_transaction(db, first)
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (2, 2)
+
+    remove_credit_card_transaction(db, last)
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (1, 1)
+    assert summary.last_transaction_date == make_date('2019-01-02T00:00:00')
+
+
+def test_decode_object_leaves_document_untouched():
+    date = make_date('2019-01-01T00:00:00')
+    transaction = make_credit_card_transaction(transaction_date=date, value_date=date, keywords=['ONE'], _seq=0)
+    document = encode_object(deepcopy(transaction))
+    stored_document = deepcopy(document)
+
+    assert decode_object(document) == transaction
+    assert document == stored_document
+
+
+def test_bulk_operations_keep_transactions_summary(db_from_transactions):
+    db = db_from_transactions()
+
+    insert_many_credit_card_transactions(db, [
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+        T('2019-01-03T00:00:00', -3.0, 2),
+    ])
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (3, 2)
+
+    transactions = find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)
+    for transaction in transactions:
+        transaction._seq += 10
+    update_many_credit_card_transactions(db, transactions)
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (3, 12)
+    assert [transaction._seq for transaction in find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)] == [10, 11, 12]
+
+    remove_many_credit_card_transactions(db, transactions[:2])
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (1, 12)
+
+
+def test_bulk_operations_keep_summaries_of_all_groups(db_from_transactions):
+    db = db_from_transactions()
+    other_card = Card('OTHER_CARD', '00000000002')
+
+    def other_T(date, amount, _seq=None):
+        return replace(T(date, amount, _seq), card=other_card)
+
+    insert_many_credit_card_transactions(db, [
+        T('2019-01-01T00:00:00', -1.0, 0),
+        other_T('2019-01-01T00:00:00', -1.0, 0),
+    ])
+    get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    get_credit_card_transactions_summary(db, other_card.number)
+
+    insert_many_credit_card_transactions(db, [
+        T('2019-01-02T00:00:00', -2.0, 1),
+        other_T('2019-01-02T00:00:00', -2.0, 1),
+        other_T('2019-01-03T00:00:00', -3.0, 2),
+    ])
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (2, 1)
+    other_summary = get_credit_card_transactions_summary(db, other_card.number)
+    assert (other_summary.count, other_summary.last_seq) == (3, 2)
+    assert other_summary.last_transaction_date == make_date('2019-01-03T00:00:00')
+
+    first = find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)[0]
+    other_last = find_credit_card_transactions(db, other_card.number)[-1]
+    remove_many_credit_card_transactions(db, [first, other_last])
+    summary = get_credit_card_transactions_summary(db, TEST_CREDIT_CARD_NUMBER)
+    assert (summary.count, summary.last_seq) == (1, 1)
+    other_summary = get_credit_card_transactions_summary(db, other_card.number)
+    assert (other_summary.count, other_summary.last_seq) == (2, 1)
+
+
+def test_update_transactions_bulk(db_from_transactions):
+    db = db_from_transactions()
+
+    insert_many_credit_card_transactions(db, [
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+        T('2019-01-03T00:00:00', -3.0, 2),
+    ])
+    transactions = find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)
+    processed_transactions = [
+        replace(transactions[0], comment='First', tags=['one'], rules_fingerprint='abc'),
+        replace(transactions[1], rules_fingerprint='abc'),
+        replace(transactions[2], comment='Last', rules_fingerprint='abc'),
+    ]
+
+    changed, field_changes = database.update_transactions_bulk(db, transactions, processed_transactions)
+
+    # Restamped transactions are stored, but not counted as changed
+    assert changed == 2
+    assert field_changes == {'comment': 2, 'tags': 1}
+    assert find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER) == processed_transactions
+
+
+def test_sqlite_database_context_manager():
+    with database.load(tempfile.mkdtemp(), backend='sqlite') as db:
+        insert_many_credit_card_transactions(db, [T('2019-01-01T00:00:00', -1.0, 0)])
+
+        with pytest.raises(UnsupportedQuery):
+            db.credit_card_transactions.find({'amount': {'$in': [-1.0]}})
+
+    with pytest.raises(sqlite3.ProgrammingError):
+        find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)
+
+
+def test_migrate_tinymongo_database():
+    tinymongo_folder, sqlite_folder = tempfile.mkdtemp(), tempfile.mkdtemp()
+    tinymongo_db = database.load(tinymongo_folder, backend='tinymongo')
+    insert_many_credit_card_transactions(tinymongo_db, [
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+    ])
+
+    assert database.migrate(tinymongo_folder, sqlite_folder)['credit_card_transactions'] == 2
+
+    sqlite_db = database.load(sqlite_folder)
+    assert isinstance(sqlite_db, SQLiteDatabase)
+    assert find_credit_card_transactions(sqlite_db, TEST_CREDIT_CARD_NUMBER) == find_credit_card_transactions(tinymongo_db, TEST_CREDIT_CARD_NUMBER)
+
+
+def test_access_codes_store(db_from_transactions):
+    db = db_from_transactions()
+    bank_config = BankConfig(id='test_bank', name='Test bank', username='', password='', accounts={})
+
+    assert database.get_bank_access_code(db, bank_config) is None
+
+    access_code = BankAccessCode(bank_id='test_bank', code='1234', date=make_date('2019-01-01T00:00:00'))
+    database.update_bank_access_code(db, bank_config, access_code)
+    stored_codes = list(map(decode_object, db.bank_access_codes.find({'bank_id': 'test_bank'})))
+    assert stored_codes == [replace(access_code, _id=stored_codes[0]._id)]
+    assert database.get_bank_access_code(db, bank_config) == stored_codes[0]
+
+
+def test_wait_for_access_code(db_from_transactions):
+    db = db_from_transactions()
+    bank_config = BankConfig(id='test_bank', name='Test bank', username='', password='', accounts={})
+
+    def accept(access_code):
+        return access_code.code == '1234'
+
+    assert database.wait_for_bank_access_code(db, bank_config, accept, timeout=0.1) is None
+
+    access_code = BankAccessCode(bank_id='test_bank', code='1234', date=make_date('2019-01-01T00:00:00'))
+
+    def publish():
+        # As the api handlers do, from another thread with its own connection
+        database.update_bank_access_code(database.load(os.path.dirname(db.filename)), bank_config, access_code)
+
+    publisher = threading.Timer(0.2, publish)
+    publisher.start()
+    received_code = database.wait_for_bank_access_code(db, bank_config, accept, timeout=10)
+    publisher.join()
+
+    assert received_code.code == '1234'
+
+
+def test_save_ruleset(db_from_transactions):
+    db = db_from_transactions()
+
+    database.io.save_ruleset(db, 'fingerprint', ['rule0', 'rule1'])
+    database.io.save_ruleset(db, 'fingerprint', ['rule0', 'rule1'])
+
+    assert database.find_rulesets(db) == {'fingerprint': ['rule0', 'rule1']}
+
+
+def test_access_code_stored_by_another_process(db_from_transactions):
+    db = db_from_transactions()
+    bank_config = BankConfig(id='test_bank', name='Test bank', username='', password='', accounts={})
+
+    assert database.get_bank_access_code(db, bank_config) is None
+
+    # Written straight to the storage, as another process would do it
+    access_code = BankAccessCode(bank_id='test_bank', code='1234', date=make_date('2019-01-01T00:00:00'))
+    if isinstance(db, SQLiteDatabase):
+        other_process_db = SQLiteDatabase(db.filename)
+    else:
+        other_process_db = TinyMongoClient(os.path.dirname(db.filename)).banking
+    other_process_db.bank_access_codes.insert_one(encode_object(access_code))
+
+    assert database.get_bank_access_code(db, bank_config).code == '1234'
+    assert database.wait_for_bank_access_code(db, bank_config, lambda code: True, timeout=1).code == '1234'
+
+
+def test_tinymongo_bulk_writes_stored_on_collection_table():
+    db = database.load(tempfile.mkdtemp(), backend='tinymongo')
+    insert_many_credit_card_transactions(db, [
+        T('2019-01-01T00:00:00', -1.0, 0),
+        T('2019-01-02T00:00:00', -2.0, 1),
+    ])
+    first, last = find_credit_card_transactions(db, TEST_CREDIT_CARD_NUMBER)
+    update_many_credit_card_transactions(db, [replace(first, comment='Updated')])
+    remove_many_credit_card_transactions(db, [last])
+
+    # Read through tinymongo itself, without the indexes
+    stored_documents = list(TinyMongoClient(os.path.dirname(db.filename)).banking.credit_card_transactions.find({}))
+    assert [decode_object(document) for document in stored_documents] == [replace(first, comment='Updated')]
@@ -0,0 +1,105 @@
+import pytest
+
+from datatypes import AccountConfig, BankConfig, TransactionDirection, TransactionType
+from bank.classification import build_type_table
+
+import bank.bankia.parsing
+import bank.bbva.parsing
+
+
+BANKS = {
+    'bbva': bank.bbva.parsing,
+    'bankia': bank.bankia.parsing,
+}
+
+
+def make_bank_config(bank_id, transaction_codes=None):
+    return BankConfig(bank_id, bank_id.upper(), 'user', 'password', [], transaction_codes)
+
+
+def make_account_config(bank_id):
+    return AccountConfig('bank_account', bank_id, 'Test account', 'ES0000000000000000000001', {})
+
+
+def bbva_account_transaction(code, amount):
+    return {
+        'id': '1',
+        'amount': {'amount': amount, 'currency': {'code': 'EUR'}},
+        'balance': {'availableBalance': {'amount': 100.0}},
+        'scheme': {'subCategory': {'id': code}},
+        'humanConceptName': 'Shop',
+        'valueDate': '2020-01-15T00:00:00.000+0100',
+        'transactionDate': '2020-01-15T10:30:00.000+0100',
+    }
+
+
+def bankia_account_transaction(code, amount):
+    return {
+        'importe': {'importeConSigno': int(amount * 100), 'numeroDecimales': 2, 'moneda': {'nombreCorto': 'EUR'}},
+        'saldoPosterior': {'importeConSigno': 10000, 'numeroDecimales': 2},
+        'codigoMovimiento': code,
+        'conceptoMovimiento': {'descripcionConcepto': 'COMPRA'},
+        'referencias': [{'codigoPlantilla': '0440', 'descripcion': 'SHOP'}],
+        'fechaValor': {'valor': '2020-01-15'},
+        'fechaMovimiento': {'valor': '2020-01-15'},
+    }
+
+
+ACCOUNT_TRANSACTIONS = {
+    'bbva': bbva_account_transaction,
+    'bankia': bankia_account_transaction,
+}
+
+
+def kind_types(transaction_kinds):
+    for kind, (codes, charge_type, income_type) in transaction_kinds.items():
+        for code in codes:
+            yield kind, code, TransactionDirection.CHARGE, charge_type
+            yield kind, code, TransactionDirection.INCOME, income_type
+
+
+@pytest.mark.parametrize('bank_id', list(BANKS))
+def test_transaction_kinds_types(bank_id):
+    parsing = BANKS[bank_id]
+    type_table = parsing.get_type_table(make_bank_config(bank_id))
+
+    assert type_table is parsing.TYPE_TABLE
+    for kind, code, direction, transaction_type in kind_types(parsing.TRANSACTION_KINDS):
+        assert parsing.get_type(code, direction, type_table) == transaction_type, (kind, code, direction)
+
+
+@pytest.mark.parametrize('bank_id', list(BANKS))
+def test_parse_account_transaction_kinds(bank_id):
+    parsing = BANKS[bank_id]
+    bank_config, account_config = make_bank_config(bank_id), make_account_config(bank_id)
+    purchase_code = parsing.TRANSACTION_KINDS['purchase'][0][0]
+
+    transaction = parsing.parse_account_transaction(bank_config, account_config, ACCOUNT_TRANSACTIONS[bank_id](purchase_code, -12.5))
+    assert transaction.type is TransactionType.PURCHASE
+    assert transaction.amount == -12.5
+    assert transaction.details['shop_name'] == 'Shop'
+    assert transaction.destination.name == 'Shop'
+
+
+@pytest.mark.parametrize('bank_id', list(BANKS))
+def test_parse_account_transaction_configured_codes(bank_id):
+    parsing = BANKS[bank_id]
+    account_config = make_account_config(bank_id)
+    make_raw_transaction = ACCOUNT_TRANSACTIONS[bank_id]
+
+    default_type = parsing.parse_account_transaction(make_bank_config(bank_id), account_config, make_raw_transaction('999', -12.5)).type
+    assert default_type is not TransactionType.PURCHASE
+
+    bank_config = make_bank_config(bank_id, transaction_codes={'purchase': ['999']})
+    type_table = parsing.get_type_table(bank_config)
+    transaction = parsing.parse_account_transaction(bank_config, account_config, make_raw_transaction('999', -12.5), type_table)
+    assert transaction.type is TransactionType.PURCHASE
+
+    # The configured codes are added to the ones of the kind
+    purchase_code = parsing.TRANSACTION_KINDS['purchase'][0][0]
+    assert parsing.get_type(purchase_code, TransactionDirection.CHARGE, type_table) is TransactionType.PURCHASE
+
+
+def test_configured_codes_of_unknown_kinds():
+    with pytest.raises(ValueError, match='Unknown transaction kinds: groceries'):
+        build_type_table(bank.bbva.parsing.TRANSACTION_KINDS, {'groceries': ['999']})
@@ -0,0 +1,152 @@
+from scrapper.pool import BrowserPool, reset
+
+import time
+
+
+class FakeDriver():
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.window_handles = ['main']
+        self.switch_to = self
+        self.origin = 'https://bank.test'
+
+    def window(self, handle):
+        pass
+
+    def close(self):
+        pass
+
+    def get(self, url):
+        self.origin = 'null'
+
+    def execute_script(self, script):
+        return self.origin
+
+    def execute_cdp_cmd(self, command, arguments):
+        if self.browser.broken_cdp:
+            raise Exception('Invalid parameters')
+        self.browser.cdp_commands.append((command, arguments.get('origin')))
+
+
+class FakeBrowser():
+
+    def __init__(self):
+        self.healthy = True
+        self.broken_cdp = False
+        self.quit_called = False
+        self.cdp_commands = []
+        self.driver = FakeDriver(self)
+
+    def execute_script(self, script):
+        if not self.healthy:
+            raise Exception('Not responding')
+        return 1
+
+    def quit(self):
+        self.quit_called = True
+
+
+def make_pool(size=2, max_age=60):
+    browsers = []
+
+    def new_browser():
+        browsers.append(FakeBrowser())
+        return browsers[-1]
+
+    pool = BrowserPool(new_browser, size, max_age)
+    # Refills are run by the tests, instead of on a background thread
+    pool.refill = lambda: None
+    return pool, browsers
+
+
+def test_acquire_from_empty_pool():
+    pool, browsers = make_pool()
+
+    browser = pool.acquire()
+
+    assert browsers == [browser]
+    assert not pool.idle
+
+
+def test_acquire_idle_browser():
+    pool, browsers = make_pool()
+    pool.fill()
+
+    browser = pool.acquire()
+
+    assert len(browsers) == 2
+    assert browser is browsers[0]
+    assert list(pool.idle) == [browsers[1]]
+
+
+def test_unhealthy_browsers_are_discarded():
+    pool, browsers = make_pool()
+    pool.fill()
+    browsers[0].healthy = False
+
+    assert pool.acquire() is browsers[1]
+    assert browsers[0].quit_called
+
+    pool.fill()
+    browsers[2].healthy = False
+    pool.maintain()
+
+    assert browsers[2].quit_called
+    assert list(pool.idle) == [browsers[3], browsers[4]]
+
+
+def test_expired_browsers_are_recycled():
+    pool, browsers = make_pool(max_age=60)
+    pool.fill()
+    pool.started_at[browsers[0]] = time.monotonic() - 61
+
+    pool.maintain()
+
+    assert browsers[0].quit_called
+    assert not browsers[1].quit_called
+    assert list(pool.idle) == [browsers[1], browsers[2]]
+
+    browser = pool.acquire()
+    pool.started_at[browser] = time.monotonic() - 61
+    pool.release(browser)
+
+    assert browser.quit_called
+    assert browser not in pool.idle
+
+
+def test_release_keeps_up_to_size_browsers():
+    pool, browsers = make_pool(size=1)
+
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+
+    assert list(pool.idle) == [first]
+    assert not first.quit_called
+    assert second.quit_called
+
+
+def test_release_resets_browser():
+    pool, browsers = make_pool()
+
+    browser = pool.acquire()
+    pool.release(browser, origins=['https://other.bank.test'])
+
+    assert ('Network.clearBrowserCookies', None) in browser.cdp_commands
+    assert ('Storage.clearDataForOrigin', 'https://bank.test') in browser.cdp_commands
+    assert ('Storage.clearDataForOrigin', 'https://other.bank.test') in browser.cdp_commands
+    assert list(pool.idle) == [browser]
+
+
+def test_browsers_that_cant_be_reset_are_discarded():
+    pool, browsers = make_pool()
+
+    browser = pool.acquire()
+    browser.broken_cdp = True
+
+    assert not reset(browser)
+
+    pool.release(browser)
+    assert browser.quit_called
+    assert not pool.idle
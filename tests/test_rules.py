@@ -0,0 +1,375 @@
+from dataclasses import replace
+from datetime import datetime
+
+from datatypes import Category, DataOrigin, TransactionType, Recipient
+from rules.compiler import compile_rules, rule_hash
+from rules.declarative import load_rules_file, parse_rules
+from rules.domain import Rule, ValueSetter
+from rules.io import Match, MatchAll, MatchAny, MatchNumeric, Set, SetFromCapture, Add
+from rules.io import apply_rules_to_transaction
+from rules.runtime import apply, apply_incremental, profile
+
+import os
+import pytest
+import rules.declarative
+import rules.runtime
+import tempfile
+import yaml
+
+from .helpers import make_transaction
+
+
+TEST_RULES = [
+    Rule(
+        conditions=[Match('type', TransactionType.PURCHASE), MatchAll('keywords', 'SHOP', 'ONLINE')],
+        actions=[Set('destination', 'Online shop')]
+    ),
+    Rule(
+        conditions=[MatchAny('type', TransactionType.PURCHASE, TransactionType.ATM_WITHDRAWAL)],
+        actions=[Add('tags', 'spending')]
+    ),
+    Rule(
+        conditions=[MatchAny('keywords', 'RENT', 'LLOGUER')],
+        actions=[Set('comment', 'Rent')]
+    ),
+    Rule(
+        conditions=[Match('destination', 'Online shop')],
+        actions=[Add('tags', 'online')]
+    ),
+    Rule(
+        conditions=[Match('comment', 'Rent')],
+        actions=[Add('tags', 'home')]
+    ),
+]
+
+
+def test_compiled_rules_candidates():
+    compiled_rules = compile_rules(TEST_RULES)
+
+    purchase = make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP', 'ONLINE'])
+    transfer = make_transaction(type=TransactionType.ISSUED_TRANSFER, keywords=['LLOGUER'])
+
+    assert compiled_rules.candidates(purchase) == [TEST_RULES[0], TEST_RULES[1], TEST_RULES[3], TEST_RULES[4]]
+    assert compiled_rules.candidates(transfer) == [TEST_RULES[2], TEST_RULES[3], TEST_RULES[4]]
+    assert list(compiled_rules) == TEST_RULES
+
+
+def test_compiled_rules_apply_as_rules_list():
+    transactions = [
+        make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP', 'ONLINE']),
+        make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP']),
+        make_transaction(type=TransactionType.ATM_WITHDRAWAL, keywords=['RENT']),
+        make_transaction(type=TransactionType.ISSUED_TRANSFER, keywords=[], destination=Recipient('Online shop')),
+    ]
+
+    processed_transactions = apply(compile_rules(TEST_RULES), transactions)
+
+    assert processed_transactions == apply(TEST_RULES, transactions)
+    assert processed_transactions[0].tags == ['spending', 'online']
+    assert processed_transactions[2].comment == 'Rent'
+    assert processed_transactions[2].tags == ['spending', 'home']
+
+
+def test_rules_list_compiled_once(monkeypatch):
+    compiled = []
+
+    def counted_compile_rules(rules):
+        compiled.append(rules)
+        return compile_rules(rules)
+
+    monkeypatch.setattr(rules.runtime, 'compile_rules', counted_compile_rules)
+
+    apply(TEST_RULES, [make_transaction(type=TransactionType.PURCHASE)] * 3)
+    assert compiled == [TEST_RULES]
+
+    with pytest.raises(TypeError):
+        apply_rules_to_transaction(TEST_RULES, make_transaction())
+
+
+REGEX_RULES = [
+    Rule(
+        conditions=[Match('details.desc', r'^compra\s+', regex='match')],
+        actions=[Add('tags', 'purchase')]
+    ),
+    Rule(
+        conditions=[MatchAny('details.desc', 'AMAZON', r'amzn\W', regex='search')],
+        actions=[Set('destination', 'Amazon')]
+    ),
+    Rule(
+        conditions=[MatchAll('details.desc', 'MERCADONA', r'(\d)\1', regex='search')],
+        actions=[Add('tags', 'groceries')]
+    ),
+    Rule(
+        conditions=[Match('destination', 'amazon', regex='match')],
+        actions=[Add('tags', 'online')]
+    ),
+]
+
+
+def test_compiled_rules_scan_regex_patterns_together():
+    compiled_rules = compile_rules(REGEX_RULES)
+    scans = compiled_rules.scans()
+
+    assert scans.matching(REGEX_RULES[1].conditions[0], 'Pago AMZN*Mktp') == {r'amzn\W'}
+    # All the patterns searched on the field are checked at once
+    assert scans.matching(REGEX_RULES[1].conditions[0], 'compra en mercadona') == {'MERCADONA'}
+    # Patterns referring to their own groups are left out of the scan
+    assert scans.matching(REGEX_RULES[2].conditions[0], 'MERCADONA 4411') is None
+
+
+def test_compiled_regex_rules_apply_as_rules_list():
+    transactions = [
+        make_transaction(details={'desc': 'COMPRA EN AMAZON.ES'}),
+        make_transaction(details={'desc': 'Pago amzn*Mktp'}),
+        make_transaction(details={'desc': 'Compra mercadona 4411'}),
+        make_transaction(details={'desc': 'transferencia'}),
+    ]
+
+    processed_transactions = apply(compile_rules(REGEX_RULES), transactions)
+
+    assert processed_transactions == apply(REGEX_RULES, transactions)
+    assert processed_transactions[0].tags == ['purchase', 'online']
+    assert processed_transactions[1].destination.name == 'Amazon'
+    assert processed_transactions[2].tags == ['purchase', 'groceries']
+    assert processed_transactions[3].tags == []
+
+
+def test_apply_reruns_rules_until_nothing_changes():
+    chained_rules = [
+        Rule(
+            conditions=[Match('destination', 'Online shop')],
+            actions=[Set('comment', 'Shop'), Add('tags', 'online')]
+        ),
+        Rule(
+            conditions=[Match('type', TransactionType.PURCHASE)],
+            actions=[Set('comment', 'Purchase')]
+        ),
+        Rule(
+            conditions=[Match('type', TransactionType.PURCHASE)],
+            actions=[Set('destination', 'Online shop')]
+        ),
+    ]
+    transaction = make_transaction(type=TransactionType.PURCHASE, tags=[])
+
+    processed_transaction, = apply(chained_rules, [transaction])
+
+    # Later rules on the same pass win, as on the first one
+    assert processed_transaction.comment == 'Purchase'
+    assert processed_transaction.destination.name == 'Online shop'
+    assert processed_transaction.tags == ['online']
+    assert processed_transaction.flags.destination == DataOrigin.RULES
+    assert transaction.tags == []
+    assert transaction.comment == ''
+
+
+def test_parallel_apply_as_serial(monkeypatch):
+    monkeypatch.setattr(rules.runtime, 'PARALLEL_MIN_TRANSACTIONS', 0)
+    monkeypatch.setattr(rules.runtime, 'CHUNK_SIZE', 3)
+
+    # Transactions travel to the workers as database documents, stored with second precision
+    transaction_date = datetime(2020, 1, 15, 10, 30)
+    transactions = [
+        replace(transaction, value_date=transaction_date, transaction_date=transaction_date)
+        for transaction in [
+            make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP', 'ONLINE']),
+            make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP']),
+            make_transaction(type=TransactionType.ATM_WITHDRAWAL, keywords=['RENT']),
+            make_transaction(type=TransactionType.ISSUED_TRANSFER, keywords=[]),
+        ] * 5
+    ]
+
+    chunk_sizes = []
+    chunks = rules.runtime.chunks
+
+    def recorded_chunks(items, size):
+        chunk_sizes.extend(len(chunk) for chunk in chunks(items, size))
+        return chunks(items, size)
+
+    monkeypatch.setattr(rules.runtime, 'chunks', recorded_chunks)
+
+    processed_transactions = apply(compile_rules(TEST_RULES), transactions, workers=2)
+
+    assert chunk_sizes == [3] * 6 + [2]
+    assert processed_transactions == apply(TEST_RULES, transactions)
+    assert processed_transactions[3] is transactions[3]
+
+
+def test_parallel_apply_falls_back_to_serial(monkeypatch):
+    monkeypatch.setattr(rules.runtime, 'PARALLEL_MIN_TRANSACTIONS', 0)
+
+    # Rules with lambdas can't be sent to the workers
+    lambda_rules = [Rule(conditions=[], actions=[ValueSetter('comment', lambda transaction: 'Any', str)])]
+    transactions = [make_transaction(), make_transaction()]
+
+    processed_transactions = apply(lambda_rules, transactions, workers=2)
+
+    assert [transaction.comment for transaction in processed_transactions] == ['Any', 'Any']
+
+
+def test_apply_incremental_only_processes_affected_transactions():
+    transactions = [
+        make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP', 'ONLINE']),
+        make_transaction(type=TransactionType.ATM_WITHDRAWAL, keywords=['RENT']),
+        make_transaction(type=TransactionType.ISSUED_TRANSFER, keywords=['NOMINA']),
+    ]
+    first_rules = compile_rules(TEST_RULES)
+    rulesets = {first_rules.fingerprint: first_rules.hashes}
+
+    processed_transactions = apply_incremental(first_rules, transactions, {})
+    assert [transaction.rules_fingerprint for transaction in processed_transactions] == [first_rules.fingerprint] * 3
+    assert apply_incremental(first_rules, processed_transactions, rulesets) == processed_transactions
+
+    new_rule = Rule(conditions=[Match('keywords', 'NOMINA')], actions=[Set('comment', 'Salary')])
+    second_rules = compile_rules(TEST_RULES + [new_rule])
+    reprocessed_transactions = apply_incremental(second_rules, processed_transactions, rulesets)
+
+    assert reprocessed_transactions == [
+        replace(transaction, rules_fingerprint=second_rules.fingerprint)
+        for transaction in apply(second_rules, processed_transactions)
+    ]
+    assert reprocessed_transactions[2].comment == 'Salary'
+
+    # Removed rules can't change what the kept ones already did, transactions are just restamped
+    third_rules = compile_rules(TEST_RULES[1:])
+    assert compile_rules(TEST_RULES[1:]).hashes == second_rules.hashes[1:-1]
+    assert apply_incremental(third_rules, reprocessed_transactions, {**rulesets, second_rules.fingerprint: second_rules.hashes}) == [
+        replace(transaction, rules_fingerprint=third_rules.fingerprint)
+        for transaction in reprocessed_transactions
+    ]
+
+
+def test_apply_incremental_edited_rule(monkeypatch):
+    transactions = [
+        make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP', 'ONLINE']),
+        make_transaction(type=TransactionType.ATM_WITHDRAWAL, keywords=['RENT']),
+        make_transaction(type=TransactionType.ISSUED_TRANSFER, keywords=['NOMINA']),
+    ]
+    first_rules = compile_rules(TEST_RULES)
+    rulesets = {first_rules.fingerprint: first_rules.hashes}
+    processed_transactions = apply_incremental(first_rules, transactions, {})
+
+    applied = []
+    apply = rules.runtime.apply
+
+    def recorded_apply(rules, transactions, workers=1):
+        applied.extend(transactions)
+        return apply(rules, transactions, workers=workers)
+
+    monkeypatch.setattr(rules.runtime, 'apply', recorded_apply)
+
+    edited_rule = Rule(conditions=[MatchAny('keywords', 'RENT', 'LLOGUER')], actions=[Set('comment', 'Home rent')])
+    edited_rules = compile_rules(TEST_RULES[:2] + [edited_rule] + TEST_RULES[3:])
+    reprocessed_transactions = apply_incremental(edited_rules, processed_transactions, rulesets)
+
+    # Only the transaction the edited rule matches is processed again
+    assert applied == [processed_transactions[1]]
+    assert reprocessed_transactions[1].comment == 'Home rent'
+    assert reprocessed_transactions[0] == replace(processed_transactions[0], rules_fingerprint=edited_rules.fingerprint)
+    assert reprocessed_transactions[2] == replace(processed_transactions[2], rules_fingerprint=edited_rules.fingerprint)
+
+    # Reordered rules may leave any transaction with a different result, all of them are processed
+    applied.clear()
+    reordered_rules = compile_rules(TEST_RULES[::-1])
+    apply_incremental(reordered_rules, processed_transactions, rulesets)
+    assert applied == processed_transactions
+
+
+def test_profile_counts_rules_and_conditions():
+    transactions = [
+        make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP', 'ONLINE']),
+        make_transaction(type=TransactionType.PURCHASE, keywords=['SHOP']),
+        make_transaction(type=TransactionType.ISSUED_TRANSFER, keywords=[]),
+    ]
+
+    rules_profile = profile(TEST_RULES, transactions)
+    online_shop, spending = rules_profile.rule_stats[:2]
+
+    assert rules_profile.transactions == 3
+    # The online purchase needs a pass for the online tag, and a last one without changes
+    assert (rules_profile.passes, rules_profile.max_passes) == (5, 3)
+    # The keywords index leaves the transfer out of the online shop rule
+    assert (online_shop.evaluations, online_shop.matches, online_shop.action_passes) == (2, 1, 3)
+    assert (spending.evaluations, spending.matches, spending.action_passes) == (2, 2, 5)
+    assert [condition.description for condition in online_shop.conditions] == [
+        'type is PURCHASE', 'keywords is all of [SHOP, ONLINE]'
+    ]
+    assert rules_profile.as_dict()['rules'][0]['conditions'][1]['matches'] == 1
+
+
+RULES_FILE = """
+- conditions:
+    - match: {field: type, value: PURCHASE}
+    - match_all: {field: keywords, values: [SHOP, ONLINE]}
+    - match_numeric: {field: amount, value: 50, operator: gt, absolute: true}
+  actions:
+    - set: {field: destination, value: Online shop}
+    - set: {field: category, value: shopping}
+- conditions:
+    - match_any: {field: details.desc, values: ['paypal\\s+\\*'], regex: search}
+  actions:
+    - set_from_capture: {field: destination, source: details.desc, regex: 'paypal\\s+\\*(.*)'}
+    - add: {field: tags, values: [paypal, online]}
+"""
+
+CATEGORIES = {'shopping': Category(id='shopping', name='Shopping')}
+
+
+def write_rules_files(content):
+    folder = tempfile.mkdtemp()
+    rules_filename = os.path.join(folder, 'rules.yaml')
+    categories_filename = os.path.join(folder, 'categories.yaml')
+    with open(rules_filename, 'w') as rules_file:
+        rules_file.write(content)
+    with open(categories_filename, 'w') as categories_file:
+        categories_file.write('- id: shopping\n  name: Shopping\n')
+    return rules_filename, categories_filename
+
+
+def test_parse_rules_file():
+    parsed_rules = parse_rules(yaml.safe_load(RULES_FILE), CATEGORIES)
+
+    assert list(map(rule_hash, parsed_rules)) == list(map(rule_hash, [
+        Rule(
+            conditions=[
+                Match('type', TransactionType.PURCHASE),
+                MatchAll('keywords', 'SHOP', 'ONLINE'),
+                MatchNumeric('amount', 50, operator='gt', absolute=True)
+            ],
+            actions=[Set('destination', 'Online shop'), Set('category', CATEGORIES['shopping'])]
+        ),
+        Rule(
+            conditions=[MatchAny('details.desc', r'paypal\s+\*', regex='search')],
+            actions=[
+                SetFromCapture('destination', source='details.desc', regex=r'paypal\s+\*(.*)'),
+                Add('tags', 'paypal', 'online')
+            ]
+        )
+    ]))
+
+    with pytest.raises(rules.declarative.RulesFileError, match='Rule #0: Unknown category "food"'):
+        parse_rules([{'actions': [{'set': {'field': 'category', 'value': 'food'}}]}], CATEGORIES)
+
+
+def test_load_rules_file_cached():
+    rules_filename, categories_filename = write_rules_files(RULES_FILE)
+    loaded_categories = []
+
+    def load_categories(filename):
+        loaded_categories.append(filename)
+        return CATEGORIES
+
+    compiled_rules = load_rules_file(rules_filename, categories_filename, load_categories)
+    assert len(compiled_rules) == 2
+    assert load_rules_file(rules_filename, categories_filename, load_categories) is compiled_rules
+
+    # Files touched without changes keep the same compiled rules
+    os.utime(rules_filename, ns=(0, 0))
+    assert load_rules_file(rules_filename, categories_filename, load_categories) is compiled_rules
+    assert loaded_categories == [categories_filename]
+
+    with open(rules_filename, 'a') as rules_file:
+        rules_file.write('- conditions: []\n  actions: [{add: {field: tags, values: [all]}}]\n')
+    os.utime(rules_filename, ns=(0, 0))
+
+    assert len(load_rules_file(rules_filename, categories_filename, load_categories)) == 3
+    assert len(loaded_categories) == 2
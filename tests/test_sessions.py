@@ -0,0 +1,164 @@
+import pytest
+
+from bank.sessions import BankSession
+
+
+class FakeBrowser():
+    """
+        Keeps the state of the loaded page as a real browser does: loading an url that
+        only changes the fragment of the current one keeps the same page.
+    """
+
+    def __init__(self):
+        self.current_url = 'about:blank'
+        self.page = {}
+        self.logged_in = False
+        self.released = False
+
+    def get(self, url):
+        if url.split('#')[0] != self.current_url.split('#')[0]:
+            self.page = {}
+        self.current_url = url
+
+
+def scrap_target(browser, target):
+    # Mimics the bank scrappers: load the app, patch it to intercept the responses
+    # and search the target transactions
+    browser.get('https://bank.test/app#/{}'.format(target))
+    browser.page['patches'] = browser.page.get('patches', 0) + 1
+    responses = browser.page.setdefault('responses', [])
+    responses.extend([target] * browser.page['patches'])
+    return list(responses)
+
+
+class ScrapFailed(Exception):
+    pass
+
+
+def make_session(expired=lambda browser: False, login_fails=0):
+    browsers = []
+    logins = []
+
+    def new_browser():
+        browsers.append(FakeBrowser())
+        return browsers[-1]
+
+    def login(browser, username, password):
+        if len(logins) < login_fails:
+            logins.append(None)
+            raise ScrapFailed('login')
+        logins.append(browser)
+        browser.logged_in = True
+
+    def release_browser(browser):
+        browser.released = True
+
+    session = BankSession(
+        bank_config=type('BankConfig', (), {'name': 'Test bank', 'username': 'user', 'password': 'password'}),
+        login=login,
+        session_expired=expired,
+        new_browser=new_browser,
+        release_browser=release_browser
+    )
+    return session, browsers, logins
+
+
+def test_session_logs_in_on_first_scrapping():
+    session, browsers, logins = make_session()
+
+    assert browsers == []
+
+    with session:
+        session.scrap(scrap_target, 'account')
+        session.scrap(scrap_target, 'card')
+
+    assert len(browsers) == 1
+    assert logins == browsers
+    assert browsers[0].released
+
+
+def test_session_targets_dont_share_page_state():
+    session, browsers, logins = make_session()
+
+    with session:
+        account_responses = session.scrap(scrap_target, 'account')
+        card_responses = session.scrap(scrap_target, 'card')
+
+    assert account_responses == ['account']
+    assert card_responses == ['card']
+    assert len(logins) == 1
+
+
+def test_expired_session_logs_in_again_once():
+    attempts = []
+
+    def scrap_until_relogin(browser, target):
+        attempts.append(browser)
+        if len(attempts) == 2:
+            raise ScrapFailed(target)
+        return target
+
+    session, browsers, logins = make_session(expired=lambda browser: True)
+
+    with session:
+        session.scrap(scrap_until_relogin, 'account')
+        assert session.scrap(scrap_until_relogin, 'card') == 'card'
+
+    assert len(logins) == 2
+    assert attempts == [browsers[0], browsers[0], browsers[1]]
+    assert all(browser.released for browser in browsers)
+
+
+def test_expired_session_retries_only_once():
+    def always_failing(browser, target):
+        raise ScrapFailed(target)
+
+    session, browsers, logins = make_session(expired=lambda browser: True)
+
+    with session:
+        session.scrap(scrap_target, 'account')
+        with pytest.raises(ScrapFailed):
+            session.scrap(always_failing, 'card')
+
+    assert len(logins) == 2
+
+
+def test_scrapping_errors_dont_log_in_again():
+    def always_failing(browser, target):
+        raise ScrapFailed(target)
+
+    session, browsers, logins = make_session(expired=lambda browser: False)
+
+    with session:
+        session.scrap(scrap_target, 'account')
+        with pytest.raises(ScrapFailed):
+            session.scrap(always_failing, 'card')
+
+    assert len(logins) == 1
+    assert browsers[0].released
+
+
+def test_fresh_session_errors_are_raised():
+    def always_failing(browser, target):
+        raise ScrapFailed(target)
+
+    session, browsers, logins = make_session(expired=lambda browser: True)
+
+    with pytest.raises(ScrapFailed):
+        with session:
+            session.scrap(always_failing, 'account')
+
+    assert len(logins) == 1
+    assert browsers[0].released
+
+
+def test_failed_login_releases_browser():
+    session, browsers, logins = make_session(login_fails=1)
+
+    with session:
+        with pytest.raises(ScrapFailed):
+            session.scrap(scrap_target, 'account')
+        assert session.scrap(scrap_target, 'card') == ['card']
+
+    assert len(browsers) == 2
+    assert all(browser.released for browser in browsers)
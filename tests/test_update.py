@@ -0,0 +1,253 @@
+import pytest
+
+from collections import Counter, namedtuple
+from dataclasses import replace
+from datetime import datetime
+
+import threading
+import time
+
+from rules.domain import Rule
+from rules.io import Match, Set
+
+import bank.runtime
+
+from .helpers import make_transaction
+
+
+Bank = namedtuple('Bank', 'id, name, accounts')
+Account = namedtuple('Account', 'id')
+Card = namedtuple('Card', 'number, type, active, account_number')
+Scheduler = namedtuple('Scheduler', 'update_timeout_seconds, max_parallel_banks')
+BankingConfig = namedtuple('BankingConfig', 'banks, accounts, cards, scheduler, notifications')
+
+
+class FakeDatabase():
+
+    def __init__(self):
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closed = True
+
+
+class FakeSession():
+
+    def __init__(self, bank_config):
+        self.bank_config = bank_config
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closed = True
+
+
+def make_banking_config(max_parallel_banks):
+    bbva = Bank('bbva', 'BBVA', {'ES01': Account('ES01'), 'ES02': Account('ES02')})
+    bankia = Bank('bankia', 'Bankia', {'ES03': Account('ES03')})
+    cards = [
+        Card('1111', 'credit', True, 'ES01'),
+        Card('2222', 'credit', False, 'ES02'),
+        Card('3333', 'debit', True, 'ES02'),
+        Card('4444', 'credit', True, 'ES03'),
+    ]
+    return BankingConfig(
+        banks={bbva.id: bbva, bankia.id: bankia},
+        accounts={**bbva.accounts, **bankia.accounts},
+        cards={card.number: card for card in cards},
+        scheduler=Scheduler(update_timeout_seconds=0, max_parallel_banks=max_parallel_banks),
+        notifications=None
+    )
+
+
+@pytest.fixture
+def stubbed_update(monkeypatch, tmp_path):
+    """
+        Runs update_all with the scrapping and the database stubbed, recording which
+        account or card each bank updated, with which session, and when.
+    """
+    updates = []
+    databases = []
+    sessions = []
+    messages = []
+    lock = threading.Lock()
+
+    def record(bank_config, source, identifier, session):
+        start = time.monotonic()
+        # Leaves time for the updates of other banks to run meanwhile
+        time.sleep(0.05)
+        with lock:
+            updates.append((bank_config.id, source, identifier, session, start, time.monotonic()))
+
+    def update_bank_account_transactions(db, bank_config, account_config, from_date, to_date, session=None):
+        record(bank_config, 'account', account_config.id, session)
+        if account_config.id == 'ES02':
+            raise Exception('Scrapping failed')
+        return (0, 2)
+
+    def update_bank_credit_card_transactions(db, bank_config, account_config, card_config, from_date, to_date, session=None):
+        record(bank_config, 'card', card_config.number, session)
+        return (1, 0)
+
+    def load(database_folder):
+        databases.append(FakeDatabase())
+        return databases[-1]
+
+    def new_session(bank_config):
+        sessions.append(FakeSession(bank_config))
+        return sessions[-1]
+
+    monkeypatch.setattr(bank.runtime, 'update_bank_account_transactions', update_bank_account_transactions)
+    monkeypatch.setattr(bank.runtime, 'update_bank_credit_card_transactions', update_bank_credit_card_transactions)
+    monkeypatch.setattr(bank.runtime, 'new_session', new_session)
+    monkeypatch.setattr(bank.runtime, 'get_notifier', lambda notifications: messages.append)
+    monkeypatch.setattr(bank.runtime.database, 'load', load)
+    monkeypatch.setattr(bank.runtime.database, 'last_account_transaction_date', lambda db, account_number: None)
+    monkeypatch.setattr(bank.runtime.database, 'last_credit_card_transaction_date', lambda db, card_number: None)
+
+    def run(max_parallel_banks):
+        bank.runtime.update_all(
+            make_banking_config(max_parallel_banks),
+            {'metadata_file': str(tmp_path / 'metadata.yaml'), 'database_folder': str(tmp_path)}
+        )
+        return updates, databases, sessions, messages
+
+    return run
+
+
+def overlap(first, second):
+    return first[4] < second[5] and second[4] < first[5]
+
+
+@pytest.mark.parametrize('max_parallel_banks', [1, 2])
+def test_update_all_groups_updates_by_bank(stubbed_update, max_parallel_banks):
+    updates, databases, sessions, messages = stubbed_update(max_parallel_banks)
+
+    assert sorted(update[:3] for update in updates) == [
+        ('bankia', 'account', 'ES03'),
+        ('bankia', 'card', '4444'),
+        ('bbva', 'account', 'ES01'),
+        ('bbva', 'account', 'ES02'),
+        ('bbva', 'card', '1111'),
+    ]
+
+    # One session by bank, shared by all its accounts and cards
+    assert sorted(session.bank_config.id for session in sessions) == ['bankia', 'bbva']
+    for update in updates:
+        assert update[3].bank_config.id == update[0]
+    assert all(session.closed for session in sessions)
+
+    # One database connection by bank, closed after the update
+    assert len(databases) == 2
+    assert all(db.closed for db in databases)
+
+
+@pytest.mark.parametrize('max_parallel_banks', [1, 2])
+def test_update_all_serializes_updates_of_each_bank(stubbed_update, max_parallel_banks):
+    updates, databases, sessions, messages = stubbed_update(max_parallel_banks)
+
+    for index, update in enumerate(updates):
+        for other in updates[index + 1:]:
+            if other[0] == update[0]:
+                assert not overlap(update, other)
+
+    banks_overlap = any(overlap(update, other) for update in updates for other in updates if other[0] != update[0])
+    assert banks_overlap == (max_parallel_banks > 1)
+
+
+def test_update_all_collects_messages_of_all_banks(stubbed_update):
+    updates, databases, sessions, messages = stubbed_update(max_parallel_banks=2)
+
+    assert sorted(messages[:4]) == [
+        'Added 2 new transactions for *BBVA* account *ES01*',
+        'Added 2 new transactions for *Bankia* account *ES03*',
+        'Removed 1 transactions for *BBVA* card *1111*',
+        'Removed 1 transactions for *Bankia* card *4444*',
+    ]
+    assert len(messages) == 5
+    assert 'While updating *BBVA* account *ES02*' in messages[4]
+    assert 'Scrapping failed' in messages[4]
+
+
+@pytest.mark.parametrize('max_parallel_banks', [1, 2])
+def test_update_all_reports_failed_banks(stubbed_update, monkeypatch, max_parallel_banks):
+    new_session = bank.runtime.new_session
+
+    def failing_new_session(bank_config):
+        if bank_config.id == 'bbva':
+            raise Exception('Browser failed to start')
+        return new_session(bank_config)
+
+    monkeypatch.setattr(bank.runtime, 'new_session', failing_new_session)
+    updates, databases, sessions, messages = stubbed_update(max_parallel_banks)
+
+    # The other banks are still updated and notified
+    assert sorted(update[:3] for update in updates) == [
+        ('bankia', 'account', 'ES03'),
+        ('bankia', 'card', '4444'),
+    ]
+    assert all(db.closed for db in databases)
+    assert len(messages) == 3
+    assert 'While updating *BBVA* bank *bbva*' in messages[2]
+    assert 'Browser failed to start' in messages[2]
+
+
+def test_transactions_pipeline(monkeypatch):
+    rent_rule = Rule(conditions=[Match('keywords', 'RENT')], actions=[Set('comment', 'Rent')])
+    monkeypatch.setattr(bank.runtime.rules, 'load', lambda: [rent_rule])
+    logged = []
+    monkeypatch.setattr(bank.runtime.logger, 'info', logged.append)
+
+    def parse_transaction(raw_transaction):
+        # Raw transactions without a day are the ones the banks parsers skip
+        if raw_transaction['day'] is None:
+            return None
+        return replace(make_transaction(keywords=raw_transaction['keywords']), transaction_date=datetime(2020, 1, raw_transaction['day']))
+
+    raw_transactions = [
+        {'day': 1, 'keywords': ['RENT']},
+        {'day': None, 'keywords': []},
+        {'day': 10, 'keywords': ['RENT']},
+        {'day': 15, 'keywords': ['SHOP']},
+        {'day': None, 'keywords': ['RENT']},
+        {'day': 20, 'keywords': ['SHOP']},
+        {'day': 31, 'keywords': ['RENT']},
+    ]
+    counters = Counter()
+    processed_transactions = bank.runtime.transactions_pipeline(
+        raw_transactions, parse_transaction, datetime(2020, 1, 5), datetime(2020, 1, 25), counters
+    )
+
+    # Nothing runs until the transactions are consumed
+    assert len(raw_transactions) == 7
+    assert not counters
+
+    processed_transactions = list(processed_transactions)
+    assert raw_transactions == []
+    assert counters == {'fetched': 7, 'parsed': 5, 'in_range': 3, 'processed': 3}
+    assert [(transaction.transaction_date.day, transaction.comment) for transaction in processed_transactions] == [
+        (10, 'Rent'),
+        (15, ''),
+        (20, ''),
+    ]
+
+    bank.runtime.log_pipeline_counters(counters)
+    assert logged == [
+        '5 transactions parsed (2 out of date range got filtered)',
+        'Rules applied to 3 transactions',
+    ]
+
+
+def test_drain():
+    items = [1, 2, 3]
+    drained = bank.runtime.drain(items)
+
+    assert next(drained) == 1
+    assert len(items) == 2
+    assert list(drained) == [2, 3]
+    assert items == []